@@ -33,6 +33,8 @@ openstack endpoint list --os-scope '{"identity": "'$DUOLC'"}'
 openstack image list
 openstack image list --os-scope '{"image": "'$CLOUD'"}'
 openstack image list --os-scope '{"image": "'$DUOLC'"}'
+# Images of both clouds, listed concurrently
+openstack image list --os-scope '{"image": ["'$CLOUD'", "'$DUOLC'"]}'
 
 # Network list
 openstack network list
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures requests through the ScopeProxy to a cloud with two Glance
+endpoints, the first one slower, with and without Balancer.
+
+Run with
+
+  python benchmarks/bench_balancer.py [SLOW_MS FAST_MS]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from oidinterpreter import SCOPE_DELIM, Balancer  # noqa
+from oidinterpreter.proxy import get_scope_proxy  # noqa
+from tests.tests_proxy import (  # noqa
+    TOKEN, StubBackend, request, services_json)
+
+
+NB_CLIENTS = 16
+REQUESTS_PER_CLIENT = 25
+
+
+async def client(port: int, latencies: list) -> None:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for _ in range(REQUESTS_PER_CLIENT):
+        start = time.perf_counter()
+        await request(reader, writer, 'GET', '/image/v2/images/cirros', {
+            'Host': '10.0.0.1:8888',
+            'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:CloudTwo'})
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def bench(slow: float, fast: float) -> None:
+    glances = [StubBackend('slow', delay=slow), StubBackend('fast',
+                                                            delay=fast)]
+    for glance in glances:
+        await glance.start()
+    services = services_json('10.0.2.15:80', '10.0.2.15:80',
+                             glances[0].address)
+    services['services'].append({
+        'Service Type': 'image', 'Interface': 'public',
+        'URL': f'{glances[1].address}/image', 'Region': 'CloudTwo',
+        'Frontend': glances[1].address, 'Backend': '10.0.2.15:80'})
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(services, f)
+
+    for name, balancer in [('first', None), ('balancer', Balancer())]:
+        proxy = get_scope_proxy(services_path, 'CloudOne')
+        proxy.oidi.balancer = balancer
+        server = (await proxy.start(['127.0.0.1:0']))[0]
+        port = server.sockets[0].getsockname()[1]
+        for glance in glances:
+            glance.requests.clear()
+
+        latencies: list = []
+        await asyncio.gather(*(client(port, latencies)
+                               for _ in range(NB_CLIENTS)))
+        server.close()
+        proxy.pools.close()
+
+        latencies.sort()
+        print(f'{name:>8} | mean {statistics.mean(latencies) * 1e3:6.1f} ms '
+              f'| p99 {latencies[int(len(latencies) * .99)] * 1e3:6.1f} ms '
+              f'| slow/fast {len(glances[0].requests):>3}/'
+              f'{len(glances[1].requests):<3}')
+
+    for glance in glances:
+        glance.server.close()
+    await asyncio.sleep(0.1)
+    os.remove(services_path)
+
+
+if __name__ == "__main__":
+    slow_ms, fast_ms = ([float(ms) for ms in sys.argv[1:3]]
+                        if len(sys.argv) > 2 else [50.0, 10.0])
+    print(f'{NB_CLIENTS} clients x {REQUESTS_PER_CLIENT} GETs, Glances of '
+          f'{slow_ms} and {fast_ms} ms')
+    asyncio.run(bench(slow_ms / 1e3, fast_ms / 1e3))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures requests through the ScopeProxy when the frontend of CloudTwo is
+dead, with and without CircuitBreaker.
+
+The dead frontend answers 503 after DEAD_MS milliseconds, as HAProxy does
+once its connect timeouts and retries are exhausted. Half of the clients
+scope their requests to CloudTwo, the other half to CloudOne.
+
+Run with
+
+  python benchmarks/bench_breaker.py [DEAD_MS]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from oidinterpreter import SCOPE_DELIM, CircuitBreaker  # noqa
+from oidinterpreter.proxy import get_scope_proxy  # noqa
+from tests.tests_proxy import (  # noqa
+    TOKEN, StubBackend, request, services_json)
+
+
+NB_CLIENTS = 16
+REQUESTS_PER_CLIENT = 20
+
+
+async def client(port: int, cloud: str, latencies: list) -> None:
+    for _ in range(REQUESTS_PER_CLIENT):
+        # Errors close the connection, so open one per request
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        start = time.perf_counter()
+        await request(reader, writer, 'GET', '/compute/v2.1/servers', {
+            'Host': '10.0.0.1:8888',
+            'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:{cloud}'})
+        latencies.append(time.perf_counter() - start)
+        writer.close()
+
+
+async def bench(dead: float) -> None:
+    backend_one = StubBackend('CloudOne')
+    frontend_two = StubBackend('CloudTwo')
+    await backend_one.start()
+    await frontend_two.start()
+
+    async def unavailable(reader, writer, *head):
+        frontend_two.requests.append(head)
+        await asyncio.sleep(dead)
+        writer.write(b'HTTP/1.1 503 Service Unavailable\r\n'
+                     b'Content-Length: 0\r\n\r\n')
+        await writer.drain()
+
+    frontend_two.respond = unavailable
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(services_json(backend_one.address, '10.0.2.15:80',
+                                frontend_two.address), f)
+
+    for name, breaker in [('none', None), ('breaker', CircuitBreaker())]:
+        proxy = get_scope_proxy(services_path, 'CloudOne')
+        proxy.oidi.breaker = breaker
+        server = (await proxy.start(['127.0.0.1:0']))[0]
+        port = server.sockets[0].getsockname()[1]
+        frontend_two.requests.clear()
+
+        latencies: dict = {'CloudOne': [], 'CloudTwo': []}
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            client(port, cloud, latencies[cloud])
+            for cloud in latencies for _ in range(NB_CLIENTS // 2)))
+        elapsed = time.perf_counter() - start
+        server.close()
+        proxy.pools.close()
+
+        print(f'{name:>8} | total {elapsed:5.2f} s | ' + ' | '.join(
+            f'{cloud} mean {statistics.mean(lat) * 1e3:6.1f} ms'
+            for cloud, lat in latencies.items()) +
+            f' | calls to CloudTwo {len(frontend_two.requests):>3}')
+
+    backend_one.server.close()
+    frontend_two.server.close()
+    await asyncio.sleep(0.1)
+    os.remove(services_path)
+
+
+if __name__ == "__main__":
+    dead_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 200.0
+    print(f'{NB_CLIENTS} clients x {REQUESTS_PER_CLIENT} GETs, dead '
+          f'frontend answers 503 after {dead_ms} ms')
+    asyncio.run(bench(dead_ms / 1e3))
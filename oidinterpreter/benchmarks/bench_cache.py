@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures a batch boot through the ScopeProxy with and without ResponseCache.
+
+Each VM of the batch gets the same few images from the Glance of another
+cloud, a stub that answers after RTT_MS to stand for the WAN.
+
+Run with
+
+  python benchmarks/bench_cache.py [RTT_MS]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from oidinterpreter import SCOPE_DELIM  # noqa
+from oidinterpreter.cache import ResponseCache  # noqa
+from oidinterpreter.proxy import get_scope_proxy  # noqa
+from tests.tests_proxy import TOKEN, StubBackend, request, services_json  # noqa
+
+
+NB_VMS = 50
+NB_IMAGES = 4
+GETS_PER_VM = 3
+
+
+class RemoteGlance(StubBackend):
+    def __init__(self, rtt: float):
+        super().__init__('CloudTwo')
+        self.rtt = rtt
+
+    async def respond(self, *args):
+        await asyncio.sleep(self.rtt)
+        await super().respond(*args)
+
+
+async def boot(port: int, vm: int) -> None:
+    "GETs of one VM, on its own connection, as a nova-compute would."
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    headers = {'Host': '10.0.0.1:8888',
+               'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:CloudOne;image=CloudTwo'}
+    for _ in range(GETS_PER_VM):
+        await request(reader, writer, 'GET',
+                      f'/image/v2/images/{vm % NB_IMAGES}', headers)
+    writer.close()
+
+
+async def bench(rtt: float) -> None:
+    glance = RemoteGlance(rtt)
+    await glance.start()
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(services_json('10.0.2.15:80', '10.0.2.15:80',
+                                glance.address), f)
+
+    for name, cache in [('no cache', None),
+                        ('cache', ResponseCache(['image'], ttl=5.0))]:
+        proxy = get_scope_proxy(services_path, 'CloudOne', cache=cache)
+        server = (await proxy.start(['127.0.0.1:0']))[0]
+        port = server.sockets[0].getsockname()[1]
+        glance.requests.clear()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(boot(port, vm) for vm in range(NB_VMS)))
+        duration = time.perf_counter() - start
+        server.close()
+        proxy.pools.close()
+
+        stats = proxy.cache_stats()
+        print(f'{name:>8} | batch {duration * 1e3:8.1f} ms '
+              f'| {len(glance.requests):>4} WAN requests '
+              f'| hit rate {stats.hit_rate if stats else 0.0:5.1%}')
+
+    glance.server.close()
+    await asyncio.sleep(0.1)
+    os.remove(services_path)
+
+
+if __name__ == "__main__":
+    rtt_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    print(f'{NB_VMS} VMs x {GETS_PER_VM} GETs of {NB_IMAGES} images, '
+          f'WAN rtt {rtt_ms} ms')
+    asyncio.run(bench(rtt_ms / 1e3))
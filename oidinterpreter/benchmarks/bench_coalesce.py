@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures a burst of identical token validations through the ScopeProxy,
+with and without coalescing.
+
+NB_VMS services validate the same token at once against the Keystone of
+another cloud, a stub that answers after RTT_MS.
+
+Run with
+
+  python benchmarks/bench_coalesce.py [RTT_MS]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from oidinterpreter import SCOPE_DELIM  # noqa
+from oidinterpreter.proxy import get_scope_proxy  # noqa
+from tests.tests_proxy import TOKEN, StubBackend, request, services_json  # noqa
+
+
+NB_VMS = 100
+
+
+async def validate(port: int) -> float:
+    "Validates the token of the burst, returns the latency."
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    start = time.perf_counter()
+    await request(reader, writer, 'GET', '/identity/v3/auth/tokens', {
+        'Host': '10.0.0.1:8888', 'X-Subject-Token': TOKEN,
+        'X-Auth-Token': f'service-token{SCOPE_DELIM}1:CloudTwo'})
+    latency = time.perf_counter() - start
+    writer.close()
+    return latency
+
+
+async def bench(rtt: float) -> None:
+    keystone = StubBackend('CloudTwo', delay=rtt)
+    await keystone.start()
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(services_json('10.0.2.15:80', '10.0.2.15:80',
+                                keystone.address), f)
+
+    for name, coalesce in [('single', False), ('coalesce', True)]:
+        proxy = get_scope_proxy(services_path, 'CloudOne', coalesce=coalesce)
+        server = (await proxy.start(['127.0.0.1:0']))[0]
+        port = server.sockets[0].getsockname()[1]
+        keystone.requests.clear()
+
+        latencies = sorted(await asyncio.gather(
+            *(validate(port) for _ in range(NB_VMS))))
+        server.close()
+        proxy.pools.close()
+
+        print(f'{name:>8} | p50 {latencies[len(latencies) // 2] * 1e3:7.1f} ms'
+              f' | max {latencies[-1] * 1e3:7.1f} ms'
+              f' | {len(keystone.requests):>4} upstream calls'
+              f' | {proxy.coalesce_stats.saved:>4} saved')
+
+    keystone.server.close()
+    await asyncio.sleep(0.1)
+    os.remove(services_path)
+
+
+if __name__ == "__main__":
+    rtt_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 50.0
+    print(f'{NB_VMS} concurrent validations of one token, WAN rtt {rtt_ms} ms')
+    asyncio.run(bench(rtt_ms / 1e3))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Compares `interpret_scope.lua` with `interpret_scope_maps.lua` on the
+catalogs and scopes of `bench_suite.py`, for requests to the services of
+Cloud0, half of them with a compact scope in X-Auth-Token, 20% with a
+json scope in X-Scope, and the others without scope.
+
+- lua: runs each script with lupa (Lua 5.3, as in HAProxy) on the fake
+  HAProxy API of `tests_haproxy`, and measures the time per call of the
+  `interpret_scope` fetch. The fake scans maps in file order, HAProxy
+  looks them up in a prefix tree.
+- haproxy: runs a local `haproxy` (with Lua) with each script in front
+  of a stub backend, and measures the throughput of NB_CLIENTS keep-alive
+  clients. Skipped if `haproxy` is not in the PATH.
+
+Run with
+
+  python benchmarks/bench_haproxy.py [--clouds 2 10 100] [--no-haproxy]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from bench_suite import SEED, TOKEN, make_catalog, make_scopes  # noqa
+from oidinterpreter import SCOPE_DELIM, encode_scope, oss2services  # noqa
+from oidinterpreter.haproxy import write_maps  # noqa
+from tests.tests_haproxy import LUA_DIR, LuaHAProxy  # noqa
+from tests.tests_proxy import StubBackend, request  # noqa
+
+
+SCRIPTS = ['interpret_scope', 'interpret_scope_maps']
+CLOUDS = [2, 10, 100]
+NB_REQUESTS = 2000
+ROUNDS = 5
+NB_CLIENTS = 16
+HAPROXY_REQUESTS = 20000
+
+# Address of the services.json read by `services.lua`
+SERVICES_JSON = '/etc/haproxy/services.json'
+
+# Makes `services.lua` read another services.json, in HAProxy
+PRELOAD = """
+local open = io.open
+io.open = function(filename, mode)
+  if filename == '{services_json}' then filename = '{path}' end
+  return open(filename, mode)
+end
+"""
+
+HAPROXY_CFG = """
+global
+  lua-load {preload}
+  lua-load {lua_dir}/{script}.lua
+
+defaults
+  mode http
+  timeout connect 10s
+  timeout client 1m
+  timeout server 1m
+
+frontend bench
+  bind 127.0.0.1:{port}
+  use_backend %[lua.interpret_scope("Cloud0")]
+
+{backends}
+"""
+
+Requests = List[Tuple[str, Dict[str, str]]]
+
+
+def make_requests(rng: random.Random, catalog: List[Dict[str, str]],
+                  nb_clouds: int, nb: int = NB_REQUESTS) -> Requests:
+    """Draws the (base, headers) of the requests of the module doc."""
+    scopes = make_scopes(rng, nb_clouds)
+    local = [s for s in catalog if s['Region'] == 'Cloud0']
+    reqs = []
+    for _ in range(nb):
+        service = rng.choice(local)
+        base = f'{service["URL"]}/v{rng.randrange(3)}/res/{rng.randrange(99)}'
+        scope = rng.choice(scopes)
+        draw = rng.random()
+        if draw < 0.5:
+            raw_scope = encode_scope(scope, max(
+                scope.values(), key=list(scope.values()).count))
+            headers = {'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}{raw_scope}'}
+        elif draw < 0.7:
+            headers = {'X-Auth-Token': TOKEN, 'X-Scope': json.dumps(scope)}
+        else:
+            headers = {'X-Auth-Token': TOKEN}
+        reqs.append((base, headers))
+    return reqs
+
+
+def setup(nb_clouds: int, directory: str
+          ) -> Tuple[List[Dict[str, str]], Requests, str]:
+    """Writes the services.json and the maps of `nb_clouds` in `directory`.
+
+    Returns the services, the requests and the path of services.json.
+    HAProxy sees urls without scheme.
+
+    """
+    catalog = [dict(s, URL=s['URL'][len('http://'):])
+               for s in make_catalog(nb_clouds)]
+    services_path = os.path.join(directory, 'services.json')
+    with open(services_path, 'w') as f:
+        json.dump({'services': catalog}, f)
+    write_maps(oss2services(catalog), directory)
+    reqs = make_requests(random.Random(SEED), catalog, nb_clouds)
+    return catalog, reqs, services_path
+
+
+def bench_lua(script: str, reqs: Requests, services_path: str,
+              directory: str) -> float:
+    """Returns the best time per call (s) of the fetch of `script`."""
+    lua = LuaHAProxy(script, files={SERVICES_JSON: services_path},
+                     env={'OIDI_MAPS': directory})
+    make_txn = lua.lua.globals().make_txn
+    txns = lua.lua.table_from([
+        make_txn(base, lua.lua.table_from(
+            {name.lower(): value for name, value in dict(
+                headers, Host=base.partition('/')[0]).items()}))[0]
+        for base, headers in reqs])
+    run = lua.lua.eval("""function(fetch, txns)
+      local start = os.clock()
+      for _, txn in ipairs(txns) do fetch(txn, 'Cloud0') end
+      return os.clock() - start
+    end""")
+    run(lua._fetch, txns)
+    return min(run(lua._fetch, txns) for _ in range(ROUNDS)) / len(reqs)
+
+
+async def bench_haproxy(script: str, catalog: List[Dict[str, str]],
+                        reqs: Requests, services_path: str,
+                        directory: str) -> float:
+    """Returns the throughput (req/s) of a local HAProxy with `script`."""
+    stub = StubBackend('stub')
+    await stub.start()
+    preload = os.path.join(directory, 'preload.lua')
+    with open(preload, 'w') as f:
+        f.write(PRELOAD.format(services_json=SERVICES_JSON,
+                               path=services_path))
+    backends = ''.join(
+        f'backend {name}\n  server stub {stub.address}\n\n'
+        for name in ['transparent'] + sorted({
+            f'{s["Region"]}_{s["Service Type"]}_{s["Interface"]}'
+            for s in catalog}))
+    port = random.randrange(20000, 30000)
+    cfg = os.path.join(directory, 'haproxy.cfg')
+    with open(cfg, 'w') as f:
+        f.write(HAPROXY_CFG.format(preload=preload, lua_dir=LUA_DIR,
+                                   script=script, port=port,
+                                   backends=backends))
+
+    env = dict(os.environ, LUA_PATH=f'{LUA_DIR}/?.lua;;',
+               OIDI_MAPS=directory)
+    haproxy = subprocess.Popen(['haproxy', '-db', '-f', cfg], env=env)
+    try:
+        await asyncio.sleep(1.0)
+
+        async def client(i: int) -> None:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for n in range(i, HAPROXY_REQUESTS, NB_CLIENTS):
+                base, headers = reqs[n % len(reqs)]
+                host, _, path = base.partition('/')
+                await request(reader, writer, 'GET', f'/{path}',
+                              dict(headers, Host=host))
+            writer.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(NB_CLIENTS)))
+        return HAPROXY_REQUESTS / (time.perf_counter() - start)
+    finally:
+        haproxy.terminate()
+        haproxy.wait()
+        stub.server.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clouds', type=int, nargs='+', default=CLOUDS)
+    parser.add_argument('--no-haproxy', action='store_true',
+                        help='Only run the scripts with lupa')
+    args = parser.parse_args(argv)
+    with_haproxy = not args.no_haproxy and shutil.which('haproxy')
+    if not args.no_haproxy and not with_haproxy:
+        print('haproxy is not in the PATH, only run the scripts with lupa')
+
+    for nb_clouds in args.clouds:
+        directory = tempfile.mkdtemp()
+        try:
+            catalog, reqs, services_path = setup(nb_clouds, directory)
+            for script in SCRIPTS:
+                latency = bench_lua(script, reqs, services_path, directory)
+                line = (f'{nb_clouds:>4} clouds | {script:>20} | lua '
+                        f'{latency * 1e6:7.2f} µs')
+                if with_haproxy:
+                    rate = asyncio.run(bench_haproxy(
+                        script, catalog, reqs, services_path, directory))
+                    line += f' | haproxy {rate:8.0f} req/s'
+                print(line)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Compares memory and latency of `iinterpret` and `rewrite` against the
+former `deepcopy` implementation of `iinterpret`, on large bodies.
+
+Run with
+
+  python benchmarks/bench_iinterpret.py [BODY_MB ...]
+"""
+import copy
+import json
+import sys
+import time
+import tracemalloc
+
+from requests import Request
+
+from oidinterpreter import Service, get_oidinterpreter_from_services
+
+
+IMAGE1 = Service(service_type='image', cloud='CloudOne', interface='public',
+                 url='http://192.168.141.245:8888/image')
+IMAGE2 = Service(service_type='image', cloud='CloudTwo', interface='public',
+                 url='http://192.168.142.245:8888/image')
+SCOPE = json.dumps({'identity': 'CloudOne', 'image': 'CloudTwo'})
+
+
+def measure(f, req, number=10):
+    "Returns the mean latency (s) and the peak of allocations (B) of `f`."
+    tracemalloc.start()
+    f(req)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(number):
+        f(req)
+    return (time.perf_counter() - start) / number, peak
+
+
+def bench(body_mb: int) -> None:
+    oidi = get_oidinterpreter_from_services([IMAGE1, IMAGE2])
+    # A mutable buffer, like the chunks of an image upload, that `deepcopy`
+    # cannot share
+    req = Request('PUT', f'{IMAGE1.url}/v2/images/42/file',
+                  {'X-Scope': SCOPE}, data=bytearray(body_mb << 20))
+
+    def deepcopy_iinterpret(req):
+        req2 = copy.deepcopy(req)
+        oidi.interpret(req2)
+        return req2
+
+    for name, f in [('deepcopy', deepcopy_iinterpret),
+                    ('iinterpret', oidi.iinterpret),
+                    ('rewrite', oidi.rewrite)]:
+        latency, peak = measure(f, req)
+        print(f'{body_mb:>4} MB body | {name:>10} | '
+              f'{latency * 1e6:10.1f} µs | peak {peak / 1024:10.1f} KiB')
+
+
+if __name__ == "__main__":
+    for body_mb in [int(n) for n in sys.argv[1:]] or [1, 16, 64]:
+        bench(body_mb)
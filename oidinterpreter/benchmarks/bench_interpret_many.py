@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Compares `interpret_many` against `interpret` in a loop.
+
+Run with
+
+  python benchmarks/bench_interpret_many.py [NB_REQUESTS ...]
+"""
+import json
+import sys
+import time
+
+from requests import Request
+
+from oidinterpreter import Service, get_oidinterpreter_from_services
+
+
+CLOUDS = ['CloudOne', 'CloudTwo', 'CloudThree']
+SERVICES = [
+    Service(service_type=service_type, cloud=cloud, interface=interface,
+            url=f'http://192.168.14{i}.245:8888/{path}')
+    for i, cloud in enumerate(CLOUDS)
+    for service_type, interface, path in [
+            ('identity', 'admin', 'identity'),
+            ('compute', 'public', 'compute/v2.1'),
+            ('image', 'public', 'image'),
+            ('network', 'public', 'network')]]
+SCOPES = [json.dumps({'identity': CLOUDS[i % 3], 'compute': CLOUDS[i % 2],
+                      'image': CLOUDS[(i + 1) % 3],
+                      'network': CLOUDS[i % 2]})
+          for i in range(4)]
+TOKEN = '507582fc-57c6-4bc7-a051-9fb3f269da70'
+
+
+def make_requests(nb_requests: int):
+    return [Request('GET',
+                    f'{SERVICES[i % len(SERVICES)].url}/resources/{i}',
+                    {'X-Auth-Token': f'{TOKEN}!SCOPE!{SCOPES[i % 4]}'})
+            for i in range(nb_requests)]
+
+
+def bench(nb_requests: int) -> None:
+    oidi = get_oidinterpreter_from_services(SERVICES)
+
+    reqs = make_requests(nb_requests)
+    start = time.perf_counter()
+    for req in reqs:
+        oidi.interpret(req)
+    t_loop = time.perf_counter() - start
+
+    reqs = make_requests(nb_requests)
+    start = time.perf_counter()
+    oidi.interpret_many(reqs)
+    t_many = time.perf_counter() - start
+
+    print(f'{nb_requests:>7} requests | '
+          f'loop {nb_requests / t_loop:10.0f} req/s | '
+          f'interpret_many {nb_requests / t_many:10.0f} req/s')
+
+
+if __name__ == "__main__":
+    for nb_requests in [int(n) for n in sys.argv[1:]] or [1000, 100000]:
+        bench(nb_requests)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures the overhead of Metrics on `rewrite`, and of the former eager
+formatting of logs in `get_scope` when INFO is disabled.
+
+Run with
+
+  python benchmarks/bench_metrics.py [NUMBER]
+"""
+import logging
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from requests import Request  # noqa
+
+from oidinterpreter import Metrics, Service, OidInterpreter  # noqa
+
+
+LOG = logging.getLogger('oidinterpreter')
+LOG.setLevel(logging.WARNING)
+
+COMPUTE1 = Service(service_type='compute', cloud='CloudOne',
+                   interface='public',
+                   url='http://192.168.141.245:8888/compute/v2.1')
+COMPUTE2 = Service(service_type='compute', cloud='CloudTwo',
+                   interface='public',
+                   url='http://192.168.142.245:8888/compute/v2.1')
+SCOPE = '1:CloudOne;compute=CloudTwo'
+
+
+def measure(f, req, number: int) -> float:
+    "Returns the mean latency (s) of `f(req)`."
+    f(req)
+    start = time.perf_counter()
+    for _ in range(number):
+        f(req)
+    return (time.perf_counter() - start) / number
+
+
+def bench(number: int) -> None:
+    oidi = OidInterpreter([COMPUTE1, COMPUTE2])
+    req = Request('GET', f'{COMPUTE1.url}/servers', {'X-Scope': SCOPE})
+
+    def eager_get_scope(req):
+        scope_entry = oidi._get_scope_entry(req)
+        scope = scope_entry[0] if scope_entry else False
+        LOG.info(f'Find scope {scope} in request headers')
+        return scope
+
+    results = [('get_scope, eager log', measure(eager_get_scope, req, number)),
+               ('get_scope', measure(oidi.get_scope, req, number)),
+               ('rewrite', measure(oidi.rewrite, req, number))]
+    oidi.metrics = Metrics()
+    results.append(('rewrite+metrics', measure(oidi.rewrite, req, number)))
+
+    for name, latency in results:
+        print(f'{name:>20} | {latency * 1e6:6.2f} µs')
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures the per-hop latency of the ScopeProxy with and without connection
+pooling.
+
+The remote Frontend is a stub backend that waits CONNECT_DELAY_MS before
+serving a new connection, to stand for the TCP (and TLS) setup over a WAN.
+
+Run with
+
+  python benchmarks/bench_pool.py [CONNECT_DELAY_MS]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from oidinterpreter.proxy import get_scope_proxy  # noqa
+from tests.tests_proxy import StubBackend, request, services_json  # noqa
+
+
+NB_REQUESTS = 500
+
+
+class RemoteFrontend(StubBackend):
+    def __init__(self, connect_delay: float):
+        super().__init__('CloudTwo')
+        self.connect_delay = connect_delay
+
+    async def handle(self, reader, writer):
+        await asyncio.sleep(self.connect_delay)
+        await super().handle(reader, writer)
+
+
+async def bench(connect_delay: float) -> None:
+    frontend = RemoteFrontend(connect_delay)
+    await frontend.start()
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(services_json('10.0.2.15:80', '10.0.2.15:80',
+                                frontend.address), f)
+
+    scope = json.dumps({'image': 'CloudTwo'})
+    for name, pool_size in [('no pool', 0), ('pool', 16)]:
+        proxy = get_scope_proxy(services_path, 'CloudOne',
+                                pool_size=pool_size)
+        server = (await proxy.start(['127.0.0.1:0']))[0]
+        port = server.sockets[0].getsockname()[1]
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        latencies = []
+        for i in range(NB_REQUESTS):
+            start = time.perf_counter()
+            await request(reader, writer, 'GET', f'/image/v2/images/{i}',
+                          {'Host': '10.0.0.1:8888', 'X-Scope': scope})
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        server.close()
+        proxy.pools.close()
+
+        latencies.sort()
+        print(f'{name:>8} | p50 {statistics.median(latencies) * 1e3:7.2f} ms'
+              f' | p99 {latencies[int(0.99 * len(latencies))] * 1e3:7.2f} ms'
+              f' | {frontend.connections:>4} upstream connections so far')
+
+    # Let connection handlers see the end of their connections
+    frontend.server.close()
+    await asyncio.sleep(0.1)
+    os.remove(services_path)
+
+
+if __name__ == "__main__":
+    delay_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    print(f'Remote frontend connect delay: {delay_ms} ms')
+    asyncio.run(bench(delay_ms / 1e3))
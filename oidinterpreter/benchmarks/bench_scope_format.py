@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Compares the json and compact formats of the scope sent by the client: the
+bytes of the scope headers on every hop (the `X-Scope` header and the suffix
+of `X-Auth-Token`), and the time to parse the scope without the cache of
+OidInterpreter.
+
+Run with
+
+  python benchmarks/bench_scope_format.py
+"""
+import json
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from oidinterpreter import SCOPE_DELIM, encode_scope, parse_scope  # noqa
+
+
+SERVICE_TYPES = ['compute', 'identity', 'image', 'network', 'placement']
+
+# Scopes of the client of CloudOne, with all its services as with
+# `--os-scope`
+SCOPES = {
+    'default': {},
+    'image on CloudTwo': {'image': 'CloudTwo'},
+    'identity on CloudOne, others on CloudTwo': {
+        s: 'CloudTwo' for s in SERVICE_TYPES if s != 'identity'},
+}
+
+
+def per_call(f, number: int = 20000) -> float:
+    return min(timeit.repeat(f, number=number, repeat=3)) / number
+
+
+def main() -> None:
+    for name, bindings in SCOPES.items():
+        scope = {s: bindings.get(s, 'CloudOne') for s in SERVICE_TYPES}
+        print(name)
+        for fmt, raw_scope in [('json', json.dumps(scope)),
+                               ('compact', encode_scope(scope, 'CloudOne'))]:
+            header_bytes = len(raw_scope) + len(SCOPE_DELIM) + len(raw_scope)
+            t_parse = per_call(lambda: parse_scope(raw_scope))
+            print(f'  {fmt:>8} | {header_bytes:4} B/hop '
+                  f'| parse {t_parse * 1e6:5.2f} us | {raw_scope}')
+
+
+if __name__ == "__main__":
+    main()
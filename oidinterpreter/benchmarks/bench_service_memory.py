@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures the memory per endpoint of the services loaded from json, with
+the former Service (a dataclass with a `__dict__` and its own strings) and
+with the current one (slotted, with shared strings).
+
+Run with
+
+  python benchmarks/bench_service_memory.py [NB_CLOUDS ...]
+"""
+from dataclasses import dataclass
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from bench_url_index import make_services  # noqa
+from oidinterpreter import Service  # noqa
+
+
+@dataclass(frozen=True)
+class DictService:
+    service_type: str
+    cloud: str
+    url: str
+    interface: str = None
+
+
+def load(cls, oss_json: str) -> int:
+    "Bytes held by the services of `oss_json` built with `cls`."
+    gc.collect()
+    tracemalloc.start()
+    services = [cls(service_type=s['Service Type'], cloud=s['Region'],
+                    url=s['URL'], interface=s['Interface'])
+                for s in json.loads(oss_json)]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del services
+    return size
+
+
+def bench(nb_clouds: int) -> None:
+    services = make_services(nb_clouds)
+    oss_json = json.dumps([{'Service Type': s.service_type, 'Region': s.cloud,
+                            'URL': s.url, 'Interface': s.interface}
+                           for s in services])
+    # Services of make_services share their strings with those to measure
+    nb_services = len(services)
+    del services
+    before = load(DictService, oss_json) / nb_services
+    after = load(Service, oss_json) / nb_services
+    print(f'{nb_services:>7} services | dict {before:6.1f} B/endpoint '
+          f'| slotted {after:6.1f} B/endpoint | {before / after:4.2f}x')
+
+
+if __name__ == "__main__":
+    for nb_clouds in [int(n) for n in sys.argv[1:]] or [10, 100, 1000]:
+        bench(nb_clouds)
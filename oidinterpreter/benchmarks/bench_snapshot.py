@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Compares the load of a catalog from json and from a snapshot.
+
+The load is the time to get an OidInterpreter from the file, and the first
+request is the rewrite of one request right after, that builds what the
+snapshot loads on use.
+
+Run with
+
+  python benchmarks/bench_snapshot.py [NB_CLOUDS ...]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from requests import Request  # noqa
+
+from bench_url_index import make_services  # noqa
+from oidinterpreter import OidInterpreter, load_services  # noqa
+from oidinterpreter.snapshot import load_snapshot, write_snapshot  # noqa
+
+
+def load_and_rewrite(load, path: str, req: Request):
+    "Times the load of `path`, then the rewrite of `req`."
+    start = time.perf_counter()
+    oidi = OidInterpreter(load(path))
+    loaded = time.perf_counter()
+    oidi.rewrite(req)
+    return loaded - start, time.perf_counter() - loaded
+
+
+def bench(nb_clouds: int) -> None:
+    services = make_services(nb_clouds)
+    tmp = tempfile.mkdtemp()
+    json_path = os.path.join(tmp, 'services.json')
+    snap_path = os.path.join(tmp, 'services.snap')
+    with open(json_path, 'w') as f:
+        json.dump([{'Service Type': s.service_type, 'Region': s.cloud,
+                    'URL': s.url, 'Interface': s.interface}
+                   for s in services], f)
+    write_snapshot(services, snap_path)
+
+    scope = json.dumps({'compute': f'Cloud{nb_clouds // 2}'})
+    req = Request('GET', f'{services[2].url}/servers', {'X-Scope': scope})
+
+    for name, path, load in [('json', json_path, load_services),
+                             ('snapshot', snap_path, load_snapshot)]:
+        t_load, t_first = map(min, zip(*(
+            load_and_rewrite(load, path, req) for _ in range(5))))
+        print(f'{len(services):>6} services | {name:>8} '
+              f'| {os.path.getsize(path) / 1024:8.1f} KiB '
+              f'| load {t_load * 1e6:9.1f} us '
+              f'| first request {t_first * 1e6:7.1f} us')
+
+    os.remove(json_path)
+    os.remove(snap_path)
+    os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    for nb_clouds in [int(n) for n in sys.argv[1:]] or [10, 100, 1000]:
+        bench(nb_clouds)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Compares lookups of the SQLite provider against the in-memory indexes, and
+the incremental sync of changes against a full load, by catalog size.
+
+A sync reads the changed services only, but copies the indexes of the
+catalog: its cost grows with the number of services, whatever the number
+of changes. The default sizes go from 1k to 20k services.
+
+Run with
+
+  python benchmarks/bench_sql.py [NB_CLOUDS ...]
+"""
+import os
+import sys
+import tempfile
+import time
+import timeit
+from typing import Callable
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from bench_url_index import SERVICE_TYPES, make_services  # noqa
+from oidinterpreter import Catalog, Service  # noqa
+from oidinterpreter.sql import SqlCatalog, SqlProvider  # noqa
+
+
+# About 1k, 10k and 20k services
+SERVICES_PER_CLOUD = sum(len(interfaces) for _, interfaces, _ in SERVICE_TYPES)
+CLOUDS = [n // SERVICES_PER_CLOUD for n in [1000, 10000, 20000]]
+NB_CHANGES = [1, 10, 100]
+ROUNDS = 5
+
+
+def per_call(f, number: int = 2000) -> float:
+    return min(timeit.repeat(f, number=number, repeat=3)) / number
+
+
+def best_of(f: Callable[[], None], setup: Callable[[], None]) -> float:
+    "Best time of `f` on ROUNDS rounds, each one after `setup`."
+    times = []
+    for _ in range(ROUNDS):
+        setup()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench(nb_clouds: int) -> None:
+    services = make_services(nb_clouds)
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'services.db')
+    provider = SqlProvider(path)
+    ids = provider.add(services)
+    catalog = Catalog(services)
+
+    url = f'{services[-5].url}/v2/images?limit=20'
+    s = services[len(services) // 2]
+    print(f'{len(services)} services')
+    for name, sql, memory in [
+            ('url lookup',
+             lambda: provider.lookup_url(url),
+             lambda: catalog.url_index.lookup(url)),
+            ('endpoint lookup',
+             lambda: provider.lookup_endpoint(s.service_type, s.interface,
+                                              s.cloud),
+             lambda: catalog.lookup_endpoint(s.service_type, s.interface,
+                                             s.cloud))]:
+        print(f'  {name:>16} | sql {per_call(sql) * 1e6:8.2f} us '
+              f'| in-memory {per_call(memory) * 1e6:6.2f} us')
+
+    t_load = best_of(lambda: SqlCatalog.load(provider), lambda: None)
+    last = SqlCatalog.load(provider)
+    moves = 0
+
+    def move(nb_changes: int) -> None:
+        # Moves `nb_changes` services spread over the catalog, on a
+        # catalog that is up to date
+        nonlocal last, moves
+        last = last.sync(provider)
+        moves += 1
+        step = len(ids) // nb_changes
+        for i in range(0, step * nb_changes, step):
+            old = services[i]
+            provider.update(ids[i], Service(
+                service_type=old.service_type, cloud=old.cloud,
+                url=f'{old.url}/moved{moves}', interface=old.interface))
+
+    for nb_changes in NB_CHANGES:
+        t_sync = best_of(lambda: last.sync(provider),
+                         lambda: move(nb_changes))
+        print(f'  {nb_changes:>6} change(s) | full load '
+              f'{t_load * 1e3:8.2f} ms | sync {t_sync * 1e3:6.2f} ms '
+              f'({t_sync / t_load:5.1%})')
+
+    provider.close()
+    os.remove(path)
+    os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    for nb_clouds in [int(n) for n in sys.argv[1:]] or CLOUDS:
+        bench(nb_clouds)
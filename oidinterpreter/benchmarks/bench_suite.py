@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Performance baseline of the OidInterpreter and the ScopeProxy.
+
+Generates synthetic catalogs in the `SERVICES` format, from 2 to hundreds
+of clouds, and a mix of requests and scopes drawn with a fixed seed:
+
+  - 50% with a compact scope in X-Auth-Token,
+  - 20% with a complete json scope in X-Scope,
+  - 15% to a service, without scope,
+  - 15% to a url that is not a service.
+
+Scopes come from a small pool, as one token carries the same scope along a
+workflow. Measures, for each catalog, the throughput of `get_scope`,
+`is_scoped_url`, `interpret` and `iinterpret` (best of ROUNDS runs over the
+mix) and the mean peak of memory they allocate per call. Then load-tests a
+ScopeProxy on stub backends with NB_CLIENTS concurrent connections.
+
+Results are printed, and written as json with `--json`. Compare them with
+the results of another commit with `--compare`, which exits with status 1
+if a benchmark is slower by more than `--threshold`.
+
+Run with
+
+  python benchmarks/bench_suite.py [--clouds 2 10 100 300] [--quick]
+    [--json results.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from requests import Request  # noqa
+
+from bench_url_index import SERVICE_TYPES  # noqa
+from oidinterpreter import (SCOPE_DELIM, OidInterpreter, encode_scope,  # noqa
+                            oss2services)
+from oidinterpreter.proxy import get_scope_proxy  # noqa
+from tests.tests_proxy import StubBackend, request  # noqa
+
+
+SEED = 20191015
+CLOUDS = [2, 10, 100, 300]
+NB_REQUESTS = 2000
+NB_SCOPES = 64
+ROUNDS = 5
+ALLOC_SAMPLE = 200
+NB_CLIENTS = 32
+PROXY_REQUESTS = 2000
+TOKEN = '507582fc-57c6-4bc7-a051-9fb3f269da70'
+
+
+def cloud_name(i: int) -> str:
+    return f'Cloud{i}'
+
+
+def cloud_host(i: int) -> str:
+    return f'10.{i // 250}.{i % 250}.1:8888'
+
+
+def make_catalog(nb_clouds: int) -> List[Dict[str, str]]:
+    """Makes the services of `nb_clouds` Devstack clouds, in the `SERVICES`
+    format."""
+    return [{'Interface': interface, 'Region': cloud_name(i),
+             'Service Type': service_type,
+             'URL': (f'http://{cloud_host(i)[:-5]}{path}' if path[0] == ':'
+                     else f'http://{cloud_host(i)}{path}')}
+            for i in range(nb_clouds)
+            for service_type, interfaces, path in SERVICE_TYPES
+            for interface in interfaces]
+
+
+def make_scopes(rng: random.Random, nb_clouds: int) -> List[Dict[str, str]]:
+    """Draws NB_SCOPES scopes that bind every service type to a home cloud,
+    but for 1 to 3 of them bound to other clouds."""
+    service_types = [t for t, _, _ in SERVICE_TYPES]
+    scopes = []
+    for _ in range(NB_SCOPES):
+        home = cloud_name(rng.randrange(nb_clouds))
+        scope = {t: home for t in service_types}
+        for t in rng.sample(service_types, rng.randint(1, 3)):
+            scope[t] = cloud_name(rng.randrange(nb_clouds))
+        scopes.append(scope)
+    return scopes
+
+
+def make_requests(rng: random.Random, catalog: List[Dict[str, str]],
+                  nb_clouds: int, nb: int = NB_REQUESTS) -> List[Request]:
+    """Draws the mix of requests described in the module docstring."""
+    scopes = make_scopes(rng, nb_clouds)
+    reqs = []
+    for _ in range(nb):
+        service = rng.choice(catalog)
+        url = f'{service["URL"]}/v{rng.randrange(3)}/res/{rng.randrange(99)}'
+        scope = rng.choice(scopes)
+        draw = rng.random()
+        if draw < 0.5:
+            raw_scope = encode_scope(scope, max(
+                scope.values(), key=list(scope.values()).count))
+            headers = {'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}{raw_scope}'}
+        elif draw < 0.7:
+            headers = {'X-Auth-Token': TOKEN, 'X-Scope': json.dumps(scope)}
+        elif draw < 0.85:
+            headers = {'X-Auth-Token': TOKEN}
+        else:
+            url = f'https://www.example{rng.randrange(9)}.org/search'
+            headers = {'X-Auth-Token': TOKEN}
+        reqs.append(Request('GET', url, headers))
+    return reqs
+
+
+def fresh(reqs: List[Request]) -> List[Request]:
+    "Copies `reqs` with their own headers, for functions that update them."
+    copies = []
+    for req in reqs:
+        req2 = copy.copy(req)
+        req2.headers = dict(req.headers)
+        copies.append(req2)
+    return copies
+
+
+def throughput(f: Callable[[Request], object], reqs: List[Request],
+               rounds: int, mutates: bool = False) -> float:
+    "Calls of `f` per second over `reqs`, best of `rounds`."
+    best = float('inf')
+    for _ in range(rounds):
+        batch = fresh(reqs) if mutates else reqs
+        start = time.perf_counter()
+        for req in batch:
+            f(req)
+        best = min(best, time.perf_counter() - start)
+    return len(reqs) / best
+
+
+def allocated(f: Callable[[Request], object], reqs: List[Request],
+              mutates: bool = False) -> float:
+    "Mean peak of bytes allocated by one call of `f` on `reqs`."
+    peaks = []
+    for req in (fresh(reqs) if mutates else reqs):
+        tracemalloc.start()
+        f(req)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return statistics.mean(peaks)
+
+
+def bench_interpreter(nb_clouds: int, rounds: int, nb_requests: int
+                      ) -> List[Dict]:
+    rng = random.Random(SEED + nb_clouds)
+    catalog = make_catalog(nb_clouds)
+    oidi = OidInterpreter(oss2services(catalog))
+    reqs = make_requests(rng, catalog, nb_clouds, nb_requests)
+
+    results = []
+    for name, f, mutates in [('get_scope', oidi.get_scope, False),
+                             ('is_scoped_url', oidi.is_scoped_url, False),
+                             ('interpret', oidi.interpret, True),
+                             ('iinterpret', oidi.iinterpret, False)]:
+        results.append({
+            'name': name, 'clouds': nb_clouds, 'services': len(catalog),
+            'ops_per_sec': throughput(f, reqs, rounds, mutates),
+            'alloc_bytes': allocated(f, reqs[:ALLOC_SAMPLE], mutates)})
+    return results
+
+
+async def client(port: int, reqs: List[Request], latencies: List[float]
+                 ) -> None:
+    "Sends `reqs` on one connection."
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for req in reqs:
+        _, host, path = req.url.split('/', 3)[1:]
+        headers = dict(req.headers, Host=host)
+        start = time.perf_counter()
+        await request(reader, writer, req.method, f'/{path}', headers)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def bench_proxy(nb_clouds: int, nb_requests: int) -> Dict:
+    """Load-tests a ScopeProxy of the first cloud of a catalog.
+
+    Every Backend and Frontend is a stub, so that the proxy is what is
+    measured. Requests that do not target a service are left aside.
+
+    """
+    rng = random.Random(SEED + nb_clouds)
+    catalog = make_catalog(nb_clouds)
+    backend = StubBackend('Backend')
+    await backend.start()
+    services = [dict(s, URL=s['URL'].split('://', 1)[1],
+                     Frontend=backend.address, Backend=backend.address)
+                for s in catalog]
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'services': services}, f)
+
+    proxy = get_scope_proxy(services_path, cloud_name(0))
+    server = (await proxy.start(['127.0.0.1:0']))[0]
+    port = server.sockets[0].getsockname()[1]
+    reqs = [req for req in make_requests(rng, catalog, nb_clouds,
+                                         nb_requests)
+            if 'example' not in req.url]
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, reqs[i::NB_CLIENTS], latencies)
+                           for i in range(NB_CLIENTS)))
+    duration = time.perf_counter() - start
+
+    server.close()
+    proxy.pools.close()
+    backend.server.close()
+    await asyncio.sleep(0.1)
+    os.remove(services_path)
+
+    latencies.sort()
+    return {'name': 'proxy', 'clouds': nb_clouds, 'services': len(catalog),
+            'ops_per_sec': len(latencies) / duration,
+            'p50_ms': latencies[len(latencies) // 2] * 1e3,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1e3}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe(result: Dict) -> str:
+    line = (f'{result["name"]:>14} | {result["clouds"]:>4} clouds '
+            f'| {result["ops_per_sec"]:>10,.0f} ops/s')
+    if 'alloc_bytes' in result:
+        line += f' | {result["alloc_bytes"]:>8,.0f} B/call'
+    if 'p50_ms' in result:
+        line += (f' | p50 {result["p50_ms"]:6.2f} ms '
+                 f'| p99 {result["p99_ms"]:6.2f} ms')
+    return line
+
+
+def compare(baseline: Dict, results: List[Dict], threshold: float) -> bool:
+    """Prints the speedup of `results` over `baseline`.
+
+    Returns False if a benchmark is slower by more than `threshold`.
+
+    """
+    base = {(r['name'], r['clouds']): r for r in baseline['results']}
+    print(f'\nCompared to {baseline["meta"].get("commit") or "baseline"}')
+    ok = True
+    for result in results:
+        before = base.get((result['name'], result['clouds']))
+        if before is None:
+            continue
+        ratio = result['ops_per_sec'] / before['ops_per_sec']
+        slower = ratio < 1 - threshold
+        ok = ok and not slower
+        print(f'{result["name"]:>14} | {result["clouds"]:>4} clouds '
+              f'| x{ratio:5.2f}{"  SLOWER" if slower else ""}')
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Performance baseline of the OidInterpreter and the '
+                    'ScopeProxy.')
+    parser.add_argument('--clouds', type=int, nargs='+', default=CLOUDS,
+                        help='Sizes of catalogs (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true',
+                        help='Fewer requests and rounds, for a smoke test')
+    parser.add_argument('--no-proxy', action='store_true',
+                        help='Skip the load test of the proxy')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as json to PATH')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='Compare with results written by --json')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown tolerated by --compare '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    rounds = 1 if args.quick else ROUNDS
+    nb_requests = NB_REQUESTS // 10 if args.quick else NB_REQUESTS
+    results = []
+    for nb_clouds in args.clouds:
+        for result in bench_interpreter(nb_clouds, rounds, nb_requests):
+            print(describe(result))
+            results.append(result)
+    if not args.no_proxy:
+        for nb_clouds in (min(args.clouds), max(args.clouds)):
+            result = asyncio.run(bench_proxy(
+                nb_clouds, PROXY_REQUESTS // 10 if args.quick
+                else PROXY_REQUESTS))
+            print(describe(result))
+            results.append(result)
+
+    report = {'meta': {'commit': git_commit(), 'date': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(), 'seed': SEED,
+                       'requests': nb_requests, 'rounds': rounds},
+              'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(json.load(f), results, args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures validations of tokens through the ScopeProxy with a local Keystone,
+a remote one, and a remote one behind the TokenCache.
+
+The remote Keystone is a stub that answers after RTT_MS to stand for the
+WAN. Each service validates the tokens of the API calls it gets, as the
+keystone middleware does.
+
+Run with
+
+  python benchmarks/bench_token_cache.py [RTT_MS]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from oidinterpreter.proxy import get_scope_proxy  # noqa
+from oidinterpreter.tokens import TokenCache  # noqa
+from tests.tests_proxy import StubBackend, request, services_json  # noqa
+
+
+NB_SERVICES = 4
+NB_USERS = 10
+CALLS_PER_SERVICE = 50
+
+
+class RemoteKeystone(StubBackend):
+    def __init__(self, rtt: float):
+        super().__init__('CloudTwo')
+        self.rtt = rtt
+
+    async def respond(self, *args):
+        await asyncio.sleep(self.rtt)
+        await super().respond(*args)
+
+
+async def service(port: int, identity: str, nb: int) -> list:
+    "Validations of one service, on its own connection."
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    latencies = []
+    for call in range(CALLS_PER_SERVICE):
+        start = time.perf_counter()
+        await request(reader, writer, 'GET', '/identity/v3/auth/tokens', {
+            'Host': '10.0.0.1:8888', 'X-Auth-Token': f'service-{nb}',
+            'X-Subject-Token': f'user-{call % NB_USERS}',
+            'X-Scope': f'1:CloudOne;identity={identity}'})
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    return latencies
+
+
+async def bench(rtt: float) -> None:
+    local, remote = StubBackend('CloudOne'), RemoteKeystone(rtt)
+    await local.start()
+    await remote.start()
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(services_json(local.address, remote.address,
+                                remote.address), f)
+
+    for name, identity, tokens in [
+            ('local', 'CloudOne', None),
+            ('remote', 'CloudTwo', None),
+            ('remote+cache', 'CloudTwo', TokenCache())]:
+        proxy = get_scope_proxy(services_path, 'CloudOne', tokens=tokens)
+        server = (await proxy.start(['127.0.0.1:0']))[0]
+        port = server.sockets[0].getsockname()[1]
+        remote.requests.clear()
+
+        latencies = sum(await asyncio.gather(*(
+            service(port, identity, nb) for nb in range(NB_SERVICES))), [])
+        server.close()
+        proxy.pools.close()
+
+        print(f'{name:>12} | mean {statistics.mean(latencies) * 1e3:6.2f} ms '
+              f'| p50 {statistics.median(latencies) * 1e3:6.2f} ms '
+              f'| {len(remote.requests):>4} WAN requests')
+
+    local.server.close()
+    remote.server.close()
+    await asyncio.sleep(0.1)
+    os.remove(services_path)
+
+
+if __name__ == "__main__":
+    rtt_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+    print(f'{NB_SERVICES} services x {CALLS_PER_SERVICE} validations of '
+          f'{NB_USERS} tokens, WAN rtt {rtt_ms} ms')
+    asyncio.run(bench(rtt_ms / 1e3))
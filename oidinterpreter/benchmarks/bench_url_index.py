@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Compares `UrlIndex` against the linear scan of `lookup_service`.
+
+Run with
+
+  python benchmarks/bench_url_index.py [NB_CLOUDS ...]
+"""
+import sys
+import timeit
+from typing import List
+
+from oidinterpreter import Service, UrlIndex, get_oidinterpreter_from_services
+
+
+# Service types, interfaces and url paths of a Devstack cloud
+SERVICE_TYPES = [('identity', ['admin', 'public'], '/identity'),
+                 ('compute', ['public', 'internal'], '/compute/v2.1'),
+                 ('compute_legacy', ['public'], '/compute/v2/'),
+                 ('placement', ['public'], '/placement'),
+                 ('image', ['public', 'internal'], '/image'),
+                 ('volume', ['public'], '/volume/v3'),
+                 ('network', ['public', 'internal', 'admin'], ':9797')]
+
+
+def make_services(nb_clouds: int) -> List[Service]:
+    services = []
+    for c in range(nb_clouds):
+        host = f'http://10.{c // 256}.{c % 256}.245'
+        for service_type, interfaces, path in SERVICE_TYPES:
+            for interface in interfaces:
+                url = (f'{host}{path}' if path.startswith(':')
+                       else f'{host}:8888{path}')
+                services.append(Service(service_type=service_type,
+                                        cloud=f'Cloud{c}', url=url,
+                                        interface=interface))
+    return services
+
+
+def bench(nb_clouds: int, number: int = 20000) -> None:
+    services = make_services(nb_clouds)
+    oidi = get_oidinterpreter_from_services(services)
+    index = UrlIndex(services)
+
+    # Worst case for the linear scan: the last cloud of the list
+    url = f'{services[-5].url}/v2/images?limit=20'
+
+    def linear():
+        oidi.lookup_service(lambda s: url.startswith(s.url))
+
+    def indexed():
+        index.lookup(url)
+
+    t_linear = min(timeit.repeat(linear, number=number, repeat=3))
+    t_indexed = min(timeit.repeat(indexed, number=number, repeat=3))
+    print(f'{nb_clouds:>5} clouds {len(services):>6} services | '
+          f'linear {t_linear / number * 1e6:8.2f} µs | '
+          f'indexed {t_indexed / number * 1e6:6.2f} µs | '
+          f'x{t_linear / t_indexed:.0f}')
+
+
+if __name__ == "__main__":
+    for nb_clouds in [int(n) for n in sys.argv[1:]] or [2, 10, 50, 200]:
+        bench(nb_clouds)
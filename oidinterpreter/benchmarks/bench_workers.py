@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures the throughput of the ScopeProxy with 1 to N worker processes.
+
+A stub backend and a load generator run in their own processes on the same
+host. Each client keeps its connection alive and sends GET requests for
+DURATION seconds.
+
+Run with
+
+  python benchmarks/bench_workers.py [NB_WORKERS ...]
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from tests.tests_proxy import StubBackend, request, services_json  # noqa
+from tests.tests_workers import free_port, wait_port  # noqa
+
+
+DURATION = 5.0
+NB_CLIENTS = 64
+
+
+def run_backend(port_queue) -> None:
+    async def backend():
+        stub = StubBackend('CloudOne')
+        port_queue.put(await stub.start())
+        await stub.server.serve_forever()
+    asyncio.run(backend())
+
+
+def run_clients(port: int, nb_clients: int, results) -> None:
+    async def client(deadline):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        count = 0
+        while time.monotonic() < deadline:
+            await request(reader, writer, 'GET', '/compute/v2.1/servers',
+                          {'Host': '10.0.0.1:8888'})
+            count += 1
+        writer.close()
+        return count
+
+    async def clients():
+        deadline = time.monotonic() + DURATION
+        return sum(await asyncio.gather(
+            *(client(deadline) for _ in range(nb_clients))))
+
+    results.put(asyncio.run(clients()))
+
+
+def bench(nb_workers: int, backend_address: str, services_path: str) -> None:
+    port = free_port()
+    proxy = subprocess.Popen(
+        [sys.executable, '-m', 'oidinterpreter.proxy',
+         '--services', services_path, '--cloud', 'CloudOne',
+         '--bind', f'127.0.0.1:{port}', '--workers', str(nb_workers)],
+        cwd=os.path.dirname(HERE))
+    try:
+        wait_port(port)
+        nb_generators = max(1, min(nb_workers, os.cpu_count() // 2))
+        results = multiprocessing.Queue()
+        generators = [multiprocessing.Process(
+            target=run_clients,
+            args=(port, NB_CLIENTS // nb_generators, results))
+            for _ in range(nb_generators)]
+        for g in generators:
+            g.start()
+        total = sum(results.get() for _ in generators)
+        for g in generators:
+            g.join()
+        print(f'{nb_workers:>3} workers | {total / DURATION:10.0f} req/s')
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+
+if __name__ == "__main__":
+    port_queue = multiprocessing.Queue()
+    backend = multiprocessing.Process(target=run_backend, args=(port_queue,),
+                                      daemon=True)
+    backend.start()
+    backend_address = port_queue.get()
+
+    fd, services_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(services_json(backend_address, '10.0.2.15:80',
+                                '10.0.0.2:8888'), f)
+
+    print(f'{os.cpu_count()} cpus, the backend and load generators share '
+          f'them with the proxy')
+    try:
+        for nb_workers in ([int(n) for n in sys.argv[1:]] or
+                           [1, 2, max(2, os.cpu_count() // 2)]):
+            bench(nb_workers, backend_address, services_path)
+    finally:
+        os.remove(services_path)
+        backend.terminate()
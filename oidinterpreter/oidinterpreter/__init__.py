@@ -12,9 +12,14 @@ import logging
 
 
 # Expose OidInterpreter
-from .oidinterpreter import (Service, OidInterpreter, get_oidinterpreter,
-                             get_oidinterpreter_from_services,
-                             oss2services, SCOPE_DELIM)
+from .oidinterpreter import (Service, OidInterpreter, Rewrite, RewritePlan,
+                             UrlIndex, Catalog, ReloadStats, ServicesWatcher,
+                             canonical_uri, encode_scope, get_oidinterpreter,
+                             get_oidinterpreter_from_services, load_services,
+                             oss2services, parse_scope, SCOPE_DELIM)
+from .balancer import Balancer, EndpointStats
+from .breaker import Circuit, CircuitBreaker, CloudUnavailable
+from .metrics import Histogram, Metrics, serve_metrics
 
 
 __version__ = '0.0.1'
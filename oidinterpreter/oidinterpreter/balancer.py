@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Choice among the endpoints of a service in a cloud
+
+A cloud may expose several endpoints for one (service type, interface),
+e.g., two Glance APIs behind their own frontends. The interpreter then
+gets a RewritePlan per endpoint, and an OidInterpreter with a `balancer`
+picks the one with the best score: its EWMA of latency multiplied by its
+number of requests in flight, so that a hot endpoint gets less traffic.
+
+Health follows the checks of HAProxy (`check inter 2000 rise 2 fall 5`): an
+endpoint is down after `fall` failures in a row, and gets no more traffic
+but one request every `inter` seconds to probe it. It is up again after
+`rise` successes in a row. Whoever forwards the requests reports them with
+`started` and `finished`, as the ScopeProxy does.
+"""
+from dataclasses import dataclass
+import time
+from typing import TYPE_CHECKING, Dict
+
+if TYPE_CHECKING:
+    from .oidinterpreter import Service
+
+
+EWMA_ALPHA = 0.3
+INTER = 2.0
+RISE = 2
+FALL = 5
+
+# Latency of an endpoint not measured yet, so that it gets tried
+_LATENCY_FLOOR = 1e-3
+
+
+@dataclass
+class EndpointStats:
+    """Counters and health of an endpoint.
+
+    `ewma` is the moving average of the latency in seconds, `inflight` the
+    number of requests not finished yet, and `streak` the number of
+    successes (positive) or failures (negative) in a row.
+
+    """
+    requests: int = 0
+    failures: int = 0
+    inflight: int = 0
+    ewma: float = 0.0
+    healthy: bool = True
+    streak: int = 0
+    next_probe: float = 0.0
+
+
+class Balancer:
+    """Scores endpoints by latency, load and health (see module doc).
+
+    The Balancer is not locked: concurrent threads may skew the counters a
+    little, which only affects the choice of the next endpoints.
+
+    """
+
+    def __init__(self, alpha: float = EWMA_ALPHA, inter: float = INTER,
+                 rise: int = RISE, fall: int = FALL):
+        self.alpha = alpha
+        self.inter = inter
+        self.rise = rise
+        self.fall = fall
+        self._stats: Dict['Service', EndpointStats] = {}
+
+    def _get(self, service: 'Service') -> EndpointStats:
+        stats = self._stats.get(service)
+        if stats is None:
+            stats = self._stats[service] = EndpointStats()
+        return stats
+
+    def score(self, service: 'Service') -> float:
+        """Scores `service`, the lower the better.
+
+        A down endpoint scores infinity, but when it is due for a probe.
+
+        """
+        stats = self._stats.get(service)
+        if stats is None:
+            return 0.0
+        if not stats.healthy:
+            return (0.0 if stats.next_probe <= time.monotonic()
+                    else float('inf'))
+        return max(stats.ewma, _LATENCY_FLOOR) * (stats.inflight + 1)
+
+    def started(self, service: 'Service') -> None:
+        "Reports a request sent to `service`."
+        stats = self._get(service)
+        stats.inflight += 1
+        stats.requests += 1
+        if not stats.healthy:
+            stats.next_probe = time.monotonic() + self.inter
+
+    def finished(self, service: 'Service', latency: float,
+                 ok: bool) -> None:
+        """Reports the end of a request to `service`, that took `latency`
+        seconds and failed unless `ok`.
+
+        A failure counts at least twice the average latency, so that an
+        endpoint that fails fast does not look fast.
+
+        """
+        stats = self._get(service)
+        stats.inflight = max(0, stats.inflight - 1)
+        if not ok:
+            latency = max(latency, 2 * stats.ewma)
+        stats.ewma = (latency if not stats.ewma else
+                      self.alpha * latency + (1 - self.alpha) * stats.ewma)
+
+        if ok:
+            stats.streak = max(stats.streak, 0) + 1
+            if not stats.healthy and stats.streak >= self.rise:
+                stats.healthy = True
+        else:
+            stats.failures += 1
+            stats.streak = min(stats.streak, 0) - 1
+            if stats.healthy and -stats.streak >= self.fall:
+                stats.healthy = False
+                stats.next_probe = time.monotonic() + self.inter
+
+    def stats(self) -> Dict['Service', EndpointStats]:
+        """Gets the stats of the endpoints seen so far."""
+        return dict(self._stats)
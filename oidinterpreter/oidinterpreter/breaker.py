@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Circuit breaker per target cloud
+
+Without it, each request scoped to a cloud whose frontend is down waits for
+the connect timeout (10 seconds in `haproxy.cfg.j2`, with 3 retries), and
+a workflow that hops through that cloud waits as many times. An
+OidInterpreter with a `breaker` checks the cloud targeted by each rewrite:
+
+- closed: requests go through. After `failures` failures in a row, the
+  circuit opens.
+- open: requests fail fast with CloudUnavailable, for `reset_timeout`
+  seconds. The circuit is then half-open.
+- half-open: one request goes through to probe the cloud, the others fail
+  fast. The circuit closes if the probe succeeds and opens again if it
+  fails. A probe never reported lets another one go after `reset_timeout`.
+
+Circuits are per cloud, so a dead cloud does not slow down the scopes that
+do not target it. Whoever forwards the requests reports them with
+`finished`, as the ScopeProxy does.
+"""
+from dataclasses import dataclass, replace
+import logging
+import threading
+import time
+from typing import Dict
+
+
+LOG = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+FAILURES = 5
+RESET_TIMEOUT = 5.0
+
+
+class CloudUnavailable(Exception):
+    """The circuit of `cloud` is open, retry in `retry_after` seconds."""
+
+    def __init__(self, cloud: str, retry_after: float):
+        super().__init__(f'{cloud} is unavailable, retry in '
+                         f'{retry_after:.1f}s')
+        self.cloud = cloud
+        self.retry_after = retry_after
+
+
+@dataclass
+class Circuit:
+    """State of the circuit of a cloud.
+
+    `failures` counts the failures in a row, `retry_at` is when the next
+    probe may go (`time.monotonic`), `trips` the number of times the circuit
+    opened and `rejected` the number of requests failed fast.
+
+    """
+    state: str = CLOSED
+    failures: int = 0
+    retry_at: float = 0.0
+    trips: int = 0
+    rejected: int = 0
+
+
+class CircuitBreaker:
+    """Circuits of the target clouds (see module doc)."""
+
+    def __init__(self, failures: int = FAILURES,
+                 reset_timeout: float = RESET_TIMEOUT):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._circuits: Dict[str, Circuit] = {}
+        self._lock = threading.Lock()
+
+    def check(self, cloud: str) -> None:
+        """Lets a request to `cloud` go, or raises CloudUnavailable."""
+        circuit = self._circuits.get(cloud)
+        if circuit is None or circuit.state == CLOSED:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            if circuit.state != CLOSED and circuit.retry_at <= now:
+                # Probe the cloud, and hold the other requests meanwhile
+                circuit.state = HALF_OPEN
+                circuit.retry_at = now + self.reset_timeout
+                return
+            if circuit.state == CLOSED:
+                return
+            circuit.rejected += 1
+            raise CloudUnavailable(cloud, circuit.retry_at - now)
+
+    def finished(self, cloud: str, ok: bool) -> None:
+        """Reports the end of a request to `cloud`, that failed unless
+        `ok`."""
+        circuit = self._circuits.get(cloud)
+        if ok and (circuit is None or (circuit.state == CLOSED
+                                       and not circuit.failures)):
+            return
+
+        with self._lock:
+            if circuit is None:
+                circuit = self._circuits.setdefault(cloud, Circuit())
+            if ok:
+                if circuit.state != CLOSED:
+                    LOG.warning('Circuit of %s is closed', cloud)
+                circuit.state = CLOSED
+                circuit.failures = 0
+                return
+
+            circuit.failures += 1
+            if (circuit.state == HALF_OPEN
+                    or (circuit.state == CLOSED
+                        and circuit.failures >= self.failures)):
+                circuit.state = OPEN
+                circuit.retry_at = time.monotonic() + self.reset_timeout
+                circuit.trips += 1
+                LOG.warning('Circuit of %s is open after %d failures',
+                            cloud, circuit.failures)
+
+    def state(self, cloud: str) -> str:
+        """Gets the state of the circuit of `cloud`.
+
+        An open circuit whose `reset_timeout` is over reads half-open.
+
+        """
+        circuit = self._circuits.get(cloud)
+        if circuit is None:
+            return CLOSED
+        if circuit.state == OPEN and circuit.retry_at <= time.monotonic():
+            return HALF_OPEN
+        return circuit.state
+
+    def stats(self) -> Dict[str, Circuit]:
+        """Gets a copy of the circuits of the clouds seen so far."""
+        with self._lock:
+            return {cloud: replace(circuit)
+                    for cloud, circuit in self._circuits.items()}
+
+    def reset(self) -> None:
+        """Closes all circuits."""
+        with self._lock:
+            self._circuits.clear()
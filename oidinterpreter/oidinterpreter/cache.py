@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Short-lived cache of responses of the ScopeProxy
+
+Cross-cloud workflows read the same remote resources again and again, e.g.,
+Nova of CloudOne gets the same image from the Glance of CloudTwo for every
+VM of a batch. The ResponseCache keeps such responses for a few seconds, so
+that the proxy answers them without a WAN round trip.
+
+Only responses to GET without body are cached, and only for the
+`service_types` of the cache. They are keyed by the targeted cloud, the url
+and the token, so a response is only served to the project it was made for.
+`Cache-Control` is honoured on both sides: `no-store` and `no-cache` keep a
+response out of the cache, `max-age` shortens its lifetime, and a request
+with `no-cache` or `max-age=0` is always forwarded. A response with a `Vary`
+header is only served to requests with the same varying headers.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import time
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+CACHE_TTL = 5.0
+CACHE_SIZE = 1024
+CACHE_MAX_BODY_SIZE = 256 * 1024
+
+
+@dataclass
+class CacheStats:
+    """Counters of a ResponseCache."""
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        "Ratio of lookups answered from the cache."
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+@dataclass
+class CachedResponse:
+    """A response of the cache, with the request headers it varies on."""
+    status_line: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+    expires: float
+    vary: Dict[str, Optional[str]] = field(default_factory=dict)
+    stored: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> int:
+        "Seconds since the response has been stored, as in `Age`."
+        return int(time.monotonic() - self.stored)
+
+
+def cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """Parses a `Cache-Control` header into its directives."""
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, arg = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def _max_age(directives: Dict[str, Optional[str]]) -> Optional[float]:
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return max(0.0, float(directives[name] or ''))
+            except ValueError:
+                return 0.0
+    return None
+
+
+class ResponseCache:
+    """LRU cache of at most `size` responses, each kept `ttl` seconds.
+
+    Only responses of `service_types` are cached, with a body of at most
+    `max_body_size` bytes. The cache is not thread-safe: it belongs to the
+    event loop of one proxy.
+
+    """
+
+    def __init__(self, service_types: Iterable[str], ttl: float = CACHE_TTL,
+                 size: int = CACHE_SIZE,
+                 max_body_size: int = CACHE_MAX_BODY_SIZE):
+        self.service_types = frozenset(service_types)
+        self.ttl = ttl
+        self.size = size
+        self.max_body_size = max_body_size
+        self.stats = CacheStats()
+        self._entries: 'OrderedDict[Hashable, CachedResponse]' = \
+            OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: Hashable, headers) -> Optional[CachedResponse]:
+        """Gets the fresh response of `key` for a request with `headers`.
+
+        Returns None, and counts a miss, if there is none or if the request
+        asks to bypass the cache.
+
+        """
+        request_cc = cache_control(headers.get('Cache-Control'))
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= time.monotonic():
+            del self._entries[key]
+            self.stats.expirations += 1
+            entry = None
+
+        if (entry is None or 'no-cache' in request_cc or
+                _max_age(request_cc) == 0 or
+                'no-cache' in headers.get('Pragma', '').lower() or
+                any(headers.get(name) != value
+                    for name, value in entry.vary.items())):
+            self.stats.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry
+
+    def ttl_of(self, request_headers, response_headers) -> float:
+        """Seconds the response with `response_headers` may be cached.
+
+        Returns 0 if it must not be cached.
+
+        """
+        request_cc = cache_control(request_headers.get('Cache-Control'))
+        response_cc = cache_control(response_headers.get('Cache-Control'))
+        if ('no-store' in request_cc or 'no-store' in response_cc or
+                'no-cache' in response_cc or
+                'set-cookie' in response_headers or
+                response_headers.get('Vary', '').strip() == '*'):
+            return 0.0
+
+        max_age = _max_age(response_cc)
+        return self.ttl if max_age is None else min(self.ttl, max_age)
+
+    def store(self, key: Hashable, status_line: str,
+              header_list: List[Tuple[str, str]], body: bytes, ttl: float,
+              request_headers) -> None:
+        """Keeps the response of `key` for `ttl` seconds.
+
+        The request headers listed in the `Vary` header of the response are
+        saved with it.
+
+        """
+        vary = {}
+        for name, value in header_list:
+            if name.lower() == 'vary':
+                for varying in value.split(','):
+                    varying = varying.strip()
+                    if varying:
+                        vary[varying] = request_headers.get(varying)
+
+        self._entries[key] = CachedResponse(
+            status_line=status_line, headers=header_list, body=body,
+            expires=time.monotonic() + ttl, vary=vary)
+        self._entries.move_to_end(key)
+        self.stats.stores += 1
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def invalidate(self, cloud: str, service_type: str) -> None:
+        """Drops the responses of `service_type` in `cloud`.
+
+        Keys are expected to start with (cloud, service_type).
+
+        """
+        stale = [key for key in self._entries
+                 if key[:2] == (cloud, service_type)]
+        for key in stale:
+            del self._entries[key]
+        self.stats.invalidations += len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Precompiled routing maps for HAProxy
+
+`interpret_scope.lua` scans the services of `services.json` on each request.
+The maps below compile them once for `interpret_scope_maps.lua`, which
+loads them at start and then only does lookups per request:
+
+- services.map: url of a service -> `<service type> <interface>`, for
+  `Map._beg` (longest prefix). Urls are shared by several services (e.g.,
+  admin and public identity), the first one of the catalog wins, as with
+  `UrlIndex`. Lines are sorted by decreasing url length, so that a
+  first-match reader also gets the longest prefix.
+- identities.map: cloud -> url of its admin identity service.
+
+The backend of a request is then `<cloud>_<service type>_<interface>`, as
+named in `haproxy.cfg.j2`, with the cloud the scope binds to the service
+type. Generate the maps with
+
+  python -m oidinterpreter.haproxy /etc/haproxy/services.json \\
+    /etc/haproxy/maps
+"""
+import argparse
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .oidinterpreter import Catalog, Service, load_services
+
+
+SERVICES_MAP = 'services.map'
+IDENTITIES_MAP = 'identities.map'
+
+# Keys and values of maps are split on blanks
+_BLANK_RE = re.compile(r'\s')
+
+
+def _check(*words: Optional[str]) -> None:
+    for word in words:
+        if not word or _BLANK_RE.search(word):
+            raise ValueError(f'{word!r} cannot go in a map')
+
+
+def services_map(catalog: Catalog) -> List[Tuple[str, str]]:
+    """Lists the (url, `<service type> <interface>`) of the services of
+    `catalog`, one per url, longest url first.
+
+    Raises `ValueError` if a url, a service type or an interface is empty
+    or has blanks.
+
+    """
+    entries = []
+    for s in catalog.url_index.services():
+        _check(s.url, s.service_type, s.interface)
+        entries.append((s.url, f'{s.service_type} {s.interface}'))
+    return sorted(entries, key=lambda entry: -len(entry[0]))
+
+
+def identities_map(catalog: Catalog) -> List[Tuple[str, str]]:
+    """Lists the (cloud, url of its admin identity) of `catalog`."""
+    entries = []
+    for cloud, s in catalog.identities.items():
+        _check(cloud, s.url)
+        entries.append((cloud, s.url))
+    return entries
+
+
+def dump_map(entries: List[Tuple[str, str]]) -> str:
+    """Serializes `entries` in the format of HAProxy map files."""
+    return ''.join(f'{key} {value}\n' for key, value in entries)
+
+
+def read_map(path: str) -> List[Tuple[str, str]]:
+    """Reads the (key, value) entries of the map file at `path`.
+
+    Skips blank lines and comments, as HAProxy does.
+
+    """
+    entries = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                key, *value = line.split(None, 1)
+                entries.append((key, value[0] if value else ''))
+    return entries
+
+
+def write_maps(services: List[Service], directory: str) -> Dict[str, str]:
+    """Writes the maps of `services` in `directory`.
+
+    Each map is replaced by a rename, so that a reload of HAProxy never
+    reads half a map. Returns the path of each map by name.
+
+    """
+    catalog = Catalog(services)
+    maps = {SERVICES_MAP: services_map(catalog),
+            IDENTITIES_MAP: identities_map(catalog)}
+
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for name, entries in maps.items():
+        path = paths[name] = os.path.join(directory, name)
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            f.write(dump_map(entries))
+        os.replace(tmp_path, path)
+    return paths
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Compiles a list of services into HAProxy maps.')
+    parser.add_argument('services',
+                        help='services.json, or the output of `openstack '
+                             'endpoint list --format json`')
+    parser.add_argument('directory', help='Directory of the maps to write')
+    args = parser.parse_args(argv)
+
+    services = load_services(args.services)
+    for name, path in write_maps(services, args.directory).items():
+        print(f'Wrote {name} to {path}')
+
+
+if __name__ == "__main__":
+    main()
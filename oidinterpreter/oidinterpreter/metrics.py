@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Metrics of the interpretation of scopes, in the Prometheus text format
+
+An OidInterpreter with `metrics` records the latency of each phase of
+`rewrite` in a Histogram, and counts its decisions by source cloud, target
+cloud and service type. Without `metrics` (the default), nothing is
+recorded and the interpretation only pays for one test per request.
+
+  oidi.metrics = Metrics()
+  serve_metrics(oidi.metrics, '0.0.0.0:9101')
+
+Then `GET /metrics` on port 9101 returns the exposition of the metrics.
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+# Phases of `OidInterpreter.rewrite`
+SCOPE_PARSE = 'scope_parse'
+URL_MATCH = 'url_match'
+TARGET_RESOLVE = 'target_resolve'
+HEADER_REWRITE = 'header_rewrite'
+PHASES = (SCOPE_PARSE, URL_MATCH, TARGET_RESOLVE, HEADER_REWRITE)
+
+# Upper bounds of the buckets of latencies, in seconds. Phases take a few
+# microseconds, unless a scope is parsed or a plan built for the first time.
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4,
+                   1e-3, 1e-2)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Counts of observations by bucket, as a Prometheus histogram.
+
+    `buckets` are the sorted upper bounds of the buckets, a last one holds
+    the observations above all of them.
+
+    """
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Lists (upper bound, observations below it), as in `le`."""
+        total = 0
+        cumulated = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulated.append((bound, total))
+        return cumulated
+
+
+def _labels(names: Iterable[str], values: Iterable[str]) -> str:
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values))
+
+
+def _bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class Metrics:
+    """Metrics of an OidInterpreter.
+
+    `phases` holds the Histogram of the latencies of each phase of PHASES,
+    `decisions` the number of requests rewritten by (source cloud, target
+    cloud, service type), and `passthrough` the number of requests left as
+    they are. Counts are not locked: concurrent threads may lose a few
+    observations, never corrupt them.
+
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.phases = {phase: Histogram(buckets) for phase in PHASES}
+        self.decisions: Dict[Tuple[str, str, str], int] = {}
+        self.passthrough = 0
+
+    def observe(self, phase: str, seconds: float) -> None:
+        self.phases[phase].observe(seconds)
+
+    def decide(self, source_cloud: str, target_cloud: str,
+               service_type: str, count: int = 1) -> None:
+        key = (source_cloud, target_cloud, service_type)
+        self.decisions[key] = self.decisions.get(key, 0) + count
+
+    def exposition(self) -> str:
+        """Renders the metrics in the Prometheus text format."""
+        lines = [
+            '# HELP oidinterpreter_phase_seconds Latency of the phases of '
+            'the interpretation of scopes.',
+            '# TYPE oidinterpreter_phase_seconds histogram']
+        for phase, histogram in self.phases.items():
+            for bound, count in histogram.cumulative():
+                labels = _labels(('phase', 'le'), (phase, _bound(bound)))
+                lines.append(
+                    f'oidinterpreter_phase_seconds_bucket{{{labels}}} {count}')
+            labels = _labels(('phase',), (phase,))
+            lines.append(f'oidinterpreter_phase_seconds_sum{{{labels}}} '
+                         f'{histogram.sum!r}')
+            lines.append(f'oidinterpreter_phase_seconds_count{{{labels}}} '
+                         f'{histogram.count}')
+
+        lines += [
+            '# HELP oidinterpreter_decisions_total Requests rewritten to '
+            'the service of a cloud.',
+            '# TYPE oidinterpreter_decisions_total counter']
+        for key, count in sorted(list(self.decisions.items())):
+            labels = _labels(
+                ('source_cloud', 'target_cloud', 'service_type'), key)
+            lines.append(f'oidinterpreter_decisions_total{{{labels}}} {count}')
+
+        lines += [
+            '# HELP oidinterpreter_passthrough_total Requests left as they '
+            'are.',
+            '# TYPE oidinterpreter_passthrough_total counter',
+            f'oidinterpreter_passthrough_total {self.passthrough}']
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics: Metrics, bind: str) -> ThreadingHTTPServer:
+    """Serves the exposition of `metrics` on `GET /metrics` at `bind`.
+
+    `bind` is a host:port. The server runs in a daemon thread; stop it with
+    its `shutdown` method.
+
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.partition('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.exposition().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    host, _, port = bind.rpartition(':')
+    server = ThreadingHTTPServer((host or '0.0.0.0', int(port)), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
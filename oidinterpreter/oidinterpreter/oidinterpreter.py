@@ -6,16 +6,30 @@
 #     /_/
 # Make your OpenStacks Collaborative
 
+from collections import OrderedDict
 import copy
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+import functools
 import json
 import logging
 import os
-from typing import (Callable, Dict, List, NewType, Union)
-from urllib.parse import urlparse
+import re
+import sys
+import threading
+import time
+from types import MappingProxyType
+import weakref
+from typing import (Callable, Dict, Hashable, Iterable, List, NewType,
+                    Optional, Tuple, Union)
+from urllib.parse import quote, unquote, urlparse
 
 from requests import Request
 
+from .balancer import Balancer
+from .breaker import CircuitBreaker, CloudUnavailable
+from .metrics import (HEADER_REWRITE, SCOPE_PARSE, TARGET_RESOLVE, URL_MATCH,
+                      Metrics)
+
 
 # A service contains `Interface`, `Region`, `Service Type`, and `URL` keys.
 Scope = NewType('Scope', Dict[str, str])
@@ -23,16 +37,97 @@ Scope = NewType('Scope', Dict[str, str])
 logging.basicConfig()
 LOG = logging.getLogger(__name__)
 SCOPE_DELIM = "!SCOPE!"
-SCOPE_INTERPRETERS = {}
+SCOPE_COMPACT_PREFIX = "1:"
+SCOPE_INTERPRETERS: 'OrderedDict[str, OidInterpreter]' = OrderedDict()
+SCOPE_INTERPRETERS_SIZE = 32
+SCOPE_CACHE_SIZE = 1024
+RELOAD_INTERVAL = 1.0
 
 
-@dataclass
+def _slotted(cls: type) -> type:
+    """Rebuilds the frozen dataclass `cls` with `__slots__`.
+
+    Instances then have no `__dict__`, as with `slots=True` of Python 3.10.
+
+    """
+    names = tuple(f.name for f in fields(cls))
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in names)
+
+    def __setstate__(self, state):
+        for name, value in zip(names, state):
+            object.__setattr__(self, name, value)
+
+    attrs = {k: v for k, v in cls.__dict__.items()
+             if k not in names + ('__dict__', '__weakref__')}
+    attrs.update(__slots__=names, __getstate__=__getstate__,
+                 __setstate__=__setstate__)
+    return type(cls)(cls.__name__, cls.__bases__, attrs)
+
+
+@_slotted
+@dataclass(frozen=True)
 class Service:
+    """An endpoint of a cloud.
+
+    Services have no `__dict__` and share their strings: a catalog repeats
+    the same clouds, service types and interfaces over its endpoints, and
+    often the same url over interfaces.
+
+    """
     service_type: str
     cloud: str
     url: str
     interface: str = None
 
+    def __post_init__(self):
+        for name in ('service_type', 'cloud', 'url', 'interface'):
+            value = getattr(self, name)
+            if type(value) is str:
+                object.__setattr__(self, name, sys.intern(value))
+
+
+@dataclass(frozen=True)
+class RewritePlan:
+    """Rewrite of requests that target `source` under a scope.
+
+    A plan only depends on the targeted Service and on the cloud the scope
+    binds to its service type. It is thus computed once and shared by all
+    requests with the same (source, cloud) pair.
+
+    When the cloud has several endpoints for the service, `target` is the
+    first one and `alternatives` holds a plan per endpoint, this one first
+    (see `oidinterpreter.balancer`).
+
+    """
+    source: Service
+    target: Service
+    clean_auth_token: bool
+    alternatives: Tuple['RewritePlan', ...] = ()
+
+    def rewrite_url(self, url: str) -> str:
+        """Replaces the `source` prefix of `url` by the `target` one."""
+        return self.target.url + url[len(self.source.url):]
+
+
+@dataclass(frozen=True)
+class Rewrite:
+    """Changes that the interpretation of a scope makes to a request.
+
+    `url` is the new url and `headers` only contains added or updated
+    headers, so a Rewrite never holds the body of the request.
+
+    """
+    url: str
+    headers: Dict[str, str]
+    plan: RewritePlan
+
+    def apply(self, req: Request) -> None:
+        """Updates `req` in place with the new url and headers."""
+        req.url = self.url
+        req.headers.update(self.headers)
+
 
 def oss2services(oss: List[Dict[str, str]]) -> List[Service]:
     """Transforms a list of OpenStack services into a list of Service.
@@ -51,13 +146,529 @@ def oss2services(oss: List[Dict[str, str]]) -> List[Service]:
             for s in oss]
 
 
-class OidInterpreter:
-    """Interprets the `Scope` in a `Request` and update it."""
+def load_services(path: str) -> List[Service]:
+    """Loads the services of the json file at `path` (see `oss2services`).
+
+    The file is either a list of OpenStack services, or a `services.json`
+    with such a list under its `services` key.
+
+    """
+    with open(path, 'r') as services_json:
+        oss = json.load(services_json)
+    if isinstance(oss, dict):
+        oss = oss['services']
+    return oss2services(oss)
+
+
+# Matches the origin of an url, i.e., everything before the path, the query
+# or the fragment (e.g., `http://192.168.141.245:8888`).
+_ORIGIN_RE = re.compile(r'^(?:[^:/?#]*://)?[^/?#]*')
+
+
+def _origin(url: str) -> str:
+    return _ORIGIN_RE.match(url).group(0)
+
+
+class UrlIndex:
+    """Longest-prefix matcher of urls onto Services.
+
+    Services are bucketed by the origin of their url. Then, in a bucket,
+    services are indexed by their url and the distinct lengths of these urls
+    are kept in decreasing order. A lookup computes the origin of the url,
+    and then tests each prefix of the url whose length is one of the bucket,
+    longest first. The cost of a lookup thus depends on the number of url
+    shapes of one origin, not on the number of services.
+
+    Two services with the same url resolve to the first one in `services`.
+
+    """
+
+    def __init__(self, services: List[Service]):
+        buckets: Dict[str, Dict[str, Service]] = {}
+        for s in services:
+            buckets.setdefault(_origin(s.url), {}).setdefault(s.url, s)
+
+        self._buckets = {
+            origin: (sorted({len(u) for u in urls}, reverse=True), urls)
+            for origin, urls in buckets.items()}
+
+    def lookup(self, url: str) -> Optional[Service]:
+        """Finds the Service with the longest url that prefixes `url`.
+
+        Returns None if no service matches.
+
+        """
+        bucket = self._buckets.get(_origin(url))
+        if bucket is None:
+            return None
+
+        lengths, urls = bucket
+        for length in lengths:
+            service = urls.get(url[:length])
+            if service is not None:
+                return service
+
+        return None
+
+    def patched(self, urls: Dict[str, Optional[Service]]) -> 'UrlIndex':
+        """Copies the index, with the Service of each url of `urls` changed.
+
+        A url mapped to None is removed. Only the buckets of `urls` are
+        rebuilt, the others are shared with this index, but the dict of the
+        buckets is copied: a patch costs one reference copy per origin.
+
+        """
+        index = copy.copy(self)
+        index._buckets = dict(self._buckets)
+
+        changes: Dict[str, Dict[str, Optional[Service]]] = {}
+        for url, service in urls.items():
+            changes.setdefault(_origin(url), {})[url] = service
+
+        for origin, bucket_changes in changes.items():
+            bucket = dict(self._buckets[origin][1]) \
+                if origin in self._buckets else {}
+            for url, service in bucket_changes.items():
+                if service is None:
+                    bucket.pop(url, None)
+                else:
+                    bucket[url] = service
+
+            if bucket:
+                index._buckets[origin] = (
+                    sorted({len(u) for u in bucket}, reverse=True), bucket)
+            else:
+                index._buckets.pop(origin, None)
+
+        return index
+
+    def services(self) -> List[Service]:
+        """Lists the indexed services, one per url."""
+        return [s for _, urls in self._buckets.values()
+                for s in urls.values()]
+
+
+class Catalog:
+    """Services of an OidInterpreter, together with their indexes.
+
+    A Catalog is never changed once built, except for the rewrite plans it
+    computes on demand. An OidInterpreter reloads its services by building
+    a new Catalog aside and then swapping it with the current one, so that
+    the interpretation of a request goes against a single Catalog from
+    start to end.
+
+    """
 
     def __init__(self, services: List[Service]):
-        """Private: Use `get_oidinterpreter instead`."""
         self.services = services
-        LOG.info(f'New OidInterpreter instance')
+        self.url_index = UrlIndex(services)
+
+        # Index services by (service_type, interface, cloud) and admin
+        # identity services by cloud. The first service of `services` wins
+        # in case of duplicates, as with `lookup_service`, and the others
+        # are its alternatives.
+        self.endpoints: Dict[Tuple[str, str, str], Service] = {}
+        self.identities: Dict[str, Service] = {}
+        groups: Dict[Tuple[str, str, str], Dict[Service, None]] = {}
+        for s in services:
+            key = (s.service_type, s.interface, s.cloud)
+            self.endpoints.setdefault(key, s)
+            groups.setdefault(key, {})[s] = None
+            if s.service_type == 'identity' and s.interface == 'admin':
+                self.identities.setdefault(s.cloud, s)
+        self.endpoint_groups: Dict[Tuple[str, str, str],
+                                   Tuple[Service, ...]] = {
+            key: tuple(group) for key, group in groups.items()}
+
+        # `X-Identity-*` headers per identity cloud, and rewrite plans per
+        # (source service, targeted cloud) filled on demand or by
+        # `precompute_plans`.
+        self.identity_headers: Dict[str, Dict[str, str]] = {
+            cloud: {'X-Identity-Cloud': s.cloud, 'X-Identity-Url': s.url}
+            for cloud, s in self.identities.items()}
+        self.plans: Dict[Tuple[Service, str], RewritePlan] = {}
+        self.precomputed = False
+
+    def lookup_endpoint(self, service_type: str, interface: str,
+                        cloud: str) -> Service:
+        """Finds the Service of `service_type`, `interface` and `cloud`.
+
+        Raises `StopIteration` if no service has been found.
+
+        """
+        try:
+            return self.endpoints[(service_type, interface, cloud)]
+        except KeyError:
+            raise StopIteration(f'No {interface} {service_type} in {cloud}')
+
+    def lookup_endpoints(self, service_type: str, interface: str,
+                         cloud: str) -> Tuple[Service, ...]:
+        """Finds all the Services of `service_type`, `interface` and
+        `cloud`, the one of `lookup_endpoint` first.
+
+        Raises `StopIteration` if no service has been found.
+
+        """
+        key = (service_type, interface, cloud)
+        group = self.endpoint_groups.get(key)
+        if group is None:
+            first = self.lookup_endpoint(service_type, interface, cloud)
+            group = (first,) + tuple(dict.fromkeys(
+                s for s in self.services if s != first and
+                (s.service_type, s.interface, s.cloud) == key))
+            self.endpoint_groups[key] = group
+        return group
+
+    def lookup_identity(self, cloud: str) -> Service:
+        """Finds the admin identity Service of `cloud`.
+
+        Raises `StopIteration` if no service has been found.
+
+        """
+        try:
+            return self.identities[cloud]
+        except KeyError:
+            raise StopIteration(f'No admin identity in {cloud}')
+
+    def get_identity_headers(self, cloud: str) -> Optional[Dict[str, str]]:
+        """Gets the `X-Identity-*` headers of `cloud`, if any."""
+        return self.identity_headers.get(cloud)
+
+    def get_plan(self, service: Service, cloud: str) -> RewritePlan:
+        """Gets the RewritePlan of requests to `service` scoped on `cloud`.
+
+        Raises `StopIteration` if `cloud` has no equivalent of `service`.
+
+        """
+        plan = self.plans.get((service, cloud))
+
+        if plan is None:
+            clean_auth_token = service.service_type == 'identity'
+            plans = tuple(
+                RewritePlan(source=service, target=target,
+                            clean_auth_token=clean_auth_token)
+                for target in self.lookup_endpoints(
+                    service.service_type, service.interface, cloud))
+            plan = plans[0]
+            if len(plans) > 1:
+                plan = RewritePlan(source=service, target=plan.target,
+                                   clean_auth_token=clean_auth_token,
+                                   alternatives=plans)
+            self.plans[(service, cloud)] = plan
+
+        return plan
+
+    def precompute_plans(self) -> int:
+        """Computes the RewritePlan of every (service, cloud) pair.
+
+        Returns the number of plans.
+
+        """
+        clouds: Dict[Tuple[str, str], List[str]] = {}
+        for (service_type, interface, cloud) in self.endpoints:
+            clouds.setdefault((service_type, interface), []).append(cloud)
+
+        for service in self.url_index.services():
+            for cloud in clouds[(service.service_type, service.interface)]:
+                self.get_plan(service, cloud)
+
+        self.precomputed = True
+        return len(self.plans)
+
+    def patched(self, services: List[Service],
+                urls: Dict[str, Optional[Service]],
+                endpoints: Dict[Tuple[str, str, str], Tuple[Service, ...]]
+                ) -> 'Catalog':
+        """Copies the Catalog, with `services` and a few entries changed.
+
+        `urls` gives the new Service of each changed url, or None if there
+        is no more Service for it, and `endpoints` all the Services of each
+        changed (service_type, interface, cloud), the first one first, or
+        none. Services, url buckets and plans that did not change are shared
+        with this Catalog, so a patch neither builds Services nor computes
+        plans but for the changes. The dicts of the indexes are still
+        copied, so its cost grows with the number of services: one change
+        of a catalog of 10k services costs about 2% of a new Catalog (see
+        `benchmarks/bench_sql.py`).
+
+        """
+        catalog = copy.copy(self)
+        catalog.services = services
+        catalog.url_index = self.url_index.patched(urls)
+        catalog.endpoints = dict(self.endpoints)
+        catalog.endpoint_groups = dict(self.endpoint_groups)
+        catalog.identities = dict(self.identities)
+        catalog.identity_headers = dict(self.identity_headers)
+
+        # Services no more in the indexes, whose plans are stale
+        stale = set()
+        for url in urls:
+            old = self.url_index.lookup(url)
+            if old is not None and old.url == url:
+                stale.add(old)
+
+        for key, group in endpoints.items():
+            old = catalog.endpoints.pop(key, None)
+            if old is not None:
+                stale.add(old)
+            catalog.endpoint_groups.pop(key, None)
+            s = group[0] if group else None
+            if group:
+                catalog.endpoints[key] = s
+                catalog.endpoint_groups[key] = group
+
+            service_type, interface, cloud = key
+            if service_type == 'identity' and interface == 'admin':
+                catalog.identities.pop(cloud, None)
+                catalog.identity_headers.pop(cloud, None)
+                if s is not None:
+                    catalog.identities[cloud] = s
+                    catalog.identity_headers[cloud] = {
+                        'X-Identity-Cloud': s.cloud,
+                        'X-Identity-Url': s.url}
+
+        # `plans` may be filled by another thread meanwhile: copy its items
+        # at once before testing them. Plans to a changed endpoint are
+        # recomputed, with its new alternatives.
+        catalog.plans = {
+            k: p for k, p in list(self.plans.items())
+            if p.source not in stale and p.target not in stale and
+            (p.target.service_type, p.target.interface, p.target.cloud)
+            not in endpoints}
+        catalog.precomputed = False
+        return catalog
+
+
+# Catalogs by content, i.e., by the tuple of their services, as long as an
+# OidInterpreter uses them.
+_CATALOGS: 'weakref.WeakValueDictionary[Tuple[Service, ...], Catalog]' = \
+    weakref.WeakValueDictionary()
+_CATALOGS_LOCK = threading.Lock()
+
+
+def shared_catalog(services: List[Service]) -> Catalog:
+    """Gets the Catalog of `services`, shared with other OidInterpreters.
+
+    Interpreters built from equal services, e.g., from two copies of the
+    same file, thus share their indexes and rewrite plans.
+
+    """
+    key = tuple(services)
+    with _CATALOGS_LOCK:
+        catalog = _CATALOGS.get(key)
+        if catalog is None:
+            catalog = _CATALOGS[key] = Catalog(services)
+    return catalog
+
+
+@dataclass
+class ReloadStats:
+    """Counters of the reloads of an OidInterpreter.
+
+    `generation` counts the Catalogs swapped in, and durations are the time
+    spent loading and building Catalogs, in seconds.
+
+    """
+    generation: int = 0
+    reloads: int = 0
+    last_duration: float = 0.0
+    total_duration: float = 0.0
+    last_reload: Optional[float] = None
+
+
+def _file_stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    """Identifies the content of `path` by its inode, size and mtime.
+
+    The inode catches files replaced by a rename. Returns None if `path`
+    cannot be stat'ed (e.g., in the middle of such a replacement).
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class ServicesWatcher(threading.Thread):
+    """Calls `reload` each time the file at `path` changes.
+
+    The watcher polls the stat of `path` every `interval` seconds, and calls
+    `reload` from its own thread, so that the loading and indexing of
+    services never stall requests. A `reload` that raises is logged, and
+    counted in `failures`, and the file is not reloaded until it changes
+    again. `stamp` identifies the content of `path`, or returns None if it
+    cannot tell (see `_file_stamp`).
+
+    """
+
+    def __init__(self, path: str, reload: Callable[[], None],
+                 interval: float = RELOAD_INTERVAL,
+                 stamp: Callable[[str], Optional[Hashable]] = _file_stamp):
+        super().__init__(name=f'ServicesWatcher({path})', daemon=True)
+        self.path = path
+        self.reload = reload
+        self.interval = interval
+        self.stamp = stamp
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self._stamp = stamp(path)
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self) -> bool:
+        """Calls `reload` if the file changed since the last check.
+
+        Returns whether the file has been reloaded.
+
+        """
+        stamp = self.stamp(self.path)
+        if stamp is None or stamp == self._stamp:
+            return False
+
+        self._stamp = stamp
+        try:
+            self.reload()
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            LOG.error(f'Failed to reload {self.path}: {e}')
+            return False
+
+        return True
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+class _DefaultScope(dict):
+    """Scope of the compact format, that binds missing services to
+    `default`, including with `get`.
+
+    """
+
+    def __init__(self, default: str):
+        super().__init__()
+        self.default = default
+
+    def __missing__(self, service_type: str) -> str:
+        return self.default
+
+    def get(self, service_type: str, default: Optional[str] = None) -> str:
+        return self[service_type]
+
+
+def encode_scope(scope: Dict[str, str], default: str) -> str:
+    """Serializes `scope` in the compact format.
+
+    The compact format is `1:<default>;<service>=<cloud>;...`, with names
+    percent-encoded, and omits services of `scope` bound to `default`, e.g.,
+    `1:CloudOne;image=CloudTwo`. Services missing in a compact scope are
+    bound to its default cloud, on every hop.
+
+    """
+    return SCOPE_COMPACT_PREFIX + quote(default, safe='') + ''.join(
+        f';{quote(service_type, safe="")}={quote(cloud, safe="")}'
+        for service_type, cloud in scope.items() if cloud != default)
+
+
+def _decode_scope(raw_scope: str) -> _DefaultScope:
+    default, *bindings = raw_scope[len(SCOPE_COMPACT_PREFIX):].split(';')
+    if not default:
+        raise ValueError(f'Scope {raw_scope} has no default cloud')
+
+    scope = _DefaultScope(unquote(default))
+    for binding in bindings:
+        service_type, _, cloud = binding.partition('=')
+        if not service_type or not cloud:
+            raise ValueError(f'Scope {raw_scope} has a bad binding '
+                             f'{binding!r}')
+        scope[unquote(service_type)] = unquote(cloud)
+
+    return scope
+
+
+def _binds_nothing(scope_entry: Optional[Tuple[Scope, str]]) -> bool:
+    """Tells whether a parsed scope and its `X-Scope` value bind no service.
+
+    That is no scope at all or an empty json one, e.g., `{}`. A compact
+    scope always binds services to its default cloud.
+
+    """
+    return not scope_entry or (
+        not scope_entry[0] and
+        not scope_entry[1].startswith(SCOPE_COMPACT_PREFIX))
+
+
+def parse_scope(raw_scope: str) -> Tuple[Scope, str]:
+    """Parses and validates `raw_scope`, in json or compact (see
+    `encode_scope`).
+
+    Returns the scope as a read-only mapping, together with its
+    serialization for the `X-Scope` header: json for a json scope, and
+    `raw_scope` itself for a compact one. Raises `ValueError` if
+    `raw_scope` is neither a json object of strings nor a compact scope.
+
+    """
+    if raw_scope.startswith(SCOPE_COMPACT_PREFIX):
+        return MappingProxyType(_decode_scope(raw_scope)), raw_scope
+
+    scope = json.loads(raw_scope)
+
+    if not isinstance(scope, dict) or not all(
+            isinstance(k, str) and isinstance(v, str)
+            for k, v in scope.items()):
+        raise ValueError(f'Scope {raw_scope} is not an object of strings')
+
+    return MappingProxyType(scope), json.dumps(scope)
+
+
+class OidInterpreter:
+    """Interprets the `Scope` in a `Request` and update it."""
+
+    def __init__(self, services: Union[List[Service], Catalog],
+                 scope_cache_size: int = SCOPE_CACHE_SIZE,
+                 metrics: Optional[Metrics] = None,
+                 balancer: Optional[Balancer] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        """Private: Use `get_oidinterpreter instead`.
+
+        `scope_cache_size` bounds the number of raw scopes whose parsing is
+        memoized (see `scope_cache_info`). Interpreters of equal `services`
+        share their Catalog (see `shared_catalog`). `services` may also be a
+        Catalog, e.g., a snapshot (see `oidinterpreter.snapshot`).
+
+        With `metrics`, the interpreter records the latency of each phase of
+        `rewrite` and counts its decisions (see `oidinterpreter.metrics`).
+        Set or unset the `metrics` attribute to turn that on or off.
+
+        When a cloud has several endpoints for a service, requests go to the
+        first one, or to the best one according to `balancer` (see
+        `oidinterpreter.balancer`).
+
+        With `breaker`, requests to a cloud whose circuit is open raise
+        CloudUnavailable instead of being rewritten (see
+        `oidinterpreter.breaker`).
+
+        """
+        self.metrics = metrics
+        self.balancer = balancer
+        self.breaker = breaker
+        self._catalog = (services if isinstance(services, Catalog)
+                         else shared_catalog(services))
+        self.reload_stats = ReloadStats()
+        self.watcher: Optional[ServicesWatcher] = None
+        self._reload_lock = threading.Lock()
+
+        # One token carries the same scope across all hops of a workflow, so
+        # a few raw scopes account for most requests. `lru_cache` is thread
+        # safe and counts hits/misses.
+        self._parse_scope = functools.lru_cache(
+            maxsize=scope_cache_size)(parse_scope)
+        LOG.info('New OidInterpreter instance')
 
     def lookup_service(self, p: Callable[[Service], bool]) -> Service:
         """Finds the first Service that satisfies `p`.
@@ -69,46 +680,180 @@ class OidInterpreter:
         """
         try:
             service = next(s for s in self.services if p(s))
-            LOG.info(f'Lookup finds service {service} with predicate {p}')
+            LOG.info('Lookup finds service %s with predicate %s', service, p)
             return service
         except StopIteration as s:
-            LOG.info(f'No service found with predicate {p}')
+            LOG.info('No service found with predicate %s', p)
             raise s
 
+    @property
+    def catalog(self) -> Catalog:
+        """The current Catalog."""
+        return self._catalog
+
+    @property
+    def services(self) -> List[Service]:
+        return self._catalog.services
+
+    @property
+    def url_index(self) -> UrlIndex:
+        return self._catalog.url_index
+
+    def lookup_endpoint(self, service_type: str, interface: str,
+                        cloud: str) -> Service:
+        """Finds the Service of `service_type`, `interface` and `cloud`.
+
+        Constant time equivalent of a `lookup_service` on these three
+        attributes. Raises `StopIteration` if no service has been found.
+
+        """
+        return self._catalog.lookup_endpoint(service_type, interface, cloud)
+
+    def lookup_identity(self, cloud: str) -> Service:
+        """Finds the admin identity Service of `cloud`.
+
+        Raises `StopIteration` if no service has been found.
+
+        """
+        return self._catalog.lookup_identity(cloud)
+
+    def get_plan(self, service: Service, cloud: str) -> RewritePlan:
+        """Gets the RewritePlan of requests to `service` scoped on `cloud`.
+
+        Raises `StopIteration` if `cloud` has no equivalent of `service`.
+
+        """
+        return self._catalog.get_plan(service, cloud)
+
+    def precompute_plans(self) -> int:
+        """Computes the RewritePlan of every (service, cloud) pair.
+
+        Catalogs built by later reloads precompute their plans too. Returns
+        the number of plans.
+
+        """
+        return self._catalog.precompute_plans()
+
+    def build_catalog(self, services: Union[List[Service], Catalog]
+                      ) -> Catalog:
+        """Builds the Catalog of `services`, without using it yet.
+
+        `services` may also be a Catalog already, e.g., a snapshot. Plans
+        are precomputed if the ones of the current Catalog are. Install the
+        Catalog with `swap`.
+
+        """
+        catalog = (services if isinstance(services, Catalog)
+                   else shared_catalog(services))
+        if self._catalog.precomputed and not catalog.precomputed:
+            catalog.precompute_plans()
+        return catalog
+
+    def swap(self, catalog: Catalog, duration: float = 0.0) -> None:
+        """Makes `catalog` the current Catalog.
+
+        Interpretations that already started finish against the previous
+        Catalog. `duration` is the time it took to load and build
+        `catalog`.
+
+        """
+        self._catalog = catalog
+        stats = self.reload_stats
+        stats.generation += 1
+        stats.reloads += 1
+        stats.last_duration = duration
+        stats.total_duration += duration
+        stats.last_reload = time.time()
+        LOG.info('Reload services (generation %d) in %.1f ms',
+                 stats.generation, duration * 1e3)
+
+    def reload(self, services: Union[List[Service], Catalog]) -> Catalog:
+        """Replaces the services of the interpreter by `services`.
+
+        Requests are interpreted against the previous services until the
+        new Catalog is built. Returns the new Catalog.
+
+        """
+        with self._reload_lock:
+            start = time.perf_counter()
+            catalog = self.build_catalog(services)
+            self.swap(catalog, time.perf_counter() - start)
+        return catalog
+
+    def watch(self, path: str, interval: float = RELOAD_INTERVAL,
+              load: Callable[[str], Union[List[Service], Catalog]] =
+              load_services,
+              stamp: Callable[[str], Optional[Hashable]] = _file_stamp
+              ) -> ServicesWatcher:
+        """Reloads the services from the file at `path` on change.
+
+        `load` reads the file, by default a json list of services, and
+        `stamp` tells when it changed (see ServicesWatcher). Starts and
+        returns the ServicesWatcher, also kept in `watcher`.
+
+        """
+        def reload() -> None:
+            start = time.perf_counter()
+            services = load(path)
+            with self._reload_lock:
+                catalog = self.build_catalog(services)
+                self.swap(catalog, time.perf_counter() - start)
+
+        if self.watcher is None:
+            self.watcher = ServicesWatcher(path, reload, interval, stamp)
+            self.watcher.start()
+        return self.watcher
+
+    def close(self) -> None:
+        """Stops watching the services file, if any."""
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
     def is_scoped_url(self, req: Request) -> Union[Service, "False"]:
         """Tests if the `req` targets a Service.
 
-        Returns the Service targeted by `req` if any, or False otherwise.
+        Returns the Service targeted by `req` if any, or False otherwise. If
+        several services prefix the url of `req`, the one with the longest url
+        wins.
 
         """
-        service = False
-
-        try:
-            service = self.lookup_service(
-                lambda s: req.url.startswith(s.url))
-        finally:
-            return service
+        return self._catalog.url_index.lookup(req.url) or False
 
     def get_scope(self, req: Request) -> Union[Scope, "False"]:
         """Finds the Scope from the current Request.
 
         Seeks for the Scope in headers of `req`. Looks first into `X-Scope`,
         then into `X-Auth-Token` delimited by `SCOPE_DELIM`. Returns either the
-        scope if found or False otherwise.
+        scope if found or False otherwise. The returned scope is read-only.
 
         """
-        scope = False
+        scope_entry = self._get_scope_entry(req)
+        scope = scope_entry[0] if scope_entry else False
 
+        LOG.info('Find scope %s in request headers', scope)
+        return scope
+
+    def _get_raw_scope(self, req: Request) -> Optional[str]:
+        """Finds the json Scope in `req` headers."""
         if 'X-Scope' in req.headers:
-            scope = json.loads(req.headers.get('X-Scope'))
+            return req.headers.get('X-Scope')
         elif 'X-Auth-Token' in req.headers \
              and SCOPE_DELIM in req.headers['X-Auth-Token']:
             auth_token = req.headers.get('X-Auth-Token')
             _, auth_scope = auth_token.split(SCOPE_DELIM)
-            scope = json.loads(auth_scope)
+            return auth_scope
 
-        LOG.info(f'Find scope {scope} in request headers')
-        return scope
+        return None
+
+    def _get_scope_entry(self, req: Request) -> Optional[Tuple[Scope, str]]:
+        """Finds the parsed Scope and its `X-Scope` value in `req` headers."""
+        raw_scope = self._get_raw_scope(req)
+        return self._parse_scope(raw_scope) if raw_scope is not None else None
+
+    def scope_cache_info(self) -> Tuple[int, int, int, int]:
+        """Reports `(hits, misses, maxsize, currsize)` of the scope parsing."""
+        return self._parse_scope.cache_info()
 
     def clean_token_header(self, req: Request, token_header_name: str) -> None:
         """Cleans the token of `token_header_name` from the Scope in `req`.
@@ -118,95 +863,310 @@ class OidInterpreter:
         token_header_name is any valid header name that contains a keystone
         token (e.g., X-Auth-Token, X-Subject-Token).
 
+        """
+        token = self._clean_token(req, token_header_name)
+        if token is not None:
+            req.headers.update({token_header_name: token})
+
+    def _clean_token(self, req: Request,
+                     token_header_name: str) -> Optional[str]:
+        """Returns the token of `token_header_name` without its Scope.
+
+        Returns None if `req` has no such header or the token has no scope.
+
         """
         if token_header_name in req.headers:
             auth_token = req.headers.get(token_header_name)
-            token, _ = auth_token.split(SCOPE_DELIM)
-            req.headers.update({token_header_name: token})
-            LOG.info(f'Revert {token_header_name} to {token}')
+            token, delim, _ = auth_token.partition(SCOPE_DELIM)
+            if delim:
+                LOG.info('Revert %s to %s', token_header_name, token)
+                return token
+
+        return None
+
+    def rewrite(self, req: Request) -> Union[Rewrite, "False"]:
+        """Finds & interprets the scope of `req` without changing it.
+
+        Returns the Rewrite to apply on `req`, or False if `req` doesn't
+        need to be changed. Raises CloudUnavailable if the `breaker` holds
+        the requests to the targeted cloud.
+
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            return self._measured_rewrite(req, metrics)
+
+        # Get the scope and the service originally targeted, all along
+        # against the same catalog
+        catalog = self._catalog
+        scope_entry = self._get_scope_entry(req)
+        service = catalog.url_index.lookup(req.url)
+
+        # The current request doesn't have a scope or doesn't target a scoped
+        # service, so we don't change the request
+        if _binds_nothing(scope_entry) or not service:
+            return False
+
+        return self._rewrite(req, *self._resolve(catalog, service,
+                                                 scope_entry))
+
+    def _measured_rewrite(self, req: Request,
+                          metrics: Metrics) -> Union[Rewrite, "False"]:
+        """`rewrite`, recording the latency of each phase in `metrics`."""
+        clock = time.perf_counter
+        catalog = self._catalog
+        start = clock()
+        scope_entry = self._get_scope_entry(req)
+        parsed = clock()
+        service = catalog.url_index.lookup(req.url)
+        matched = clock()
+        metrics.observe(SCOPE_PARSE, parsed - start)
+        metrics.observe(URL_MATCH, matched - parsed)
+
+        if _binds_nothing(scope_entry) or not service:
+            metrics.passthrough += 1
+            return False
+
+        plan, scope_headers = self._resolve(catalog, service, scope_entry)
+        resolved = clock()
+        rewrite = self._rewrite(req, plan, scope_headers)
+        metrics.observe(TARGET_RESOLVE, resolved - matched)
+        metrics.observe(HEADER_REWRITE, clock() - resolved)
+        metrics.decide(service.cloud, plan.target.cloud,
+                       service.service_type)
+        return rewrite
+
+    def _resolve(self, catalog: Catalog, service: Service,
+                 scope_entry: Tuple[Scope, str]
+                 ) -> Tuple[RewritePlan, Dict[str, str]]:
+        """Finds the plan and the scope headers for `service` in a scope.
+
+        This is the part of the interpretation shared by all requests to
+        `service` with the same scope.
+
+        """
+        scope, scope_header = scope_entry
+
+        # Find the plan for the targeted cloud
+        plan = catalog.get_plan(service, scope[service.service_type])
+        headers = {'X-Scope': scope_header}
+
+        # HACK: Add headers of the identity service. They are used later to
+        # tweak the keystone middleware
+        id_headers = catalog.get_identity_headers(scope.get('identity'))
+        if id_headers:
+            headers.update(id_headers)
+
+        return plan, headers
+
+    def _rewrite(self, req: Request, plan: RewritePlan,
+                 scope_headers: Dict[str, str]) -> Rewrite:
+        """Makes the Rewrite of `req` from its plan and scope headers."""
+        balancer = self.balancer
+        if plan.alternatives and balancer is not None:
+            plan = min(plan.alternatives,
+                       key=lambda p: balancer.score(p.target))
+        if self.breaker is not None:
+            self.breaker.check(plan.target.cloud)
+
+        # Remove scope from tokens
+        headers = {}
+        for token_header_name in (
+                ('X-Subject-Token', 'X-Auth-Token') if plan.clean_auth_token
+                else ('X-Subject-Token',)):
+            token = self._clean_token(req, token_header_name)
+            if token is not None:
+                headers[token_header_name] = token
+        headers.update(scope_headers)
+
+        return Rewrite(url=plan.rewrite_url(req.url), headers=headers,
+                       plan=plan)
 
     def interpret(self, req: Request) -> None:
         """Finds & interprets the scope to update `req` if need be.
 
         Update `req` in place with the new headers and url.
         """
-        # Get the scope and the service originally targeted
-        scope = self.get_scope(req)
-        service = self.is_scoped_url(req)
+        rewrite = self.rewrite(req)
+        if rewrite:
+            rewrite.apply(req)
 
-        # The current request doesn't have a scope or doesn't target a scoped
-        # service, so we don't change the request
-        if not scope or not service:
-            return
-
-        # Find the targeted cloud
-        targeted_service_type = service.service_type
-        targeted_interface = service.interface
-        targeted_cloud = scope[targeted_service_type]
-
-        # From targeted cloud, find the targeted service
-        targeted_service = self.lookup_service(
-            lambda s:
-                s.interface == targeted_interface and
-                s.service_type == targeted_service_type and
-                s.cloud == targeted_cloud)
-
-        # Update request
-        req.url = req.url.replace(
-            service.url, targeted_service.url) # Change url
-        self.clean_token_header(req, 'X-Subject-Token')  # Remove scope
-        if targeted_service_type == 'identity':          # from token
-            self.clean_token_header(req, 'X-Auth-Token')
-        req.headers.update({
-            'X-Scope': json.dumps(scope),
-        })
-
-        # HACK: Find the identity service. This part is used later to add
-        # helpful headers to tweak the keystone middleware
-        try:
-            id_service = self.lookup_service(
-                lambda s:
-                    s.interface == 'admin' and
-                    s.service_type == 'identity' and
-                    s.cloud == scope['identity'])
-
-            req.headers.update({
-                'X-Identity-Cloud': id_service.cloud,
-                'X-Identity-Url': id_service.url,
-            })
-        except StopIteration:
-            pass
+    def interpret_many(self, reqs: Iterable[Request]
+                       ) -> List[Union[Rewrite, "False", Exception]]:
+        """Interprets the scope of many requests at once.
+
+        Requests are grouped by raw scope and targeted service, so that the
+        scope and the plan of a group are resolved once. Update each request
+        in place, as `interpret` does, and returns, in the order of `reqs`,
+        either the Rewrite applied on the request, False if the request
+        doesn't need to be changed, or the exception raised while
+        interpreting it. A failing request never stops the batch. With
+        `metrics`, decisions are counted but phases are not timed.
+
+        """
+        catalog = self._catalog
+        metrics = self.metrics
+        reqs = list(reqs)
+        results: List[Union[Rewrite, "False", Exception]] = [False] * len(reqs)
+        groups: Dict[Tuple[str, Service], List[int]] = {}
+
+        for i, req in enumerate(reqs):
+            try:
+                raw_scope = self._get_raw_scope(req)
+                service = catalog.url_index.lookup(req.url)
+            except Exception as e:
+                results[i] = e
+                continue
+
+            if raw_scope is not None and service:
+                groups.setdefault((raw_scope, service), []).append(i)
+
+        for (raw_scope, service), indexes in groups.items():
+            try:
+                scope_entry = self._parse_scope(raw_scope)
+                if _binds_nothing(scope_entry):
+                    continue
+                plan, scope_headers = self._resolve(catalog, service,
+                                                    scope_entry)
+            except Exception as e:
+                for i in indexes:
+                    results[i] = e
+                continue
+
+            rewritten = 0
+            for i in indexes:
+                try:
+                    rewrite = self._rewrite(reqs[i], plan, scope_headers)
+                except CloudUnavailable as e:
+                    results[i] = e
+                    continue
+                rewrite.apply(reqs[i])
+                results[i] = rewrite
+                rewritten += 1
+            if metrics is not None and rewritten:
+                metrics.decide(service.cloud, plan.target.cloud,
+                               service.service_type, rewritten)
+
+        if metrics is not None:
+            metrics.passthrough += results.count(False)
+        return results
 
     def iinterpret(self, req: Request) -> Request:
-        "Immutable version of `interpret`."
-        req2 = copy.deepcopy(req)
+        """Immutable version of `interpret`.
+
+        Returns a shallow copy of `req` with its own url and headers. The
+        body, files, hooks and auth are shared with `req`, never copied. Use
+        `rewrite` to only get the changes.
+
+        """
+        req2 = copy.copy(req)
+        req2.headers = req.headers.copy()
         self.interpret(req2)
         return req2
 
 
-def get_oidinterpreter(services_uri: str) -> OidInterpreter:
+def canonical_uri(services_uri: str) -> str:
+    """Gets the canonical form of `services_uri`.
+
+    The path of a `file://` uri (the default), a `snapshot://` or a `sql://`
+    uri is made absolute, with symbolic links resolved, so that all the
+    uris of a file are equal.
+
+    """
+    uri = urlparse(services_uri)
+    if uri.scheme in ('', 'file', 'snapshot', 'sql'):
+        return (f'{uri.scheme or "file"}://' +
+                os.path.realpath(''.join([uri.netloc, uri.path])))
+    return uri.geturl()
+
+
+# Serializes the accesses to `SCOPE_INTERPRETERS`, and the build of the
+# OidInterpreter of each uri.
+_REGISTRY_LOCK = threading.Lock()
+_BUILD_LOCKS: Dict[str, threading.Lock] = {}
+
+
+def _loader(services_uri: str
+            ) -> Tuple[str, Callable[[str], Union[List[Service], Catalog]],
+                       Callable[[str], Optional[Hashable]]]:
+    """Finds the path of a canonical `services_uri`, how to load it, and
+    how to tell that it changed.
+
+    """
+    scheme, _, path = services_uri.partition('://')
+
+    # Interpret the uri to get the service list
+    if scheme == 'file':
+        return path, load_services, _file_stamp
+    elif scheme == 'snapshot':
+        from .snapshot import load_snapshot
+        return path, load_snapshot, _file_stamp
+    elif scheme == 'sql':
+        from .sql import load_sql, sql_stamp
+        return path, load_sql, sql_stamp
+
+    raise ValueError(f'Unsupported uri {services_uri}')
+
+
+def _build_oidinterpreter(services_uri: str, key: str) -> OidInterpreter:
+    """Builds the OidInterpreter of `services_uri` and registers it."""
+    path, load, _ = _loader(key)
+    services = load(path)
+    LOG.debug('Loaded from %s the services %s', services_uri, services)
+    oidi = OidInterpreter(services)
+
+    with _REGISTRY_LOCK:
+        SCOPE_INTERPRETERS[key] = oidi
+        while len(SCOPE_INTERPRETERS) > SCOPE_INTERPRETERS_SIZE:
+            _, evicted = SCOPE_INTERPRETERS.popitem(last=False)
+            evicted.close()
+
+    return oidi
+
+
+def get_oidinterpreter(services_uri: str,
+                       reload_interval: Optional[float] = None
+                       ) -> OidInterpreter:
     """Factory method that instantiates a new OidInterpreter.
 
     services_uri is the url of the services list. In absence of scheme, the
-    Default is `file://` uri that should target a json file.
+    Default is `file://` uri that should target a json file. A
+    `snapshot://` uri targets a binary snapshot of the services (see
+    `oidinterpreter.snapshot`), and a `sql://` uri a SQLite database of
+    services (see `oidinterpreter.sql`).
 
-    Right now, we only support filepath uri.
+    Interpreters are kept by canonical uri (see `canonical_uri`), for the
+    `SCOPE_INTERPRETERS_SIZE` most recently used uris. An evicted
+    interpreter stops watching its file. With a `reload_interval`, the
+    OidInterpreter checks the services file for changes every
+    `reload_interval` seconds and reloads it (see `OidInterpreter.watch`).
 
     """
-    services = []
-    uri = urlparse(services_uri)
+    key = canonical_uri(services_uri)
+
+    with _REGISTRY_LOCK:
+        oidi = SCOPE_INTERPRETERS.get(key)
+        if oidi is not None:
+            SCOPE_INTERPRETERS.move_to_end(key)
+        else:
+            build_lock = _BUILD_LOCKS.setdefault(key, threading.Lock())
+
+    if oidi is None:
+        # Concurrent first accesses wait for the one that builds it
+        with build_lock:
+            with _REGISTRY_LOCK:
+                oidi = SCOPE_INTERPRETERS.get(key)
+            if oidi is None:
+                try:
+                    oidi = _build_oidinterpreter(services_uri, key)
+                finally:
+                    with _REGISTRY_LOCK:
+                        _BUILD_LOCKS.pop(key, None)
 
-    if uri not in SCOPE_INTERPRETERS:
-        # Interpret the uri to get the service list. E.g.,
-        # if uri.scheme == 'sql', uri.scheme == 'file' ...
-        # Right now, we only support filepath uri
-        fp = os.path.abspath(''.join([uri.netloc, uri.path]))
-        with open(fp, 'r') as services_json:
-            services = oss2services(json.load(services_json))
-            LOG.debug(f'Loaded from {services_uri} the services {services}')
-
-    # Instantiate & serialize the OidInterpreter
-    return SCOPE_INTERPRETERS.setdefault(uri, OidInterpreter(services))
+    if reload_interval:
+        path, load, stamp = _loader(key)
+        oidi.watch(path, reload_interval, load, stamp)
+    return oidi
 
 
 def get_oidinterpreter_from_services(
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Keep-alive connection pools of the ScopeProxy
+
+A ConnectionPool bounds the number of connections to one upstream and keeps
+the idle ones open for reuse, so that requests don't pay a TCP setup to
+remote Frontends. A connection carries one request at a time: HTTP
+pipelining is not used, and `max_requests` caps the number of requests a
+connection carries before being renewed. A request waits at most
+`queue_timeout` seconds for a connection.
+"""
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+
+LOG = logging.getLogger(__name__)
+
+TIMEOUT_CONNECT = 10.0
+TIMEOUT_QUEUE = 60.0
+POOL_SIZE = 128
+POOL_IDLE_TIMEOUT = 30.0
+POOL_MAX_REQUESTS = 1000
+
+
+def split_address(address: str, default_port: int = 80) -> Tuple[str, int]:
+    """Splits `host[:port]` (or `[ipv6][:port]`) into its host and port."""
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        port = port[1:]
+    else:
+        host, _, port = address.partition(':')
+    return host, int(port) if port else default_port
+
+
+class QueueTimeout(Exception):
+    """No connection of a ConnectionPool got free in time."""
+
+
+@dataclass
+class Connection:
+    """A connection to an upstream."""
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    requests: int = 0
+    idle_since: float = field(default_factory=time.monotonic)
+
+    def is_usable(self, now: float, idle_timeout: float) -> bool:
+        "Tests if the idle connection can carry a new request."
+        return (now - self.idle_since < idle_timeout and
+                not self.reader.at_eof() and
+                not self.writer.is_closing())
+
+
+@dataclass
+class PoolStats:
+    """Counters of a ConnectionPool."""
+    size: int
+    in_use: int = 0
+    idle: int = 0
+    peak_in_use: int = 0
+    acquired: int = 0
+    reused: int = 0
+    opened: int = 0
+    closed: int = 0
+    waited: int = 0
+    timeouts: int = 0
+
+    @property
+    def saturation(self) -> float:
+        "Ratio of connections in use over the size of the pool."
+        return self.in_use / self.size if self.size else 0.0
+
+
+class ConnectionPool:
+    """Bounded pool of keep-alive connections to `address`.
+
+    At most `size` connections are open at once, a request that finds all of
+    them in use waits for one to be released, for at most `queue_timeout`
+    seconds. A `size` of 0 doesn't bound the number of connections. Idle
+    connections are closed after `idle_timeout` seconds.
+
+    """
+
+    def __init__(self, address: str, size: int = POOL_SIZE,
+                 idle_timeout: float = POOL_IDLE_TIMEOUT,
+                 max_requests: int = POOL_MAX_REQUESTS,
+                 connect_timeout: float = TIMEOUT_CONNECT,
+                 queue_timeout: float = TIMEOUT_QUEUE):
+        self.address = address
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.connect_timeout = connect_timeout
+        self.queue_timeout = queue_timeout
+        self.stats = PoolStats(size=size)
+
+        self.closed = False
+        self._idle: Deque[Connection] = deque()
+        self._slots = asyncio.Semaphore(size) if size else None
+        self._purge_handle: Optional[asyncio.TimerHandle] = None
+
+    async def acquire(self) -> Connection:
+        """Gets an idle connection, or opens a new one.
+
+        Raises `QueueTimeout` if all connections stayed in use for
+        `queue_timeout` seconds, `OSError` or `asyncio.TimeoutError` if the
+        connection cannot be opened.
+
+        """
+        if self._slots is not None:
+            if self._slots.locked():
+                self.stats.waited += 1
+                try:
+                    await asyncio.wait_for(self._slots.acquire(),
+                                           self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self.stats.timeouts += 1
+                    raise QueueTimeout(
+                        f'No connection to {self.address} got free in '
+                        f'{self.queue_timeout}s')
+            else:
+                await self._slots.acquire()
+
+        try:
+            conn = self._pop_idle()
+            if conn is None:
+                host, port = split_address(self.address)
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port),
+                    self.connect_timeout)
+                conn = Connection(reader, writer)
+                self.stats.opened += 1
+            else:
+                self.stats.reused += 1
+        except BaseException:
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+        conn.requests += 1
+        self.stats.acquired += 1
+        self.stats.in_use += 1
+        self.stats.peak_in_use = max(self.stats.peak_in_use,
+                                     self.stats.in_use)
+        return conn
+
+    def release(self, conn: Connection, reusable: bool) -> None:
+        """Gives `conn` back to the pool.
+
+        `conn` is kept for a later request if `reusable`, closed otherwise.
+
+        """
+        self.stats.in_use -= 1
+        if reusable and conn.requests < self.max_requests and not self.closed:
+            conn.idle_since = time.monotonic()
+            self._idle.append(conn)
+            self.stats.idle = len(self._idle)
+            self._schedule_purge()
+        else:
+            self._close(conn)
+        if self._slots is not None:
+            self._slots.release()
+
+    def _pop_idle(self) -> Optional[Connection]:
+        "Pops the most recently used idle connection that is still usable."
+        now = time.monotonic()
+        while self._idle:
+            conn = self._idle.pop()
+            self.stats.idle = len(self._idle)
+            if conn.is_usable(now, self.idle_timeout):
+                return conn
+            self._close(conn)
+        return None
+
+    def _purge(self) -> None:
+        "Closes idle connections that have been idle for too long."
+        self._purge_handle = None
+        now = time.monotonic()
+        while self._idle and not self._idle[0].is_usable(
+                now, self.idle_timeout):
+            self._close(self._idle.popleft())
+        self.stats.idle = len(self._idle)
+        self._schedule_purge()
+
+    def _schedule_purge(self) -> None:
+        if self._idle and self._purge_handle is None:
+            delay = self._idle[0].idle_since + self.idle_timeout \
+                - time.monotonic()
+            self._purge_handle = asyncio.get_event_loop().call_later(
+                max(delay, 0.0), self._purge)
+
+    def _close(self, conn: Connection) -> None:
+        conn.writer.close()
+        self.stats.closed += 1
+
+    def close(self) -> None:
+        """Closes all idle connections.
+
+        Connections in use are closed when released.
+
+        """
+        self.closed = True
+        while self._idle:
+            self._close(self._idle.pop())
+        self.stats.idle = 0
+        if self._purge_handle is not None:
+            self._purge_handle.cancel()
+            self._purge_handle = None
+
+
+class PoolManager:
+    """ConnectionPools per upstream key.
+
+    The ScopeProxy keys pools by (cloud, service_type, interface), as
+    HAProxy names its backends, so their number is bounded by the catalog.
+    `kwargs` are given to each ConnectionPool.
+
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.pools: Dict[Hashable, ConnectionPool] = {}
+
+    def get(self, key: Hashable, address: str) -> ConnectionPool:
+        """Gets the pool of `key`, created with `address` on first use.
+
+        The pool of `key` is replaced if `key` moved to another `address`
+        (e.g., after a reload of the services).
+
+        """
+        pool = self.pools.get(key)
+        if pool is None or pool.address != address:
+            if pool is not None:
+                pool.close()
+            pool = self.pools[key] = ConnectionPool(address, **self.kwargs)
+        return pool
+
+    def stats(self) -> Dict[Hashable, PoolStats]:
+        "Gets the counters of each pool."
+        return {key: pool.stats for key, pool in self.pools.items()}
+
+    def close(self) -> None:
+        for pool in self.pools.values():
+            pool.close()
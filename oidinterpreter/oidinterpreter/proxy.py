@@ -0,0 +1,1149 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+ScopeProxy: Interprets the Scope of requests in a reverse proxy
+
+Python counterpart of HAProxy with `interpret_scope.lua`. The proxy reads the
+`services.json` generated from `services.json.j2`, interprets the scope of
+each request and forwards it either to the local Backend of the service, or
+to the Frontend of the cloud targeted by the scope. Bodies of requests and
+responses are streamed, never buffered, except the small ones kept by the
+optional ResponseCache (see `oidinterpreter.cache`) and TokenCache (see
+`oidinterpreter.tokens`), or shared by coalesced requests.
+
+Run with
+
+  python -m oidinterpreter.proxy --services /etc/haproxy/services.json \\
+    --cloud CloudOne
+"""
+import argparse
+import asyncio
+from dataclasses import dataclass
+import functools
+import json
+import logging
+import math
+import time
+from typing import Awaitable, Dict, List, Optional, Tuple, TypeVar
+
+from requests.structures import CaseInsensitiveDict
+
+from .balancer import Balancer
+from .breaker import (FAILURES, RESET_TIMEOUT, Circuit, CircuitBreaker,
+                      CloudUnavailable)
+from .cache import (CACHE_SIZE, CACHE_TTL, CachedResponse, CacheStats,
+                    ResponseCache)
+from .metrics import Metrics, serve_metrics
+from .oidinterpreter import (RELOAD_INTERVAL, SCOPE_DELIM, Catalog,
+                             OidInterpreter, Service, ServicesWatcher,
+                             _origin, get_oidinterpreter_from_services,
+                             oss2services, parse_scope)
+from .pool import (POOL_IDLE_TIMEOUT, POOL_MAX_REQUESTS, POOL_SIZE,
+                   TIMEOUT_CONNECT, TIMEOUT_QUEUE, Connection,
+                   ConnectionPool, PoolManager, PoolStats, QueueTimeout,
+                   split_address)
+from .tokens import (TOKEN_CACHE_SIZE, TOKEN_NEGATIVE_TTL, TOKEN_TTL,
+                     TokenCache)
+
+
+LOG = logging.getLogger(__name__)
+
+# Sizes and timeouts, named after the HAProxy configuration
+MAX_HEAD_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+TIMEOUT_HTTP_REQUEST = 10.0
+TIMEOUT_CLIENT = 60.0
+TIMEOUT_SERVER = 60.0
+COALESCE_MAX_BODY_SIZE = 256 * 1024
+
+# Headers that only make sense for one connection (RFC 7230, Section 6.1)
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+    'upgrade'])
+
+# Statuses of a gateway that could not get a response from its server, as
+# the HAProxy frontend of a cloud answers when its backends are down
+GATEWAY_ERRORS = frozenset([502, 503, 504])
+
+# Methods that do not change resources (RFC 7231, Section 4.2.1)
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'TRACE'])
+
+# A response as read from an upstream: status line, headers and body
+Response = Tuple[str, List[Tuple[str, str]], bytes]
+
+T = TypeVar('T')
+
+
+@dataclass(frozen=True)
+class Route:
+    """Addresses of a Service, as in `services.json`."""
+    frontend: str
+    backend: str
+
+
+@dataclass(frozen=True)
+class Upstream:
+    """Where a request goes.
+
+    `service` is the Service targeted after interpretation of the scope, or
+    None for the transparent backend. `host` overrides the `Host` header
+    when not None.
+
+    """
+    address: str
+    service: Optional[Service] = None
+    host: Optional[str] = None
+
+    @property
+    def key(self) -> Tuple[str, ...]:
+        """Names the upstream as HAProxy names its backends.
+
+        That is (cloud, service_type, interface), or the address for the
+        transparent backend.
+
+        """
+        if self.service is None:
+            return (self.address,)
+        return (self.service.cloud, self.service.service_type,
+                self.service.interface)
+
+
+@dataclass
+class CoalesceStats:
+    """Counters of the coalescing of requests (see `ScopeProxy`)."""
+    flights: int = 0
+    coalesced: int = 0
+    fallbacks: int = 0
+
+    @property
+    def saved(self) -> int:
+        "Upstream calls saved by coalescing."
+        return self.coalesced - self.fallbacks
+
+
+class HttpError(Exception):
+    """An error to report to the client with `status`."""
+
+    def __init__(self, status: int, reason: str, message: str = '',
+                 headers: Optional[Dict[str, str]] = None):
+        super().__init__(message or reason)
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+
+
+class ProxyRequest:
+    """Head of a proxied request.
+
+    `url` is the `Host` header followed by the request target. This is what
+    the `base` sample fetch of HAProxy returns and how services are named in
+    `services.json` (no scheme). So a ProxyRequest can be given to
+    `OidInterpreter` like a `requests.Request`.
+
+    A target in absolute form, as sent by clients through `HTTP_PROXY`, is
+    split as HAProxy does: its authority replaces the `Host` header and
+    `target` keeps its path and query (RFC 7230, Section 5.4).
+
+    """
+
+    def __init__(self, method: str, target: str, version: str,
+                 headers: CaseInsensitiveDict):
+        if target[:8].lower().startswith(('http://', 'https://')):
+            authority, target = split_absolute_target(target)
+            headers['Host'] = authority
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.url = headers.get('Host', '') + target
+
+    @property
+    def keep_alive(self) -> bool:
+        "Tests if the client connection stays open after this request."
+        connection = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    def encode(self) -> bytes:
+        "Serializes the head of the request."
+        lines = [f'{self.method} {self.target} {self.version}']
+        lines.extend(f'{k}: {v}' for k, v in self.headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def split_absolute_target(target: str) -> Tuple[str, str]:
+    """Splits an absolute-form request target into its authority, without
+    user info, and its origin-form (path and query)."""
+    rest = target.partition('://')[2]
+    end = len(rest)
+    for delim in '/?':
+        i = rest.find(delim)
+        if i != -1:
+            end = min(end, i)
+    authority, path = rest[:end].rpartition('@')[2], rest[end:]
+    if not path.startswith('/'):
+        path = '/' + path
+    return authority, path
+
+
+def load_services_json(path: str) -> Tuple[List[Service],
+                                           Dict[Service, Route]]:
+    """Loads the services and their routes from a `services.json`."""
+    with open(path, 'r') as services_json:
+        oss = json.load(services_json)['services']
+
+    services = oss2services(oss)
+    routes = {s: Route(frontend=os['Frontend'], backend=os['Backend'])
+              for s, os in zip(services, oss)}
+    return services, routes
+
+
+async def read_head(reader: asyncio.StreamReader, prefix: bytes = b''
+                    ) -> Optional[Tuple[str, List[Tuple[str, str]]]]:
+    """Reads the start line and headers of an HTTP message, whose first
+    bytes `prefix` have already been read.
+
+    Returns None if the connection has been closed before any byte.
+
+    """
+    try:
+        data = prefix + await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial and not prefix:
+            return None
+        raise HttpError(400, 'Bad Request', 'Truncated HTTP head')
+    except asyncio.LimitOverrunError:
+        raise HttpError(431, 'Request Header Fields Too Large')
+
+    lines = data.decode('latin-1').split('\r\n')[:-2]
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep or not name or name != name.strip():
+            raise HttpError(400, 'Bad Request', f'Bad header {line!r}')
+        headers.append((name, value.strip()))
+
+    return lines[0], headers
+
+
+async def within(aw: Awaitable[T], timeout: Optional[float]) -> T:
+    "Awaits `aw` for at most `timeout` seconds, for ever if None."
+    if timeout is None:
+        return await aw
+    return await asyncio.wait_for(aw, timeout)
+
+
+async def copy_exactly(reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter, length: int,
+                       timeout: Optional[float] = None) -> None:
+    """Streams `length` bytes from `reader` to `writer`.
+
+    Raises `asyncio.TimeoutError` if `reader` stays silent for `timeout`
+    seconds, here and in the other `copy_*` functions.
+
+    """
+    while length > 0:
+        data = await within(reader.read(min(CHUNK_SIZE, length)), timeout)
+        if not data:
+            raise asyncio.IncompleteReadError(b'', length)
+        length -= len(data)
+        writer.write(data)
+        await writer.drain()
+
+
+async def copy_chunked(reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter,
+                       timeout: Optional[float] = None) -> None:
+    "Streams a chunked body, chunk by chunk, from `reader` to `writer`."
+    while True:
+        size_line = await within(reader.readuntil(b'\r\n'), timeout)
+        writer.write(size_line)
+        try:
+            size = int(size_line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise HttpError(400, 'Bad Request', 'Bad chunk size')
+
+        if size == 0:
+            # Trailers, up to the final empty line
+            while True:
+                line = await within(reader.readuntil(b'\r\n'), timeout)
+                writer.write(line)
+                if line == b'\r\n':
+                    await writer.drain()
+                    return
+
+        await copy_exactly(reader, writer, size + 2, timeout)
+
+
+async def copy_until_eof(reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter,
+                         timeout: Optional[float] = None) -> None:
+    "Streams bytes from `reader` to `writer` until `reader` is closed."
+    while True:
+        data = await within(reader.read(CHUNK_SIZE), timeout)
+        if not data:
+            return
+        writer.write(data)
+        await writer.drain()
+
+
+def body_length(headers) -> Optional[int]:
+    """Finds the framing of a body from its `headers`.
+
+    Returns -1 for a chunked body, the Content-Length otherwise, or None in
+    absence of both.
+
+    """
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        if 'Content-Length' in headers:
+            raise HttpError(400, 'Bad Request',
+                            'Both Transfer-Encoding and Content-Length')
+        return -1
+    elif 'Content-Length' in headers:
+        try:
+            length = int(headers['Content-Length'])
+        except ValueError:
+            length = -2
+        if length < 0:
+            raise HttpError(400, 'Bad Request', 'Bad Content-Length')
+        return length
+
+    return None
+
+
+async def copy_body(reader: asyncio.StreamReader,
+                    writer: asyncio.StreamWriter,
+                    length: Optional[int],
+                    timeout: Optional[float] = None) -> None:
+    "Streams a body of `length`, as returned by `body_length`."
+    if length == -1:
+        await copy_chunked(reader, writer, timeout)
+    elif length:
+        await copy_exactly(reader, writer, length, timeout)
+
+
+class ScopeProxy:
+    """Reverse proxy that interprets the Scope of requests.
+
+    `cloud` is the name of the current cloud. As with `interpret_scope.lua`,
+    services missing in the scope of a request default to `cloud`, and
+    requests to a service of `cloud` go to its Backend while requests to a
+    service of another cloud go to its Frontend.
+
+    Connections to each upstream are kept alive in a ConnectionPool of
+    `pool_size` connections, closed after `pool_idle_timeout` seconds of
+    inactivity. A `pool_size` of 0 opens a new connection per request. A
+    request that finds all the connections of its upstream in use waits
+    `queue_timeout` seconds at most, then is answered 503. Requests to the
+    transparent backend, whose address comes from the client, always get a
+    new connection.
+
+    An upstream that stays silent for `server_timeout` seconds before its
+    response head is answered 504, and one that sends a bad head 502. A
+    response that stalls for `server_timeout` seconds afterwards closes the
+    client connection.
+
+    A client gets `request_timeout` seconds to send the head of its
+    request. A request body that stalls for `client_timeout` seconds is
+    answered 408, and its upstream connection is closed. A keep-alive
+    connection waits `client_timeout` seconds at most for the next request.
+
+    `services_json` is the file the routes come from, reloaded on change
+    by `watch`.
+
+    Requests to a service with several endpoints in a cloud go to the one
+    that the `balancer` of `oidi` picks, if any, and the balancer is told
+    the latency and the outcome of each of them.
+
+    Requests to another cloud whose circuit is open in the `breaker` of
+    `oidi`, if any, are answered 503 at once (see `oidinterpreter.breaker`).
+    Connection errors and 502, 503 or 504 responses count as failures.
+
+    With a `cache`, GET requests to services of another cloud may be
+    answered from the cache (see `oidinterpreter.cache`). Other requests to
+    a service of another cloud drop the cached responses of that service.
+
+    With `tokens`, validations of tokens by the Keystone of another cloud
+    may be answered from the TokenCache (see `oidinterpreter.tokens`).
+
+    With `coalesce`, identical safe requests without body that go to the
+    same upstream at the same time share one upstream call: the first one
+    is forwarded and the others wait for its response. A response with a
+    body larger than `COALESCE_MAX_BODY_SIZE` is not shared, and waiting
+    requests are then forwarded on their own.
+
+    """
+
+    def __init__(self, oidi: OidInterpreter, routes: Dict[Service, Route],
+                 cloud: str, connect_timeout: float = TIMEOUT_CONNECT,
+                 request_timeout: float = TIMEOUT_HTTP_REQUEST,
+                 server_timeout: float = TIMEOUT_SERVER,
+                 client_timeout: float = TIMEOUT_CLIENT,
+                 pool_size: int = POOL_SIZE,
+                 pool_idle_timeout: float = POOL_IDLE_TIMEOUT,
+                 pool_max_requests: int = POOL_MAX_REQUESTS,
+                 queue_timeout: float = TIMEOUT_QUEUE,
+                 services_json: Optional[str] = None,
+                 cache: Optional[ResponseCache] = None,
+                 tokens: Optional[TokenCache] = None,
+                 coalesce: bool = False):
+        self.oidi = oidi
+        self.routes = routes
+        self.cloud = cloud
+        self.services_json = services_json
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.server_timeout = server_timeout
+        self.client_timeout = client_timeout
+        self.pooling = pool_size > 0
+        self.cache = cache
+        self.tokens = tokens
+        self.coalesce = coalesce
+        self.coalesce_stats = CoalesceStats()
+        self._flights: Dict[Tuple, 'asyncio.Future[Optional[Response]]'] = {}
+        self.pools = PoolManager(
+            size=pool_size, idle_timeout=pool_idle_timeout,
+            max_requests=pool_max_requests if self.pooling else 1,
+            connect_timeout=connect_timeout, queue_timeout=queue_timeout)
+
+        self._default_scope = {
+            s.service_type: cloud for s in oidi.services}
+        self._complete_scope = functools.lru_cache(maxsize=1024)(
+            self._complete_scope)
+        self.watcher: Optional[ServicesWatcher] = None
+
+    def _complete_scope(self, raw_scope: Optional[str]) -> str:
+        """Fills the scope with the current cloud for missing services.
+
+        Backends always get a json scope, whatever the format of `raw_scope`.
+
+        """
+        scope = dict(self._default_scope)
+        if raw_scope is not None:
+            parsed = parse_scope(raw_scope)[0]
+            # A compact scope binds missing services to its own default
+            scope = {service_type: parsed.get(service_type, cloud)
+                     for service_type, cloud in scope.items()}
+            scope.update(parsed)
+        return json.dumps(scope)
+
+    def resolve(self, req: ProxyRequest) -> Upstream:
+        """Interprets the scope of `req` and finds its Upstream.
+
+        Updates headers of `req` in place. Raises `HttpError` if the scope
+        is not valid.
+
+        """
+        if not self.oidi.is_scoped_url(req):
+            # The request does not target a service: use the transparent
+            # backend.
+            return Upstream(address=req.headers.get('Host', ''))
+
+        try:
+            req.headers['X-Scope'] = self._complete_scope(
+                self.oidi._get_raw_scope(req))
+            rewrite = self.oidi.rewrite(req)
+        except ValueError as e:
+            raise HttpError(400, 'Bad Request', str(e))
+        except StopIteration as e:
+            raise HttpError(400, 'Bad Request', str(e) or 'Unknown cloud')
+        except CloudUnavailable as e:
+            raise HttpError(503, 'Service Unavailable', str(e), {
+                'Retry-After': str(math.ceil(e.retry_after))})
+
+        rewrite.apply(req)
+        req.target = req.url[len(_origin(req.url)):] or '/'
+
+        # FIXME: find the proper protocol (e.g., http, https) instead of
+        # hardcoding it, as in `interpret_scope.lua`.
+        id_url = req.headers.get('X-Identity-Url')
+        if id_url and '://' not in id_url:
+            req.headers['X-Identity-Url'] = f'http://{id_url}'
+
+        target = rewrite.plan.target
+        route = self.routes[target]
+        if target.cloud == self.cloud:
+            return Upstream(address=route.backend, service=target)
+        else:
+            return Upstream(address=route.frontend, service=target,
+                            host=route.frontend)
+
+    def swap(self, catalog: Catalog, routes: Dict[Service, Route],
+             duration: float = 0.0) -> None:
+        """Makes `catalog` and `routes` the current ones.
+
+        Must be called from the event loop: `resolve` then always sees a
+        Catalog together with its routes. Requests already resolved go on
+        with their upstream. `duration` is given to `OidInterpreter.swap`.
+
+        """
+        self.routes = routes
+        self.oidi.swap(catalog, duration)
+        self._default_scope = {
+            s.service_type: self.cloud for s in catalog.services}
+        self._complete_scope.cache_clear()
+        if self.cache is not None:
+            self.cache.clear()
+        if self.tokens is not None:
+            self.tokens.clear()
+
+    def watch(self, interval: float = RELOAD_INTERVAL) -> ServicesWatcher:
+        """Reloads `services_json` when it changes.
+
+        The services are loaded and indexed in the thread of the watcher,
+        then swapped from the running event loop. Starts and returns the
+        ServicesWatcher, also kept in `watcher`.
+
+        """
+        loop = asyncio.get_running_loop()
+
+        def reload() -> None:
+            start = time.perf_counter()
+            services, routes = load_services_json(self.services_json)
+            catalog = self.oidi.build_catalog(services)
+            loop.call_soon_threadsafe(self.swap, catalog, routes,
+                                      time.perf_counter() - start)
+
+        if self.watcher is None:
+            self.watcher = ServicesWatcher(self.services_json, reload,
+                                           interval)
+            self.watcher.start()
+        return self.watcher
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        """Serves the requests of one client connection."""
+        peer = writer.get_extra_info('peername')
+        try:
+            keep_alive = await self._handle_request(reader, writer, peer)
+            while keep_alive:
+                keep_alive = await self._handle_request(reader, writer, peer,
+                                                        idle=True)
+        except HttpError as e:
+            await self._send_error(writer, e)
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError):
+            pass
+        except Exception:
+            LOG.exception('Unexpected error while proxying')
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader,
+                              writer: asyncio.StreamWriter, peer,
+                              idle: bool = False) -> bool:
+        """Proxies one request, returns whether the connection is kept.
+
+        An `idle` connection, kept alive after a request, waits for the
+        first byte of the next one for `client_timeout` seconds.
+
+        """
+        prefix = b''
+        if idle:
+            try:
+                prefix = await asyncio.wait_for(reader.readexactly(1),
+                                                self.client_timeout)
+            except asyncio.IncompleteReadError:
+                return False
+        head = await asyncio.wait_for(read_head(reader, prefix),
+                                      self.request_timeout)
+        if head is None:
+            return False
+
+        start_line, header_list = head
+        try:
+            method, target, version = start_line.split(' ')
+        except ValueError:
+            raise HttpError(400, 'Bad Request', 'Bad request line')
+
+        headers = CaseInsensitiveDict()
+        for name, value in header_list:
+            headers[name] = (f'{headers[name]}, {value}' if name in headers
+                             else value)
+
+        req = ProxyRequest(method, target, version, headers)
+        keep_alive = req.keep_alive
+        length = body_length(headers)
+        upstream = self.resolve(req)
+
+        token_key = self._token_key(req, upstream, length)
+        if token_key is not None:
+            cache_key = None
+            entry = self.tokens.lookup(token_key)
+        else:
+            cache_key = self._cache_key(req, upstream, length)
+            entry = (self.cache.lookup(cache_key, headers)
+                     if cache_key is not None else None)
+        if entry is not None:
+            await self._send_cached(writer, entry, keep_alive)
+            return keep_alive
+
+        # The proxy answers `Expect: 100-continue` itself, so that the body
+        # can be streamed right after the head.
+        if headers.pop('Expect', '').lower() == '100-continue':
+            writer.write(f'{version} 100 Continue\r\n\r\n'.encode('latin-1'))
+
+        for name in list(headers):
+            if name.lower() in HOP_BY_HOP_HEADERS:
+                del headers[name]
+        if not self.pooling or version == 'HTTP/1.0':
+            headers['Connection'] = 'close'
+        if upstream.host:
+            headers['Host'] = upstream.host
+        if peer:
+            forwarded_for = headers.get('X-Forwarded-For')
+            headers['X-Forwarded-For'] = (
+                f'{forwarded_for}, {peer[0]}' if forwarded_for else peer[0])
+
+        flight = None
+        flight_key = self._flight_key(req, upstream, length)
+        if flight_key is not None:
+            leader = self._flights.get(flight_key)
+            if leader is not None:
+                response = await self._follow(leader)
+                if response is not None:
+                    await self._send_response(writer, *response, keep_alive)
+                    return keep_alive
+            else:
+                flight = self._flights[flight_key] = \
+                    asyncio.get_running_loop().create_future()
+                self.coalesce_stats.flights += 1
+
+        try:
+            return await self._forward(req, reader, writer, upstream, length,
+                                       keep_alive, cache_key, token_key,
+                                       flight)
+        finally:
+            if flight is not None:
+                del self._flights[flight_key]
+                if not flight.done():
+                    flight.set_result(None)
+
+    async def _forward(self, req: ProxyRequest, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter, upstream: Upstream,
+                       length: Optional[int], keep_alive: bool,
+                       cache_key: Optional[Tuple[str, ...]],
+                       token_key: Optional[Tuple[str, ...]],
+                       flight: 'Optional[asyncio.Future[Optional[Response]]]'
+                       ) -> bool:
+        """Forwards `req` to `upstream` and relays its response.
+
+        Returns whether the client connection is kept.
+
+        """
+        if upstream.service is None:
+            # Clients name the transparent upstreams: a pool per address
+            # would let them grow the pools without bound
+            pool = ConnectionPool(upstream.address, size=0, max_requests=1,
+                                  connect_timeout=self.connect_timeout)
+        else:
+            pool = self.pools.get(upstream.key, upstream.address)
+        head = req.encode()
+        service = upstream.service
+        balancer = self.oidi.balancer if service is not None else None
+        if balancer is not None:
+            balancer.started(service)
+        breaker = (self.oidi.breaker if service is not None
+                   and service.cloud != self.cloud else None)
+        start = time.perf_counter()
+        latency: Optional[float] = None
+        status = 0
+        failed = False
+        conn: Optional[Connection] = None
+        reusable = False
+        try:
+            conn = await self._acquire(pool, upstream)
+            try:
+                conn.writer.write(head)
+                try:
+                    await copy_body(reader, conn.writer, length,
+                                    self.client_timeout)
+                except asyncio.TimeoutError:
+                    raise HttpError(408, 'Request Timeout',
+                                    'Stalled request body')
+                response_head = await self._read_response_head(conn.reader)
+            except ConnectionError:
+                response_head = None
+
+            # An idle connection may have been closed by the upstream in the
+            # meantime. Retry once on a new connection if no body has been
+            # sent.
+            if response_head is None and conn.requests > 1 and not length:
+                pool.release(conn, False)
+                conn = None
+                conn = await self._acquire(pool, upstream)
+                conn.writer.write(head)
+                response_head = await self._read_response_head(conn.reader)
+
+            if response_head is None:
+                raise HttpError(502, 'Bad Gateway', 'Empty response')
+
+            # The balancer measures the latency until the response head
+            latency = time.perf_counter() - start
+            status = int(response_head[0].split(' ', 2)[1])
+            keep_alive, reusable = await self._relay_response(
+                response_head, conn.reader, writer, req.method, keep_alive,
+                cache_key, req.headers, token_key, flight)
+            return keep_alive
+        except HttpError as e:
+            failed = e.status in GATEWAY_ERRORS
+            raise
+        except asyncio.TimeoutError:
+            # The upstream stalled in the middle of its response
+            failed = True
+            raise
+        finally:
+            if conn is not None:
+                pool.release(conn, reusable and self.pooling)
+            if balancer is not None:
+                balancer.finished(
+                    service, (time.perf_counter() - start if latency is None
+                              else latency), 0 < status < 500)
+            # Errors of the client connection tell nothing about the cloud
+            if breaker is not None and (failed or status):
+                breaker.finished(service.cloud,
+                                 status not in GATEWAY_ERRORS and not failed)
+
+    def _cache_key(self, req: ProxyRequest, upstream: Upstream,
+                   length: Optional[int]) -> Optional[Tuple[str, ...]]:
+        """Keys the response of `req` in the cache.
+
+        Returns None if the response is not to be cached. A request that may
+        change a cached service invalidates its responses.
+
+        """
+        service = upstream.service
+        if (self.cache is None or service is None or
+                service.cloud == self.cloud or
+                service.service_type not in self.cache.service_types):
+            return None
+
+        if req.method not in SAFE_METHODS:
+            self.cache.invalidate(service.cloud, service.service_type)
+        if req.method != 'GET' or length:
+            return None
+
+        token = req.headers.get('X-Auth-Token', '').partition(SCOPE_DELIM)[0]
+        return (service.cloud, service.service_type, req.url, token)
+
+    def _token_key(self, req: ProxyRequest, upstream: Upstream,
+                   length: Optional[int]) -> Optional[Tuple[str, ...]]:
+        """Keys the validation of a token by `req` in the token cache.
+
+        Returns None if `req` is not a validation to cache. A request that
+        may revoke tokens drops the validations of its cloud.
+
+        """
+        service = upstream.service
+        if (self.tokens is None or service is None or
+                service.cloud == self.cloud or
+                service.service_type != 'identity'):
+            return None
+
+        path, _, query = req.target.partition('?')
+        on_tokens = path.rstrip('/').endswith('/auth/tokens')
+        subject = req.headers.get('X-Subject-Token', '')
+        if req.method == 'DELETE' and on_tokens:
+            self.tokens.revoke(service.cloud, subject)
+        elif req.method not in SAFE_METHODS and not on_tokens:
+            self.tokens.invalidate(service.cloud)
+
+        # Validations of expired tokens are not cached
+        if (req.method != 'GET' or length or not on_tokens or not subject
+                or 'allow_expired' in query):
+            return None
+
+        caller = req.headers.get('X-Auth-Token', '').partition(SCOPE_DELIM)[0]
+        return (service.cloud, req.target, subject, caller)
+
+    async def _send_cached(self, writer: asyncio.StreamWriter,
+                           entry: CachedResponse, keep_alive: bool) -> None:
+        "Answers a request with a response of the cache."
+        header_list = [(k, v) for k, v in entry.headers
+                       if k.lower() != 'age']
+        header_list.append(('Age', str(entry.age)))
+        await self._send_response(writer, entry.status_line, header_list,
+                                  entry.body, keep_alive)
+
+    async def _send_response(self, writer: asyncio.StreamWriter,
+                             status_line: str,
+                             header_list: List[Tuple[str, str]], body: bytes,
+                             keep_alive: bool) -> None:
+        "Answers a request with a response read beforehand."
+        lines = [status_line]
+        lines.extend(f'{k}: {v}' for k, v in header_list
+                     if k.lower() not in HOP_BY_HOP_HEADERS)
+        lines.append(f'Connection: {"keep-alive" if keep_alive else "close"}')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') +
+                     body)
+        await writer.drain()
+
+    def _flight_key(self, req: ProxyRequest, upstream: Upstream,
+                    length: Optional[int]) -> Optional[Tuple]:
+        """Keys the upstream call of `req` among the concurrent ones.
+
+        Returns None if `req` is not to be coalesced. Requests with the same
+        key are identical, but for `X-Forwarded-For`.
+
+        """
+        if not self.coalesce or req.method not in SAFE_METHODS or length:
+            return None
+        return (upstream.address, req.method, req.target,
+                tuple((k.lower(), v) for k, v in req.headers.items()
+                      if k.lower() != 'x-forwarded-for'))
+
+    async def _follow(self, flight: 'asyncio.Future[Optional[Response]]'
+                      ) -> Optional[Response]:
+        """Waits for the response of an identical request in flight.
+
+        Returns None if that response cannot be shared.
+
+        """
+        self.coalesce_stats.coalesced += 1
+        try:
+            response = await asyncio.wait_for(asyncio.shield(flight),
+                                              self.request_timeout)
+        except asyncio.TimeoutError:
+            response = None
+        if response is None:
+            self.coalesce_stats.fallbacks += 1
+        return response
+
+    async def _acquire(self, pool: ConnectionPool,
+                       upstream: Upstream) -> Connection:
+        try:
+            return await pool.acquire()
+        except QueueTimeout as e:
+            LOG.warning(str(e))
+            raise HttpError(503, 'Service Unavailable', str(e))
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            LOG.info(f'Cannot connect to {upstream.address}: {e!r}')
+            raise HttpError(502, 'Bad Gateway')
+
+    async def _read_response_head(self, up_reader: asyncio.StreamReader
+                                  ) -> Optional[Tuple[str,
+                                                      List[Tuple[str, str]]]]:
+        """Reads the head of a response from an upstream.
+
+        Returns None if the upstream closed the connection before any byte.
+        Raises `HttpError` 504 if the upstream does not answer within
+        `server_timeout` seconds, and 502 if its head is not valid.
+
+        """
+        try:
+            head = await asyncio.wait_for(read_head(up_reader),
+                                          self.server_timeout)
+        except asyncio.TimeoutError:
+            raise HttpError(504, 'Gateway Timeout')
+        except HttpError as e:
+            raise HttpError(502, 'Bad Gateway', f'Bad response: {e}')
+
+        if head is not None:
+            try:
+                int(head[0].split(' ', 2)[1])
+            except (IndexError, ValueError):
+                raise HttpError(502, 'Bad Gateway',
+                                f'Bad status line {head[0]!r}')
+        return head
+
+    async def _relay_response(
+            self, head: Tuple[str, List[Tuple[str, str]]],
+            up_reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+            method: str, keep_alive: bool,
+            cache_key: Optional[Tuple[str, ...]] = None,
+            req_headers: Optional[CaseInsensitiveDict] = None,
+            token_key: Optional[Tuple[str, ...]] = None,
+            flight: 'Optional[asyncio.Future[Optional[Response]]]' = None
+            ) -> Tuple[bool, bool]:
+        """Streams the response of the upstream back to the client.
+
+        Returns whether the client connection is kept alive and whether the
+        upstream connection can be reused. A cacheable response of
+        `cache_key` is read whole and stored in the cache, and so is a
+        validation of `token_key` in the token cache. A small enough
+        response is read whole and set as the result of `flight`.
+
+        """
+        while True:
+            status_line, header_list = head
+            status = int(status_line.split(' ', 2)[1])
+            if not 100 <= status < 200:
+                break
+            # Interim response
+            writer.write(f'{status_line}\r\n\r\n'.encode('latin-1'))
+            head = await self._read_response_head(up_reader)
+            if head is None:
+                raise HttpError(502, 'Bad Gateway', 'Empty response')
+
+        headers = CaseInsensitiveDict(header_list)
+        reusable = (status_line.startswith('HTTP/1.1') and
+                    'close' not in headers.get('Connection', '').lower())
+        if method == 'HEAD' or status in (204, 304):
+            length = 0
+        else:
+            length = body_length(headers)
+            if length is None:
+                # Body delimited by the end of the connection
+                keep_alive = reusable = False
+
+        lines = [status_line]
+        lines.extend(f'{k}: {v}' for k, v in header_list
+                     if k.lower() not in HOP_BY_HOP_HEADERS)
+        lines.append(f'Connection: {"keep-alive" if keep_alive else "close"}')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        ttl = 0.0
+        if (cache_key is not None and status == 200 and length is not None
+                and 0 <= length <= self.cache.max_body_size):
+            ttl = self.cache.ttl_of(req_headers, headers)
+
+        validation = (token_key is not None and self.tokens.caches(status)
+                      and length is not None
+                      and 0 <= length <= self.tokens.max_body_size)
+
+        share = (flight is not None and length is not None and
+                 0 <= length <= COALESCE_MAX_BODY_SIZE)
+
+        if ttl > 0 or validation or share:
+            body = await within(up_reader.readexactly(length),
+                                self.server_timeout)
+            writer.write(body)
+            if ttl > 0:
+                self.cache.store(cache_key, status_line, header_list, body,
+                                 ttl, req_headers)
+            if validation:
+                self.tokens.store(token_key, status_line, header_list, body)
+            if share:
+                flight.set_result((status_line, header_list, body))
+        elif length is None:
+            await copy_until_eof(up_reader, writer, self.server_timeout)
+        else:
+            await copy_body(up_reader, writer, length, self.server_timeout)
+        await writer.drain()
+
+        return keep_alive, reusable
+
+    def cache_stats(self) -> Optional[CacheStats]:
+        """Gets the counters of the cache, None without cache."""
+        return self.cache.stats if self.cache is not None else None
+
+    def token_stats(self) -> Optional[CacheStats]:
+        """Gets the counters of the token cache, None without it."""
+        return self.tokens.stats if self.tokens is not None else None
+
+    def breaker_stats(self) -> Optional[Dict[str, Circuit]]:
+        """Gets the circuits of the other clouds, None without breaker."""
+        breaker = self.oidi.breaker
+        return breaker.stats() if breaker is not None else None
+
+    def pool_stats(self) -> Dict[Tuple[str, ...], PoolStats]:
+        """Gets the counters of the pool of each upstream.
+
+        Upstreams are keyed as in `Upstream.key`. The transparent backend
+        has no pool.
+
+        """
+        return self.pools.stats()
+
+    async def _send_error(self, writer: asyncio.StreamWriter,
+                          error: HttpError) -> None:
+        body = f'{error}\n'.encode()
+        try:
+            writer.write(
+                (f'HTTP/1.1 {error.status} {error.reason}\r\n'
+                 f'Content-Type: text/plain\r\n'
+                 f'Content-Length: {len(body)}\r\n' +
+                 ''.join(f'{name}: {value}\r\n'
+                         for name, value in error.headers.items()) +
+                 'Connection: close\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def start(self, binds: List[str],
+                    **kwargs) -> List[asyncio.AbstractServer]:
+        """Listens on all `binds` addresses (i.e., `host:port`).
+
+        `kwargs` are given to `asyncio.start_server`.
+
+        """
+        kwargs.setdefault('backlog', 1024)
+        servers = []
+        for bind in binds:
+            host, port = split_address(bind)
+            servers.append(await asyncio.start_server(
+                self.handle, host, port, limit=MAX_HEAD_SIZE, **kwargs))
+            LOG.info(f'Listen on {bind}')
+        return servers
+
+
+def get_scope_proxy(services_json: str, cloud: str,
+                    **kwargs) -> ScopeProxy:
+    """Factory method that instantiates a ScopeProxy from a `services.json`.
+
+    `kwargs` are given to ScopeProxy.
+
+    """
+    services, routes = load_services_json(services_json)
+    return ScopeProxy(get_oidinterpreter_from_services(services), routes,
+                      cloud, services_json=services_json, **kwargs)
+
+
+def frontends(proxy: ScopeProxy) -> List[str]:
+    "Lists the Frontends of the current cloud, as bound by HAProxy."
+    return sorted({r.frontend for s, r in proxy.routes.items()
+                   if s.cloud == proxy.cloud})
+
+
+async def serve(proxy: ScopeProxy, binds: List[str],
+                reload_interval: float = 0.0, **kwargs) -> None:
+    """Serves `proxy` on `binds` forever.
+
+    With a `reload_interval`, the services file is checked for changes
+    every `reload_interval` seconds. `kwargs` are given to
+    `asyncio.start_server`.
+
+    """
+    servers = await proxy.start(binds, **kwargs)
+    if reload_interval:
+        proxy.watch(reload_interval)
+    try:
+        await asyncio.gather(*(s.serve_forever() for s in servers))
+    finally:
+        if proxy.watcher is not None:
+            proxy.watcher.stop()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Reverse proxy that interprets the scope of requests.')
+    parser.add_argument('--services', default='/etc/haproxy/services.json',
+                        help='services.json (default: %(default)s)')
+    parser.add_argument('--cloud', required=True,
+                        help='Name of the current cloud')
+    parser.add_argument('--bind', action='append',
+                        help='host:port to listen on, may be repeated '
+                             '(default: Frontends of the current cloud)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes, more than one '
+                             'requires SO_REUSEPORT (default: %(default)s)')
+    parser.add_argument('--server-timeout', type=float,
+                        default=TIMEOUT_SERVER,
+                        help='Seconds an upstream may stay silent before '
+                             'the request fails with 504 '
+                             '(default: %(default)s)')
+    parser.add_argument('--client-timeout', type=float,
+                        default=TIMEOUT_CLIENT,
+                        help='Seconds a client may stall its request body, '
+                             'or stay idle between requests '
+                             '(default: %(default)s)')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='Keep-alive connections per upstream, 0 '
+                             'disables pooling (default: %(default)s)')
+    parser.add_argument('--pool-idle-timeout', type=float,
+                        default=POOL_IDLE_TIMEOUT,
+                        help='Seconds before closing an idle upstream '
+                             'connection (default: %(default)s)')
+    parser.add_argument('--queue-timeout', type=float, default=TIMEOUT_QUEUE,
+                        help='Seconds a request waits for a connection of '
+                             'a full pool before a 503 '
+                             '(default: %(default)s)')
+    parser.add_argument('--reload-interval', type=float, default=0.0,
+                        help='Seconds between checks of the services file '
+                             'for changes, 0 disables reloads '
+                             '(default: %(default)s)')
+    parser.add_argument('--cache', default='',
+                        help='Comma separated service types whose GET '
+                             'responses from other clouds are cached, e.g., '
+                             'image,compute (default: no cache)')
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL,
+                        help='Seconds a response stays in the cache '
+                             '(default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help='Maximum number of cached responses '
+                             '(default: %(default)s)')
+    parser.add_argument('--token-cache', action='store_true',
+                        help='Cache validations of tokens by the Keystone '
+                             'of other clouds')
+    parser.add_argument('--token-ttl', type=float, default=TOKEN_TTL,
+                        help='Maximum seconds a valid token stays in the '
+                             'token cache (default: %(default)s)')
+    parser.add_argument('--token-negative-ttl', type=float,
+                        default=TOKEN_NEGATIVE_TTL,
+                        help='Seconds an invalid token stays in the token '
+                             'cache, 0 disables it (default: %(default)s)')
+    parser.add_argument('--token-cache-size', type=int,
+                        default=TOKEN_CACHE_SIZE,
+                        help='Maximum number of cached validations '
+                             '(default: %(default)s)')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Share one upstream call among identical '
+                             'concurrent safe requests')
+    parser.add_argument('--balance', action='store_true',
+                        help='Pick among the endpoints of a service in a '
+                             'cloud by health and latency (default: the '
+                             'first one)')
+    parser.add_argument('--breaker', action='store_true',
+                        help='Fail fast requests to other clouds that keep '
+                             'failing')
+    parser.add_argument('--breaker-failures', type=int, default=FAILURES,
+                        help='Failures in a row that open the circuit of a '
+                             'cloud (default: %(default)s)')
+    parser.add_argument('--breaker-reset-timeout', type=float,
+                        default=RESET_TIMEOUT,
+                        help='Seconds before probing a cloud whose circuit '
+                             'is open (default: %(default)s)')
+    parser.add_argument('--metrics', metavar='BIND',
+                        help='host:port to serve the metrics of the '
+                             'interpretation on, at /metrics (default: no '
+                             'metrics)')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    if args.metrics and args.workers > 1:
+        parser.error('--metrics requires a single worker')
+
+    logging.getLogger('oidinterpreter').setLevel(args.log_level)
+    service_types = [s for s in args.cache.split(',') if s]
+    cache = (ResponseCache(service_types, ttl=args.cache_ttl,
+                           size=args.cache_size) if service_types else None)
+    tokens = (TokenCache(ttl=args.token_ttl,
+                         negative_ttl=args.token_negative_ttl,
+                         size=args.token_cache_size)
+              if args.token_cache else None)
+    proxy = get_scope_proxy(args.services, args.cloud,
+                            server_timeout=args.server_timeout,
+                            client_timeout=args.client_timeout,
+                            pool_size=args.pool_size,
+                            pool_idle_timeout=args.pool_idle_timeout,
+                            queue_timeout=args.queue_timeout,
+                            cache=cache, tokens=tokens,
+                            coalesce=args.coalesce)
+    binds = args.bind or frontends(proxy)
+    if args.balance:
+        proxy.oidi.balancer = Balancer()
+    if args.breaker:
+        proxy.oidi.breaker = CircuitBreaker(
+            failures=args.breaker_failures,
+            reset_timeout=args.breaker_reset_timeout)
+    if args.metrics:
+        proxy.oidi.metrics = Metrics()
+        serve_metrics(proxy.oidi.metrics, args.metrics)
+
+    if args.workers > 1:
+        from .workers import fork_workers
+        try:
+            fork_workers(proxy, binds, args.workers, args.reload_interval)
+        except RuntimeError as e:
+            parser.exit(1, f'{e}\n')
+    else:
+        asyncio.run(serve(proxy, binds, args.reload_interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Binary snapshots of a service catalog
+
+A snapshot holds the services of a catalog and its lookup indexes in a
+memory-mappable file, so that a process loads a catalog without parsing
+json nor building one Service per endpoint. Services, strings and index
+buckets are only materialized on first use.
+
+All numbers are little-endian unsigned 32-bit integers, and sections
+follow the header in this order:
+
+- string offsets: `nb_strings + 1` offsets in the string blob;
+- string blob: utf-8 strings, each one stored once, padded to 4 bytes;
+- services: the columns `service_type`, `cloud`, `url` and `interface`
+  of `nb_services` string ids (`NONE` for a missing interface);
+- origins: `nb_origins` triples (origin string id, start, end) of ranges
+  in the url entries;
+- url entries: `nb_entries` service ids, the first service of each url,
+  grouped by origin and sorted by decreasing url length;
+- origin table: `origin_slots` origin ids, open-addressed on the crc32 of
+  the origin;
+- endpoint table: `endpoint_slots` service ids, open-addressed on the
+  crc32 of `service_type\\0interface\\0cloud`. Every service is indexed,
+  in catalog order, so that a probe finds all the endpoints of a key, the
+  first one first.
+
+Convert a `services.json` or the output of `openstack endpoint list
+--format json` with
+
+  python -m oidinterpreter.snapshot services.json services.snap
+
+and load it with `get_oidinterpreter('snapshot:///path/to/services.snap')`.
+"""
+from array import array
+import argparse
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import zlib
+
+from .oidinterpreter import (Catalog, Service, UrlIndex, _origin,
+                             load_services)
+
+
+SNAPSHOT_MAGIC = b'OIDSNAP\0'
+SNAPSHOT_VERSION = 2
+NONE = 0xFFFFFFFF
+
+# magic, version, nb_strings, blob_size, nb_services, nb_origins,
+# nb_entries, origin_slots, endpoint_slots
+_HEADER = struct.Struct('<8sIIIIIIII')
+
+
+def _slots(nb_keys: int) -> int:
+    "Size of an open-addressed table for `nb_keys`, a power of 2."
+    size = 2
+    while size < 2 * nb_keys:
+        size *= 2
+    return size
+
+
+def _endpoint_key(service_type: str, interface: Optional[str],
+                  cloud: str) -> bytes:
+    return f'{service_type}\0{interface or ""}\0{cloud}'.encode()
+
+
+def _probe(table: Sequence[int], key: bytes) -> Iterator[int]:
+    "Yields the values of `table` for the keys that share the slot of `key`."
+    mask = len(table) - 1
+    i = zlib.crc32(key) & mask
+    while table[i] != NONE:
+        yield table[i]
+        i = (i + 1) & mask
+
+
+def _insert(table: List[int], key: bytes, value: int) -> None:
+    mask = len(table) - 1
+    i = zlib.crc32(key) & mask
+    while table[i] != NONE:
+        i = (i + 1) & mask
+    table[i] = value
+
+
+def _u32(buf: memoryview) -> Sequence[int]:
+    "Reads little-endian integers of `buf`, without copy when possible."
+    if sys.byteorder == 'little':
+        return buf.cast('I')
+    a = array('I', bytes(buf))
+    a.byteswap()
+    return a
+
+
+def dump_snapshot(services: List[Service]) -> bytes:
+    """Serializes `services` and their indexes into a snapshot.
+
+    Duplicates resolve as in Catalog: the first service of a url, or of a
+    (service_type, interface, cloud), wins, and the other services of a
+    (service_type, interface, cloud) are its alternatives. Raises
+    `ValueError` if a string contains a NUL character.
+
+    """
+    strings: Dict[str, int] = {}
+
+    def intern(s: Optional[str]) -> int:
+        if s is None:
+            return NONE
+        if '\0' in s:
+            raise ValueError(f'NUL character in {s!r}')
+        return strings.setdefault(s, len(strings))
+
+    columns = [[intern(getattr(s, attr)) for s in services]
+               for attr in ('service_type', 'cloud', 'url', 'interface')]
+
+    # Url entries, as in UrlIndex
+    buckets: Dict[str, Dict[str, int]] = {}
+    for i, s in enumerate(services):
+        buckets.setdefault(_origin(s.url), {}).setdefault(s.url, i)
+    origins, entries = [], []
+    for origin, urls in buckets.items():
+        start = len(entries)
+        entries.extend(sorted(urls.values(),
+                              key=lambda i: -len(services[i].url)))
+        origins.extend([intern(origin), start, len(entries)])
+
+    origin_table = [NONE] * _slots(len(buckets))
+    for o, origin in enumerate(buckets):
+        _insert(origin_table, origin.encode(), o)
+
+    # Linear probing keeps the services of a key in insertion order
+    endpoint_table = [NONE] * _slots(len(services))
+    for i, s in enumerate(services):
+        _insert(endpoint_table,
+                _endpoint_key(s.service_type, s.interface, s.cloud), i)
+
+    offsets, blob = [0], bytearray()
+    for s in strings:
+        blob += s.encode()
+        offsets.append(len(blob))
+    blob += b'\0' * (-len(blob) % 4)
+
+    def pack(values: List[int]) -> bytes:
+        return struct.pack(f'<{len(values)}I', *values)
+
+    return b''.join([
+        _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(strings),
+                     len(blob), len(services), len(buckets), len(entries),
+                     len(origin_table), len(endpoint_table)),
+        pack(offsets), bytes(blob), *(pack(c) for c in columns),
+        pack(origins), pack(entries), pack(origin_table),
+        pack(endpoint_table)])
+
+
+def write_snapshot(services: List[Service], path: str) -> None:
+    """Writes the snapshot of `services` at `path`.
+
+    The file is replaced by a rename, so that processes that mapped the
+    previous snapshot keep on reading it safely.
+
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(dump_snapshot(services))
+    os.replace(tmp_path, path)
+
+
+class _SnapshotUrlIndex(UrlIndex):
+    """UrlIndex of a SnapshotCatalog, whose buckets are loaded on use."""
+
+    def __init__(self, catalog: 'SnapshotCatalog'):
+        self._catalog = catalog
+        self._buckets = {}
+
+    def lookup(self, url: str) -> Optional[Service]:
+        origin = _origin(url)
+        bucket = self._buckets.get(origin)
+        if bucket is None:
+            bucket = self._catalog._load_bucket(origin)
+            if bucket is None:
+                return None
+            self._buckets[origin] = bucket
+
+        lengths, urls = bucket
+        for length in lengths:
+            service = urls.get(url[:length])
+            if service is not None:
+                return service
+
+        return None
+
+    def services(self) -> List[Service]:
+        c = self._catalog
+        return [c._service(i) for i in c._entries]
+
+
+class SnapshotCatalog(Catalog):
+    """Catalog read from a snapshot (see `dump_snapshot`).
+
+    `buf` is the snapshot, typically a mmap. Services are built the first
+    time a lookup finds them, so loading a snapshot does not depend on the
+    number of services. Raises `ValueError` if `buf` is not a snapshot of
+    the current version.
+
+    """
+
+    def __init__(self, buf: Union[bytes, mmap.mmap]):
+        mv = memoryview(buf)
+        if len(mv) < _HEADER.size or mv[:8] != SNAPSHOT_MAGIC:
+            raise ValueError('Not a services snapshot')
+        (_, version, nb_strings, blob_size, nb_services, nb_origins,
+         nb_entries, origin_slots, endpoint_slots) = _HEADER.unpack_from(mv)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f'Unsupported snapshot version {version}')
+
+        sizes = [4 * (nb_strings + 1), blob_size] + [4 * nb_services] * 4 + [
+            4 * 3 * nb_origins, 4 * nb_entries, 4 * origin_slots,
+            4 * endpoint_slots]
+        if _HEADER.size + sum(sizes) != len(mv):
+            raise ValueError('Truncated services snapshot')
+        sections, offset = [], _HEADER.size
+        for size in sizes:
+            sections.append(mv[offset:offset + size])
+            offset += size
+
+        self._offsets = _u32(sections[0])
+        self._blob = sections[1]
+        self._columns = [_u32(c) for c in sections[2:6]]
+        self._origins = _u32(sections[6])
+        self._entries = _u32(sections[7])
+        self._origin_table = _u32(sections[8])
+        self._endpoint_table = _u32(sections[9])
+
+        self._strings: List[Optional[str]] = [None] * nb_strings
+        self._services: List[Optional[Service]] = [None] * nb_services
+        # Filled on demand, unlike those of Catalog
+        self.endpoint_groups: Dict[Tuple[str, str, str],
+                                   Tuple[Service, ...]] = {}
+        self.identity_headers: Dict[str, Optional[Dict[str, str]]] = {}
+        self.url_index = _SnapshotUrlIndex(self)
+        self.plans = {}
+        self.precomputed = False
+
+    def _string(self, i: int) -> Optional[str]:
+        if i == NONE:
+            return None
+        s = self._strings[i]
+        if s is None:
+            s = self._strings[i] = sys.intern(str(
+                self._blob[self._offsets[i]:self._offsets[i + 1]], 'utf-8'))
+        return s
+
+    def _service(self, i: int) -> Service:
+        s = self._services[i]
+        if s is None:
+            service_type, cloud, url, interface = (
+                self._string(c[i]) for c in self._columns)
+            s = self._services[i] = Service(
+                service_type=service_type, cloud=cloud, url=url,
+                interface=interface)
+        return s
+
+    def _load_bucket(self, origin: str
+                     ) -> Optional[Tuple[List[int], Dict[str, Service]]]:
+        for o in _probe(self._origin_table, origin.encode()):
+            if self._string(self._origins[3 * o]) == origin:
+                start, end = self._origins[3 * o + 1:3 * o + 3]
+                urls = {}
+                for i in self._entries[start:end]:
+                    service = self._service(i)
+                    urls[service.url] = service
+                return sorted({len(u) for u in urls}, reverse=True), urls
+        return None
+
+    @property
+    def services(self) -> List[Service]:
+        return [self._service(i) for i in range(len(self._services))]
+
+    @property
+    def endpoints(self) -> Dict[Tuple[str, str, str], Service]:
+        endpoints = {}
+        for s in self.services:
+            endpoints.setdefault((s.service_type, s.interface, s.cloud), s)
+        return endpoints
+
+    @property
+    def identities(self) -> Dict[str, Service]:
+        return {cloud: s for (service_type, interface, cloud), s
+                in self.endpoints.items()
+                if service_type == 'identity' and interface == 'admin'}
+
+    def lookup_endpoint(self, service_type: str, interface: str,
+                        cloud: str) -> Service:
+        return self.lookup_endpoints(service_type, interface, cloud)[0]
+
+    def lookup_endpoints(self, service_type: str, interface: str,
+                         cloud: str) -> Tuple[Service, ...]:
+        key = (service_type, interface, cloud)
+        group = self.endpoint_groups.get(key)
+        if group is None:
+            services = {}
+            for i in sorted(_probe(self._endpoint_table, _endpoint_key(
+                    service_type, interface, cloud))):
+                s = self._service(i)
+                if (s.service_type, s.interface, s.cloud) == key:
+                    services[s] = None
+            if not services:
+                raise StopIteration(
+                    f'No {interface} {service_type} in {cloud}')
+            group = self.endpoint_groups[key] = tuple(services)
+        return group
+
+    def lookup_identity(self, cloud: str) -> Service:
+        try:
+            return self.lookup_endpoint('identity', 'admin', cloud)
+        except StopIteration:
+            raise StopIteration(f'No admin identity in {cloud}')
+
+    def get_identity_headers(self, cloud: str) -> Optional[Dict[str, str]]:
+        try:
+            return self.identity_headers[cloud]
+        except KeyError:
+            pass
+
+        try:
+            s = self.lookup_identity(cloud)
+            headers = {'X-Identity-Cloud': s.cloud, 'X-Identity-Url': s.url}
+        except StopIteration:
+            headers = None
+        self.identity_headers[cloud] = headers
+        return headers
+
+
+def load_snapshot(path: str) -> SnapshotCatalog:
+    """Maps the snapshot at `path` into a SnapshotCatalog."""
+    with open(path, 'rb') as f:
+        return SnapshotCatalog(mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Converts a list of services into a snapshot.')
+    parser.add_argument('services',
+                        help='services.json, or the output of `openstack '
+                             'endpoint list --format json`')
+    parser.add_argument('snapshot', help='Snapshot to write')
+    args = parser.parse_args(argv)
+
+    services = load_services(args.services)
+    write_snapshot(services, args.snapshot)
+    print(f'Wrote {len(services)} services to {args.snapshot}')
+
+
+if __name__ == "__main__":
+    main()
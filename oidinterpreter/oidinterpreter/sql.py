@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+SQLite catalog of services
+
+Services live in the `services` table of a SQLite database, indexed on
+(service_type, interface, region) and on url, so that teams add, change or
+remove their endpoints with plain SQL. Triggers log the id of each changed
+service in the `changelog` table. An OidInterpreter loaded from the
+database (i.e., `get_oidinterpreter('sql:///path/to/services.db')`) then
+follows the changelog and patches its Catalog with the changed services
+only, instead of reloading all of them. A patch still copies the rows and
+the indexes, so its cost grows with the number of services, e.g., one
+change of 10k services costs about 2% of a full load (see
+`benchmarks/bench_sql.py`).
+
+As in the other catalogs, the first service, i.e., the one with the
+lowest id, wins when several have the same url or the same
+(service_type, interface, region).
+
+Import a `services.json`, or the output of `openstack endpoint list
+--format json`, with
+
+  python -m oidinterpreter.sql services.json services.db
+"""
+import argparse
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote
+import weakref
+
+from .oidinterpreter import Catalog, Service, _origin, load_services
+
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS services (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    service_type TEXT NOT NULL,
+    interface TEXT,
+    region TEXT NOT NULL,
+    url TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS services_endpoint
+    ON services (service_type, interface, region, id);
+CREATE INDEX IF NOT EXISTS services_url ON services (url, id);
+
+CREATE TABLE IF NOT EXISTS changelog (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    service_id INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS services_insert AFTER INSERT ON services
+BEGIN
+    INSERT INTO changelog (service_id) VALUES (new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS services_update AFTER UPDATE ON services
+BEGIN
+    INSERT INTO changelog (service_id) VALUES (old.id);
+    INSERT INTO changelog (service_id) SELECT new.id WHERE new.id != old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS services_delete AFTER DELETE ON services
+BEGIN
+    INSERT INTO changelog (service_id) VALUES (old.id);
+END;
+"""
+
+_COLUMNS = 'id, service_type, region, url, interface'
+
+# SQLITE_MAX_VARIABLE_NUMBER of SQLite before 3.32, e.g., as shipped with
+# Python 3.7
+MAX_VARIABLES = 999
+
+# Changes may be trimmed, but their sequence numbers are never reused
+_LAST_SEQ = """
+SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'changelog'),
+                0)
+"""
+
+EndpointKey = Tuple[str, Optional[str], str]
+
+
+def _service(row: Tuple[int, str, str, str, Optional[str]]) -> Service:
+    _, service_type, region, url, interface = row
+    return Service(service_type=service_type, cloud=region, url=url,
+                   interface=interface)
+
+
+class SqlProvider:
+    """Services of the SQLite database at `path`.
+
+    The database is created if need be and `create`, and raises
+    `sqlite3.OperationalError` if it cannot be opened otherwise. Its schema
+    is created if need be. A SqlProvider may be used from several threads.
+
+    """
+
+    def __init__(self, path: str, create: bool = True):
+        self.path = path
+        try:
+            self._conn = sqlite3.connect(
+                path if create else f'file:{quote(path)}?mode=rw',
+                uri=not create, check_same_thread=False,
+                isolation_level=None)
+        except sqlite3.OperationalError as e:
+            raise sqlite3.OperationalError(
+                f'Cannot open the SQLite database {path}: {e}') from e
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Runs the statements of the block in one transaction.
+
+        Reads of the block see a consistent state of the database. A nested
+        block runs in the transaction of the outer one.
+
+        """
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute('BEGIN')
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute('COMMIT')
+
+    def add(self, services: Iterable[Service]) -> List[int]:
+        """Adds `services`, returns their ids."""
+        with self.transaction() as conn:
+            return [conn.execute(
+                'INSERT INTO services (service_type, region, url, interface)'
+                ' VALUES (?, ?, ?, ?)',
+                (s.service_type, s.cloud, s.url, s.interface)).lastrowid
+                for s in services]
+
+    def update(self, service_id: int, service: Service) -> None:
+        """Replaces the service of `service_id` by `service`."""
+        with self.transaction() as conn:
+            conn.execute(
+                'UPDATE services SET service_type = ?, region = ?, url = ?,'
+                ' interface = ? WHERE id = ?',
+                (service.service_type, service.cloud, service.url,
+                 service.interface, service_id))
+
+    def remove(self, service_ids: Iterable[int]) -> None:
+        """Removes the services of `service_ids`."""
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM services WHERE id = ?',
+                             ((i,) for i in service_ids))
+
+    def services(self, service_ids: Optional[Iterable[int]] = None
+                 ) -> Dict[int, Service]:
+        """Gets the services, or only those of `service_ids`, by id."""
+        with self._lock:
+            if service_ids is None:
+                rows = self._conn.execute(
+                    f'SELECT {_COLUMNS} FROM services ORDER BY id')
+            else:
+                # One query per chunk of MAX_VARIABLES ids
+                ids = sorted(service_ids)
+                rows = []
+                for i in range(0, len(ids), MAX_VARIABLES):
+                    chunk = ids[i:i + MAX_VARIABLES]
+                    rows.extend(self._conn.execute(
+                        f'SELECT {_COLUMNS} FROM services WHERE id IN '
+                        f'({", ".join("?" * len(chunk))}) ORDER BY id',
+                        chunk))
+            return {row[0]: _service(row) for row in rows}
+
+    def lookup_endpoint(self, service_type: str, interface: Optional[str],
+                        cloud: str) -> Optional[Service]:
+        """Finds the Service of `service_type`, `interface` and `cloud`."""
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT {_COLUMNS} FROM services WHERE service_type = ? '
+                f'AND interface IS ? AND region = ? ORDER BY id LIMIT 1',
+                (service_type, interface, cloud)).fetchone()
+        return _service(row) if row else None
+
+    def lookup_endpoints(self, service_type: str, interface: Optional[str],
+                         cloud: str) -> Tuple[Service, ...]:
+        """Finds all the Services of `service_type`, `interface` and
+        `cloud`, the one of `lookup_endpoint` first."""
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {_COLUMNS} FROM services WHERE service_type = ? '
+                f'AND interface IS ? AND region = ? ORDER BY id',
+                (service_type, interface, cloud))
+            return tuple(dict.fromkeys(_service(row) for row in rows))
+
+    def lookup_url(self, url: str, exact: bool = False) -> Optional[Service]:
+        """Finds the Service with the longest url that prefixes `url`.
+
+        With `exact`, finds the Service of `url` itself. The lookup walks
+        the url index downward from `url`: the greatest url below the
+        current bound is either a prefix of `url`, hence the longest one, or
+        shares a prefix with `url` that becomes the next bound. A Service
+        of another origin than `url` never matches, as in UrlIndex.
+
+        """
+        with self._lock:
+            if exact:
+                row = self._conn.execute(
+                    f'SELECT {_COLUMNS} FROM services WHERE url = ? '
+                    f'ORDER BY id LIMIT 1', (url,)).fetchone()
+                return _service(row) if row else None
+
+            bound = url
+            while True:
+                candidate, = self._conn.execute(
+                    'SELECT MAX(url) FROM services WHERE url <= ?',
+                    (bound,)).fetchone()
+                if candidate is None:
+                    return None
+                if url.startswith(candidate):
+                    if len(candidate) < len(_origin(url)):
+                        return None
+                    return self.lookup_url(candidate, exact=True)
+                bound = os.path.commonprefix([candidate, url])
+
+    def last_seq(self) -> int:
+        """Gets the sequence number of the last change, 0 if none."""
+        with self._lock:
+            return self._conn.execute(_LAST_SEQ).fetchone()[0]
+
+    def changes(self, since: int) -> Tuple[int, Optional[Set[int]]]:
+        """Gets the ids of the services changed after the change `since`.
+
+        Returns the sequence number of the last change, and the ids, or
+        None if changes have been trimmed since then (see `trim`).
+
+        """
+        with self.transaction() as conn:
+            last = conn.execute(_LAST_SEQ).fetchone()[0]
+            first = conn.execute(
+                'SELECT MIN(seq) FROM changelog').fetchone()[0]
+            if last > since and (first is None or first > since + 1):
+                return last, None
+            return last, {i for (i,) in conn.execute(
+                'SELECT DISTINCT service_id FROM changelog '
+                'WHERE seq > ? AND seq <= ?', (since, last))}
+
+    def trim(self, until: int) -> None:
+        """Forgets the changes up to the change `until`.
+
+        Interpreters that didn't follow these changes yet reload all the
+        services.
+
+        """
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM changelog WHERE seq <= ?', (until,))
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class SqlCatalog(Catalog):
+    """Catalog of a SqlProvider at the change `seq`.
+
+    `rows` are the services by id, as in the database.
+
+    """
+
+    def __init__(self, rows: Dict[int, Service], seq: int = 0):
+        super().__init__(list(rows.values()))
+        self.rows = rows
+        self.seq = seq
+
+    @classmethod
+    def load(cls, provider: SqlProvider) -> 'SqlCatalog':
+        """Loads all the services of `provider`."""
+        with provider.transaction():
+            seq = provider.last_seq()
+            rows = provider.services()
+        return cls(rows=rows, seq=seq)
+
+    def sync(self, provider: SqlProvider) -> 'SqlCatalog':
+        """Follows the changes of `provider` since this Catalog.
+
+        Returns this Catalog if nothing changed, a patched copy of it
+        otherwise (see `Catalog.patched`), or a new Catalog if the changes
+        have been trimmed in the meantime. Only the changed services are
+        read from the database, but the rows and the indexes are copied.
+
+        """
+        with provider.transaction():
+            seq, ids = provider.changes(self.seq)
+            if seq == self.seq:
+                return self
+            if ids is None:
+                LOG.info(f'Changes of {provider.path} have been trimmed, '
+                         f'reload all services')
+                return SqlCatalog.load(provider)
+
+            changed = provider.services(ids)
+            rows = dict(self.rows)
+            urls: Set[str] = set()
+            keys: Set[EndpointKey] = set()
+            for i in ids:
+                for s in (rows.get(i), changed.get(i)):
+                    if s is not None:
+                        urls.add(s.url)
+                        keys.add((s.service_type, s.interface, s.cloud))
+                if i in changed:
+                    rows[i] = changed[i]
+                else:
+                    rows.pop(i, None)
+
+            # The first service of each changed url and the services of
+            # each changed endpoint may now be other ones, ask the database.
+            catalog = self.patched(
+                list(rows.values()),
+                {url: provider.lookup_url(url, exact=True) for url in urls},
+                {key: provider.lookup_endpoints(*key) for key in keys})
+
+        catalog.rows = rows
+        catalog.seq = seq
+        return catalog
+
+
+# One provider per database, and the last Catalog loaded from it, that the
+# next load patches.
+_PROVIDERS: Dict[str, SqlProvider] = {}
+_LAST_CATALOGS: 'weakref.WeakValueDictionary[str, SqlCatalog]' = \
+    weakref.WeakValueDictionary()
+_LOCK = threading.Lock()
+
+
+def get_provider(path: str) -> SqlProvider:
+    """Gets the SqlProvider of the database at `path`.
+
+    Raises `sqlite3.OperationalError` if there is no database at `path`,
+    rather than loading an empty one.
+
+    """
+    path = os.path.realpath(path)
+    with _LOCK:
+        provider = _PROVIDERS.get(path)
+        if provider is None:
+            provider = _PROVIDERS[path] = SqlProvider(path, create=False)
+        return provider
+
+
+def load_sql(path: str) -> SqlCatalog:
+    """Loads the Catalog of the database at `path`.
+
+    Patches the last Catalog loaded from `path` if any, so that a load only
+    reads the services changed since then (see `SqlCatalog.sync`).
+
+    """
+    provider = get_provider(path)
+    with _LOCK:
+        last = _LAST_CATALOGS.get(provider.path)
+    catalog = (last.sync(provider) if last is not None
+               else SqlCatalog.load(provider))
+    with _LOCK:
+        _LAST_CATALOGS[provider.path] = catalog
+    return catalog
+
+
+def sql_stamp(path: str) -> int:
+    """Identifies the content of the database at `path` by its last change
+    (see `ServicesWatcher`).
+
+    """
+    return get_provider(path).last_seq()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description='Imports a list of services into a SQLite database.')
+    parser.add_argument('services',
+                        help='services.json, or the output of `openstack '
+                             'endpoint list --format json`')
+    parser.add_argument('database', help='SQLite database, created if need '
+                                         'be')
+    args = parser.parse_args(argv)
+
+    services = load_services(args.services)
+    provider = SqlProvider(args.database)
+    provider.add(services)
+    provider.close()
+    print(f'Imported {len(services)} services into {args.database}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Cache of token validations of the ScopeProxy
+
+Services validate tokens against the identity cloud of the scope (see
+`X-Identity-Url`). When that cloud is another one, each validation is a WAN
+round trip to its Keystone. The TokenCache keeps the responses of
+`GET /v3/auth/tokens` to a remote Keystone, so that validating a token
+again costs no more than with a local Keystone.
+
+Validations are keyed by the identity cloud, the request target, the token
+to validate (`X-Subject-Token`) and the token of the caller (`X-Auth-Token`),
+both without scope. A validation is thus only served to a caller that
+already got it from Keystone. A valid token is kept until the earliest of
+its `expires_at` and `ttl`, and an invalid one (404) `negative_ttl`
+seconds, if any. Revocations that go through the proxy are applied at once:
+`DELETE /v3/auth/tokens` drops the validations of the revoked token, and
+any other change to the remote Keystone (e.g., a user disabled, a role
+unassigned) drops all the validations of that cloud. `ttl` bounds how long
+a revocation made elsewhere goes unnoticed, as `token_cache_time` of the
+keystone middleware.
+"""
+from collections import OrderedDict
+from datetime import datetime, timezone
+import json
+import time
+from typing import Hashable, List, Optional, Tuple
+
+from .cache import CacheStats, CachedResponse
+
+
+TOKEN_TTL = 60.0
+TOKEN_NEGATIVE_TTL = 0.0
+TOKEN_CACHE_SIZE = 4096
+TOKEN_MAX_BODY_SIZE = 256 * 1024
+
+
+def token_expiry(body: bytes) -> Optional[float]:
+    """Gets the `expires_at` of the token of a validation, as a timestamp.
+
+    Returns None if `body` has no such date.
+
+    """
+    try:
+        expires_at = json.loads(body)['token']['expires_at']
+        expiry = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if expiry.tzinfo is None:
+        expiry = expiry.replace(tzinfo=timezone.utc)
+    return expiry.timestamp()
+
+
+class TokenCache:
+    """LRU cache of at most `size` token validations.
+
+    Keys are tuples (cloud, target, subject token, caller token). Valid
+    tokens are kept at most `ttl` seconds, invalid ones `negative_ttl`
+    seconds (0 to not keep them). Validations with a body larger than
+    `max_body_size` are not kept. The cache is not thread-safe: it belongs
+    to the event loop of one proxy.
+
+    """
+
+    def __init__(self, ttl: float = TOKEN_TTL,
+                 negative_ttl: float = TOKEN_NEGATIVE_TTL,
+                 size: int = TOKEN_CACHE_SIZE,
+                 max_body_size: int = TOKEN_MAX_BODY_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.max_body_size = max_body_size
+        self.stats = CacheStats()
+        self._entries: 'OrderedDict[Hashable, CachedResponse]' = \
+            OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def caches(self, status: int) -> bool:
+        "Tells whether validations answered with `status` are kept."
+        return status == 200 or (status == 404 and self.negative_ttl > 0)
+
+    def lookup(self, key: Tuple[str, str, str, str]
+               ) -> Optional[CachedResponse]:
+        """Gets the validation of `key`, None if there is no fresh one."""
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= time.monotonic():
+            del self._entries[key]
+            self.stats.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.stats.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry
+
+    def store(self, key: Tuple[str, str, str, str], status_line: str,
+              header_list: List[Tuple[str, str]], body: bytes) -> bool:
+        """Keeps the validation of `key`, returns whether it has been kept.
+
+        A valid token is only kept when its expiry is known.
+
+        """
+        status = int(status_line.split(' ', 2)[1])
+        if status == 404:
+            ttl = self.negative_ttl
+        elif status == 200:
+            expiry = token_expiry(body)
+            ttl = (0.0 if expiry is None
+                   else min(self.ttl, expiry - time.time()))
+        else:
+            ttl = 0.0
+        if ttl <= 0 or len(body) > self.max_body_size:
+            return False
+
+        self._entries[key] = CachedResponse(
+            status_line=status_line, headers=header_list, body=body,
+            expires=time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        self.stats.stores += 1
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+        return True
+
+    def revoke(self, cloud: str, token: str) -> None:
+        """Drops the validations of `token` in `cloud`.
+
+        Validations made with `token` as caller token are dropped as well.
+
+        """
+        self._drop(lambda key: key[0] == cloud and token in key[2:])
+
+    def invalidate(self, cloud: str) -> None:
+        "Drops all the validations of `cloud`."
+        self._drop(lambda key: key[0] == cloud)
+
+    def _drop(self, p) -> None:
+        stale = [key for key in self._entries if p(key)]
+        for key in stale:
+            del self._entries[key]
+        self.stats.invalidations += len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Pre-fork workers for the ScopeProxy
+
+The parent process builds the ScopeProxy, with all its indexes and rewrite
+plans, then forks the workers. Workers thus share the routing table with
+the parent through copy-on-write pages, and `gc.freeze` keeps the garbage
+collector from touching, hence copying, these pages. Each worker listens
+on the same addresses with `SO_REUSEPORT`, so the kernel spreads new
+connections across workers.
+
+Threads don't survive a fork, so each worker watches the services file on
+its own when reloads are enabled.
+
+A worker that dies within RESPAWN_MIN_UPTIME seconds of its start is
+respawned after a delay that doubles on each such death, from
+RESPAWN_DELAY up to RESPAWN_MAX_DELAY seconds. The parent gives up after
+RESPAWN_MAX_DEATHS of them in a row, e.g., when workers cannot bind their
+addresses, rather than forking in a loop.
+"""
+import asyncio
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .proxy import ScopeProxy, serve
+
+
+LOG = logging.getLogger(__name__)
+
+RESPAWN_MIN_UPTIME = 10.0
+RESPAWN_DELAY = 0.1
+RESPAWN_MAX_DELAY = 10.0
+RESPAWN_MAX_DEATHS = 5
+
+
+def _run_worker(proxy: ScopeProxy, binds: List[str],
+                reload_interval: float) -> None:
+    "Serves `proxy` in the current (forked) process until SIGTERM."
+    async def worker():
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, task.cancel)
+        try:
+            await serve(proxy, binds, reload_interval, reuse_port=True)
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(worker())
+
+
+def fork_workers(proxy: ScopeProxy, binds: List[str], nb_workers: int,
+                 reload_interval: float = 0.0) -> None:
+    """Serves `proxy` on `binds` with `nb_workers` processes.
+
+    Respawns workers that die unexpectedly, with a backoff for those that
+    die right after their start, and stops all of them on SIGTERM or
+    SIGINT. `reload_interval` is given to `serve` in each worker.
+
+    Raises `RuntimeError` once a worker died RESPAWN_MAX_DEATHS times in a
+    row right after its start, after having stopped the other ones.
+
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError('SO_REUSEPORT is not supported on this platform')
+
+    # Build everything before the fork, so that workers share it
+    proxy.oidi.precompute_plans()
+    gc.collect()
+    gc.freeze()
+
+    workers: Dict[int, int] = {}
+    started_at: Dict[int, float] = {}
+    deaths: Dict[int, int] = {}
+    # Respawn time of dead workers, by worker id
+    respawns: Dict[int, float] = {}
+    stopping = False
+
+    def spawn(worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                _run_worker(proxy, binds, reload_interval)
+            except BaseException:
+                LOG.exception(f'Worker {worker_id} failed')
+                status = 1
+            finally:
+                os._exit(status)
+        workers[pid] = worker_id
+        started_at[worker_id] = time.monotonic()
+        LOG.info(f'Start worker {worker_id} (pid {pid})')
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def wait(timeout: Optional[float]) -> Optional[Tuple[int, int]]:
+        """Waits for a worker to die, for at most `timeout` seconds.
+
+        Returns its pid and status, None on timeout or without workers.
+
+        """
+        if timeout is None:
+            try:
+                return os.wait()
+            except ChildProcessError:
+                return None
+        deadline = time.monotonic() + timeout
+        while not stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = 0, 0
+            if pid:
+                return pid, status
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.05))
+        return None
+
+    for worker_id in range(nb_workers):
+        spawn(worker_id)
+
+    while workers or (respawns and not stopping):
+        now = time.monotonic()
+        for worker_id, at in list(respawns.items()):
+            if at <= now and not stopping:
+                del respawns[worker_id]
+                spawn(worker_id)
+
+        timeout = (max(min(respawns.values()) - now, 0.0)
+                   if respawns and not stopping else None)
+        died = wait(timeout)
+        if died is None:
+            if timeout is None:
+                # No worker left
+                break
+            continue
+        pid, status = died
+        worker_id = workers.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+
+        uptime = time.monotonic() - started_at[worker_id]
+        if uptime >= RESPAWN_MIN_UPTIME:
+            deaths[worker_id] = 0
+            LOG.warning(f'Worker {worker_id} (pid {pid}) died with status '
+                        f'{status}, respawn it')
+            spawn(worker_id)
+            continue
+
+        deaths[worker_id] = deaths.get(worker_id, 0) + 1
+        if deaths[worker_id] >= RESPAWN_MAX_DEATHS:
+            stop(signal.SIGTERM, None)
+            while workers:
+                try:
+                    workers.pop(os.wait()[0], None)
+                except ChildProcessError:
+                    break
+            raise RuntimeError(
+                f'Worker {worker_id} died {deaths[worker_id]} times in a '
+                f'row right after its start, give up')
+
+        delay = min(RESPAWN_DELAY * 2 ** (deaths[worker_id] - 1),
+                    RESPAWN_MAX_DELAY)
+        LOG.warning(f'Worker {worker_id} (pid {pid}) died with status '
+                    f'{status} after {uptime:.1f}s, respawn it in '
+                    f'{delay:.1f}s')
+        respawns[worker_id] = time.monotonic() + delay
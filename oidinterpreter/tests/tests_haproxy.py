@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+from requests import Request
+
+from oidinterpreter import (Catalog, OidInterpreter, encode_scope,
+                            oss2services, parse_scope, SCOPE_DELIM)
+from oidinterpreter.haproxy import (IDENTITIES_MAP, SERVICES_MAP,
+                                    identities_map, main, read_map,
+                                    services_map, write_maps)
+
+try:
+    # HAProxy embeds Lua 5.3
+    from lupa.lua53 import LuaRuntime
+except ImportError:
+    LuaRuntime = None
+
+
+LUA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))), 'playbooks', 'haproxy', 'lua')
+
+CLOUDS = {'CloudOne': '10.0.0.1', 'CloudTwo': '10.0.0.2',
+          'CloudThree': '10.0.0.3'}
+
+# As in `services.json.j2`
+SERVICES = [
+    {'Service Type': service_type, 'Interface': interface,
+     'URL': f'{ip}:{path}', 'Region': cloud}
+    for cloud, ip in CLOUDS.items()
+    for service_type, interface, path in [
+        ('identity', 'admin', '8888/identity'),
+        ('identity', 'public', '8888/identity'),
+        ('compute', 'public', '8888/compute/v2.1'),
+        ('compute_legacy', 'public', '8888/compute/v2/'),
+        ('placement', 'public', '8888/placement'),
+        ('image', 'public', '8888/image'),
+        ('network', 'public', '9797')]]
+
+# Scopes that `parse_scope` refuses, and the proxy answers 400
+BAD_SCOPES = ['1:', '1:;image=CloudTwo', '1:CloudOne;image',
+              '1:CloudOne;=CloudTwo', '1:CloudOne;image=',
+              '1:CloudOne;;image=CloudTwo', '{"image": 1}', '["CloudTwo"]',
+              '"CloudTwo"', '{', 'CloudTwo']
+
+# The part of the HAProxy Lua API used by the scripts: `core`, `Map` and
+# the `txn` of a request. `Map._beg` returns the first entry of the map
+# file that prefixes the looked up string, as HAProxy does, so that the
+# tests rely on the order of the map file.
+FAKE_HAPROXY = r"""
+local files, env = ...
+local open, getenv = io.open, os.getenv
+io.open = function(filename, mode) return open(files[filename] or filename,
+                                               mode) end
+os.getenv = function(name) return env[name] or getenv(name) end
+
+fetches = {}
+core = {err = 3, warning = 4, info = 6, debug = 7}
+function core.log(level, message) end
+function core.register_fetches(name, f) fetches[name] = f end
+
+Map = {_beg = 'beg', _str = 'str'}
+function Map.new(filename, method)
+  local entries, values = {}, {}
+  for line in io.lines(filename) do
+    local key, value = string.match(line, '^(%S+)%s+(.-)%s*$')
+    if key then
+      table.insert(entries, {key, value})
+      if values[key] == nil then values[key] = value end
+    end
+  end
+
+  local map = {}
+  function map:lookup(str)
+    if method ~= Map._beg then return values[str] end
+    for _, entry in ipairs(entries) do
+      if string.sub(str, 1, #entry[1]) == entry[1] then return entry[2] end
+    end
+  end
+  return map
+end
+
+-- Makes the txn of a request to `base` with `headers` (lower case
+-- names), and the table of the headers it sets.
+function make_txn(base, headers)
+  local set = {}
+  local sf, http = {}, {}
+  function sf:base() return base end
+  function sf:path() return string.match(base, '/.*$') or '/' end
+  function sf:req_fhdr(name) return headers[name] end
+  function http:req_get_headers()
+    local all = {}
+    for name, value in pairs(headers) do all[name] = {[0] = value} end
+    return all
+  end
+  function http:req_set_header(name, value) set[name] = value end
+  return {sf = sf, http = http}, set
+end
+"""
+
+
+class LuaHAProxy:
+    """Runs a Lua script of HAProxy out of HAProxy.
+
+    `files` renames the files the script opens, and `env` sets its
+    environment variables.
+
+    """
+
+    def __init__(self, script: str, files=None, env=None):
+        self.lua = LuaRuntime(unpack_returned_tuples=True)
+        self.lua.execute(f"package.path = '{LUA_DIR}/?.lua;' "
+                         f".. package.path")
+        self.lua.execute(FAKE_HAPROXY, self.lua.table_from(files or {}),
+                         self.lua.table_from(env or {}))
+        self.lua.require(script)
+        self._fetch = self.lua.globals().fetches['interpret_scope']
+        self._make_txn = self.lua.globals().make_txn
+
+    def interpret_scope(self, base, headers, cloud):
+        """Returns the backend of a request to `base` (`Host` and path)
+        with `headers` in `cloud`, and the headers set on the way."""
+        headers = dict(headers, Host=base.partition('/')[0])
+        txn, set_headers = self._make_txn(base, self.lua.table_from(
+            {name.lower(): value for name, value in headers.items()}))
+        return self._fetch(txn, cloud), dict(set_headers.items())
+
+
+class TestHAProxyMaps(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.services = oss2services(SERVICES)
+        self.catalog = Catalog(self.services)
+
+    def test_maps(self):
+        entries = services_map(self.catalog)
+        self.assertEqual(len(entries), 6 * len(CLOUDS))
+        self.assertEqual(entries[0], ('10.0.0.1:8888/compute/v2.1',
+                                      'compute public'))
+        self.assertEqual(entries, sorted(entries,
+                                         key=lambda e: -len(e[0])))
+
+        # Admin and public identities share a url, the admin one wins
+        self.assertIn(('10.0.0.2:8888/identity', 'identity admin'), entries)
+        self.assertNotIn(('10.0.0.2:8888/identity', 'identity public'),
+                         entries)
+        self.assertEqual(identities_map(self.catalog), [
+            (cloud, f'{ip}:8888/identity') for cloud, ip in CLOUDS.items()])
+
+        catalog = Catalog(oss2services([
+            {'Service Type': 'compute', 'Interface': 'public',
+             'URL': '10.0.0.1:8888/compute v2', 'Region': 'CloudOne'}]))
+        self.assertRaises(ValueError, services_map, catalog)
+
+    def test_write_maps(self):
+        paths = write_maps(self.services, self.dir)
+        self.assertEqual(read_map(paths[SERVICES_MAP]),
+                         services_map(self.catalog))
+        self.assertEqual(read_map(paths[IDENTITIES_MAP]),
+                         identities_map(self.catalog))
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         [IDENTITIES_MAP, SERVICES_MAP])
+
+        services_path = os.path.join(self.dir, 'services.json')
+        with open(services_path, 'w') as f:
+            json.dump({'services': SERVICES}, f)
+        maps = os.path.join(self.dir, 'maps')
+        with contextlib.redirect_stdout(io.StringIO()):
+            main([services_path, maps])
+        self.assertEqual(read_map(os.path.join(maps, SERVICES_MAP)),
+                         services_map(self.catalog))
+
+    @unittest.skipIf(LuaRuntime is None, 'lupa is not installed')
+    def test_lua_parity(self):
+        write_maps(self.services, self.dir)
+        lua = LuaHAProxy('interpret_scope_maps',
+                         env={'OIDI_MAPS': self.dir})
+        oidi = OidInterpreter(self.services)
+        service_types = sorted({s.service_type for s in self.services})
+
+        # Scopes as (default cloud, bindings)
+        scopes = [(None, {}), ('CloudTwo', {}),
+                  ('CloudOne', {'compute': 'CloudThree',
+                                'identity': 'CloudTwo'}),
+                  ('CloudThree', {'image': 'CloudOne',
+                                  'network': 'CloudTwo'})]
+
+        nb_checks = 0
+        for cloud, ip in CLOUDS.items():
+            # HAProxy of `cloud` gets requests to services of `cloud`,
+            # those without scope are scoped to `cloud`
+            urls = [f'{s["URL"]}/v1/resources' for s in SERVICES
+                    if s['Region'] == cloud]
+            for url in urls:
+                for (default, bindings), encoding, in_token in [
+                        (scope, encoding, in_token) for scope in scopes
+                        for encoding in ['compact', 'json']
+                        for in_token in [False, True]]:
+                    default = default or cloud
+                    if encoding == 'compact':
+                        raw_scope = encode_scope(bindings, default)
+                    else:
+                        raw_scope = json.dumps({
+                            st: bindings.get(st, default)
+                            for st in service_types})
+                    headers = {
+                        'X-Subject-Token': f'subject{SCOPE_DELIM}'
+                                           f'{raw_scope}'}
+                    if in_token:
+                        headers['X-Auth-Token'] = \
+                            f'token{SCOPE_DELIM}{raw_scope}'
+                    elif bindings or default != cloud:
+                        headers['X-Scope'] = raw_scope
+                    else:
+                        # No scope at all
+                        headers['X-Auth-Token'] = 'token'
+                        raw_scope = encode_scope({}, cloud)
+
+                    backend, set_headers = lua.interpret_scope(
+                        url, headers, cloud)
+
+                    req = Request('GET', url, dict(headers,
+                                                   **{'X-Scope': raw_scope}))
+                    rewrite = oidi.rewrite(req)
+                    target = rewrite.plan.target
+                    scope = parse_scope(rewrite.headers['X-Scope'])[0]
+                    expected = {
+                        name: value for name, value in rewrite.headers.items()
+                        if name.endswith('-Token')}
+                    expected.update({
+                        'X-Identity-Cloud':
+                            rewrite.headers['X-Identity-Cloud'],
+                        'X-Identity-Url':
+                            f'http://{rewrite.headers["X-Identity-Url"]}'})
+
+                    msg = f'{url} {headers}'
+                    self.assertEqual(backend, f'{target.cloud}_'
+                                     f'{target.service_type}_'
+                                     f'{target.interface}', msg)
+                    self.assertEqual(json.loads(set_headers.pop('X-Scope')),
+                                     {st: scope[st] for st in service_types},
+                                     msg)
+                    self.assertEqual(set_headers, expected, msg)
+                    nb_checks += 1
+
+        self.assertEqual(nb_checks, 3 * 7 * 16)
+
+        # Requests to anything else go to the transparent backend
+        self.assertEqual(lua.interpret_scope(
+            '10.0.0.1:8080/index.html', {}, 'CloudOne'), ('transparent', {}))
+        self.assertFalse(oidi.rewrite(
+            Request('GET', '10.0.0.1:8080/index.html', {
+                'X-Scope': '1:CloudTwo'})))
+
+    @unittest.skipIf(LuaRuntime is None, 'lupa is not installed')
+    def test_lua_longest_prefix(self):
+        # HAProxy takes the first prefix of the map file, which is sorted
+        # by decreasing url length
+        services = self.services + oss2services([
+            {'Service Type': 'volume', 'Interface': 'public',
+             'URL': '10.0.0.1:8888/compute', 'Region': 'CloudOne'}])
+        write_maps(services, self.dir)
+        lua = LuaHAProxy('interpret_scope_maps',
+                         env={'OIDI_MAPS': self.dir})
+        for url, backend in [
+                ('10.0.0.1:8888/compute/v2.1/servers',
+                 'CloudOne_compute_public'),
+                ('10.0.0.1:8888/compute/v3/volumes',
+                 'CloudOne_volume_public')]:
+            self.assertEqual(
+                lua.interpret_scope(url, {}, 'CloudOne')[0], backend)
+
+    @unittest.skipIf(LuaRuntime is None, 'lupa is not installed')
+    def test_lua_bad_scope(self):
+        write_maps(self.services, self.dir)
+        lua = LuaHAProxy('interpret_scope_maps',
+                         env={'OIDI_MAPS': self.dir})
+        url = '10.0.0.1:8888/compute/v2.1/servers'
+        for raw_scope in BAD_SCOPES:
+            with self.assertRaises(ValueError, msg=raw_scope):
+                parse_scope(raw_scope)
+            token = f'token{SCOPE_DELIM}{raw_scope}'
+            for headers in [{'X-Scope': raw_scope}, {'X-Auth-Token': token}]:
+                self.assertEqual(lua.interpret_scope(url, headers, 'CloudOne'),
+                                 ('bad_scope', {}), raw_scope)
+
+        # Bad scopes are not memoized in place of good ones
+        self.assertEqual(lua.interpret_scope(
+            url, {'X-Scope': '1:CloudTwo'}, 'CloudOne')[0],
+            'CloudTwo_compute_public')
+
+
+@unittest.skipIf(LuaRuntime is None, 'lupa is not installed')
+class TestInterpretScopeLua(TestCase):
+    """Tests `interpret_scope.lua` in CloudOne."""
+
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'services': SERVICES}, f)
+        self.lua = LuaHAProxy('interpret_scope', files={
+            '/etc/haproxy/services.json': path})
+
+    def interpret(self, path, headers):
+        return self.lua.interpret_scope(f'10.0.0.1:8888{path}', headers,
+                                        'CloudOne')
+
+    def test_json_scope(self):
+        backend, headers = self.interpret('/compute/v2.1/servers', {
+            'X-Scope': json.dumps({'compute': 'CloudTwo',
+                                   'identity': 'CloudThree'})})
+        self.assertEqual(backend, 'CloudTwo_compute_public')
+        self.assertEqual(json.loads(headers['X-Scope']), {
+            'compute': 'CloudTwo', 'identity': 'CloudThree',
+            'image': 'CloudOne', 'network': 'CloudOne',
+            'placement': 'CloudOne'})
+        self.assertEqual(headers['X-Identity-Cloud'], 'CloudThree')
+        self.assertEqual(headers['X-Identity-Url'],
+                         'http://10.0.0.3:8888/identity')
+
+        # Without scope, everything is in the current cloud
+        backend, headers = self.interpret('/image/v2/images', {})
+        self.assertEqual(backend, 'CloudOne_image_public')
+        self.assertEqual(set(json.loads(headers['X-Scope']).values()),
+                         {'CloudOne'})
+
+    def test_compact_scope(self):
+        # Services missing in a compact scope go to its default cloud, not
+        # to the current one
+        raw_scope = encode_scope({'image': 'CloudThree'}, 'CloudTwo')
+        self.assertEqual(raw_scope, '1:CloudTwo;image=CloudThree')
+        for path, backend in [('/compute/v2.1/servers',
+                               'CloudTwo_compute_public'),
+                              ('/image/v2/images', 'CloudThree_image_public')]:
+            self.assertEqual(self.interpret(path, {'X-Scope': raw_scope}),
+                             (backend, {
+                                 'X-Scope': mock.ANY,
+                                 'X-Identity-Cloud': 'CloudTwo',
+                                 'X-Identity-Url':
+                                     'http://10.0.0.2:8888/identity'}))
+
+        _, headers = self.interpret('/image/v2/images', {'X-Scope': raw_scope})
+        self.assertEqual(json.loads(headers['X-Scope']), {
+            'compute': 'CloudTwo', 'identity': 'CloudTwo',
+            'image': 'CloudThree', 'network': 'CloudTwo',
+            'placement': 'CloudTwo'})
+
+    def test_percent_encoded_scope(self):
+        raw_scope = '1:Cloud%54wo;im%61ge=Cloud%4Fne;network=Cloud%3BFour'
+        self.assertEqual(dict(parse_scope(raw_scope)[0]),
+                         {'image': 'CloudOne', 'network': 'Cloud;Four'})
+        backend, headers = self.interpret('/image/v2/images',
+                                          {'X-Scope': raw_scope})
+        self.assertEqual(backend, 'CloudOne_image_public')
+        self.assertEqual(json.loads(headers['X-Scope']), {
+            'compute': 'CloudTwo', 'identity': 'CloudTwo',
+            'image': 'CloudOne', 'network': 'Cloud;Four',
+            'placement': 'CloudTwo'})
+
+    def test_scope_in_token(self):
+        token = f'token{SCOPE_DELIM}1:CloudOne;identity=CloudTwo'
+        backend, headers = self.interpret('/identity/v3/auth/tokens', {
+            'X-Auth-Token': token, 'X-Subject-Token': f'subject{SCOPE_DELIM}'
+                                                      f'1:CloudOne'})
+        self.assertEqual(backend, 'CloudTwo_identity_admin')
+        self.assertEqual(headers['X-Auth-Token'], 'token')
+        self.assertEqual(headers['X-Subject-Token'], 'subject')
+        self.assertEqual(headers['X-Identity-Cloud'], 'CloudTwo')
+        self.assertEqual(json.loads(headers['X-Scope'])['identity'],
+                         'CloudTwo')
+
+        # Only identity loses the scope of X-Auth-Token
+        backend, headers = self.interpret('/compute/v2.1/servers',
+                                          {'X-Auth-Token': token})
+        self.assertEqual(backend, 'CloudOne_compute_public')
+        self.assertNotIn('X-Auth-Token', headers)
+
+        # X-Scope wins over the scope of the token
+        backend, _ = self.interpret('/compute/v2.1/servers', {
+            'X-Auth-Token': f'token{SCOPE_DELIM}1:CloudTwo',
+            'X-Scope': '1:CloudThree'})
+        self.assertEqual(backend, 'CloudThree_compute_public')
+
+    def test_bad_scope(self):
+        for raw_scope in BAD_SCOPES:
+            self.assertEqual(
+                self.interpret('/compute/v2.1/servers',
+                               {'X-Scope': raw_scope}),
+                ('bad_scope', {}), raw_scope)
+
+
+if __name__ == "__main__":
+    unittest.main()
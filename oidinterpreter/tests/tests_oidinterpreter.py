@@ -6,16 +6,25 @@
 #     /_/
 # Make your OpenStacks Collaborative
 
+import collections
 import copy
 import json
 import logging
 import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
 from unittest import TestCase, mock
+from urllib.request import urlopen
 
 from requests import Request
 
-from oidinterpreter import (OidInterpreter, get_oidinterpreter, oss2services,
+from oidinterpreter import (Balancer, CircuitBreaker, CloudUnavailable,
+                            Metrics, OidInterpreter, Service, UrlIndex,
+                            canonical_uri, encode_scope, get_oidinterpreter,
+                            oss2services, parse_scope, serve_metrics,
                             SCOPE_DELIM)
 
 
@@ -75,6 +84,43 @@ class TestInterpreter(TestCase):
         with self.assertRaises(StopIteration):
             self.the_oidi.lookup_service(lambda s: False)
 
+    def test_lookup_endpoint(self):
+        c2 = self.the_c2service
+        res_service = self.the_oidi.lookup_endpoint(
+            c2.service_type, c2.interface, c2.cloud)
+        self.assertEqual(res_service, c2)
+
+        # Admin identity of a cloud
+        self.assertEqual(self.the_oidi.lookup_identity('CloudTwo'),
+                         self.the_i2service)
+
+        # Bad lookups
+        with self.assertRaises(StopIteration):
+            self.the_oidi.lookup_endpoint('compute', 'admin', 'CloudTwo')
+        with self.assertRaises(StopIteration):
+            self.the_oidi.lookup_identity('CloudThree')
+
+    def test_service(self):
+        c1 = self.the_c1service
+        same = Service(service_type=''.join(['com', 'pute']),
+                       cloud=''.join(['Cloud', 'One']), url=c1.url,
+                       interface='public')
+        self.assertEqual(same, c1)
+        self.assertEqual(hash(same), hash(c1))
+        self.assertEqual({c1: 1}[same], 1)
+
+        # Strings are shared and services have no __dict__
+        self.assertIs(same.service_type, c1.service_type)
+        self.assertIs(same.cloud, c1.cloud)
+        self.assertFalse(hasattr(same, '__dict__'))
+
+        # Services are still immutable, and copied as before
+        with self.assertRaises(AttributeError):
+            same.url = 'http://example.org'
+        self.assertEqual(copy.copy(c1), c1)
+        self.assertEqual(pickle.loads(pickle.dumps(c1)), c1)
+        self.assertIsNone(Service('image', 'CloudOne', c1.url).interface)
+
     def test_is_scoped_url(self):
         # `the_c2service` is scoped
         res_service = self.the_oidi.is_scoped_url(
@@ -85,6 +131,29 @@ class TestInterpreter(TestCase):
         self.assertFalse(self.the_oidi.is_scoped_url(
             Request('GET', 'https://wikipedia.org')))
 
+    def test_url_index(self):
+        legacy = Service(service_type='compute_legacy', cloud='CloudOne',
+                         url='http://192.168.141.245:8888/compute/v2',
+                         interface='public')
+        index = UrlIndex([legacy, self.the_c1service, self.the_i1service])
+
+        # The longest url wins whatever the order of services
+        self.assertEqual(
+            index.lookup(f'{self.the_c1service.url}/servers'),
+            self.the_c1service)
+        self.assertEqual(
+            index.lookup(f'{legacy.url}/servers'), legacy)
+
+        # Services with the same url resolve to the first one
+        self.assertEqual(
+            self.the_oidi.url_index.lookup(self.the_i1service.url),
+            self.the_i1service)
+
+        # Unknown origin, or unknown path under a known origin
+        self.assertIsNone(index.lookup('http://192.168.141.245:9999/image'))
+        self.assertIsNone(index.lookup('http://192.168.141.245:8888/image'))
+        self.assertIsNone(index.lookup('http://192.168.141.245:8888'))
+
     def test_get_scope(self):
         the_scope = {'identity': 'CloudOne', 'compute': 'CloudOne'}
 
@@ -112,6 +181,96 @@ class TestInterpreter(TestCase):
         res_scope = self.the_oidi.get_scope(req)
         self.assertFalse(res_scope)
 
+        # A scope is read-only
+        headers = {'X-Scope': json.dumps(the_scope)}
+        req = Request('GET', self.the_c2service.url, headers)
+        with self.assertRaises(TypeError):
+            self.the_oidi.get_scope(req)['compute'] = 'CloudTwo'
+
+        # A scope is an object of strings
+        for bad_scope in ['["CloudOne"]', '{"compute": 1}', '{"compute"']:
+            req = Request('GET', self.the_c2service.url,
+                          {'X-Scope': bad_scope})
+            with self.assertRaises(ValueError):
+                self.the_oidi.get_scope(req)
+
+    def test_compact_scope(self):
+        the_scope = {'identity': 'CloudOne', 'compute': 'CloudTwo',
+                     'image': 'Cloud;Three'}
+        raw_scope = encode_scope(the_scope, 'CloudOne')
+        self.assertEqual(raw_scope, '1:CloudOne;compute=CloudTwo;'
+                                    'image=Cloud%3BThree')
+        self.assertLess(len(raw_scope), len(json.dumps(the_scope)))
+
+        # Services missing in the scope are bound to its default cloud
+        scope, scope_header = parse_scope(raw_scope)
+        self.assertEqual(scope_header, raw_scope)
+        self.assertEqual(dict(scope), {'compute': 'CloudTwo',
+                                       'image': 'Cloud;Three'})
+        self.assertEqual(scope['identity'], 'CloudOne')
+        self.assertEqual(scope.get('network'), 'CloudOne')
+        with self.assertRaises(TypeError):
+            scope['compute'] = 'CloudOne'
+
+        # Interpret a compact scope of X-Auth-Token, and keep it as is
+        token = f'{self.the_token}{SCOPE_DELIM}1:CloudTwo;compute=CloudOne'
+        req = Request('GET', f'{self.the_c2service.url}/servers',
+                      {'X-Auth-Token': token})
+        self.the_oidi.interpret(req)
+        self.assertEqual(req.url, f'{self.the_c1service.url}/servers')
+        self.assertEqual(req.headers['X-Scope'], '1:CloudTwo;compute=CloudOne')
+        self.assertEqual(req.headers['X-Identity-Cloud'], 'CloudTwo')
+
+        # A compact scope with no binding still binds to its default cloud
+        req = Request('GET', self.the_c2service.url, {'X-Scope': '1:CloudOne'})
+        self.the_oidi.interpret(req)
+        self.assertEqual(req.url, self.the_c1service.url)
+
+        for bad_scope in ['1:', '1:;compute=CloudOne', '1:CloudOne;compute',
+                          '1:CloudOne;=CloudTwo']:
+            with self.assertRaises(ValueError):
+                parse_scope(bad_scope)
+
+    def test_scope_cache(self):
+        oidi = OidInterpreter(self.the_oidi.services, scope_cache_size=2)
+        the_scope = {'identity': 'CloudOne', 'compute': 'CloudTwo'}
+        headers = {'X-Scope': json.dumps(the_scope),
+                   'X-Auth-Token':
+                       f'{self.the_token}{SCOPE_DELIM}{json.dumps(the_scope)}'}
+
+        # The raw scope is parsed once, whatever the header it comes from
+        for _ in range(3):
+            oidi.interpret(Request('GET', self.the_c2service.url,
+                                   copy.copy(headers)))
+        oidi.get_scope(Request('GET', self.the_c2service.url,
+                               {'X-Auth-Token': headers['X-Auth-Token']}))
+        hits, misses, maxsize, currsize = oidi.scope_cache_info()
+        self.assertEqual((hits, misses, maxsize, currsize), (3, 1, 2, 1))
+
+        # The cache is bounded
+        for cloud in ['CloudOne', 'CloudTwo', 'CloudThree']:
+            oidi.get_scope(Request('GET', self.the_c2service.url,
+                                   {'X-Scope': json.dumps({'image': cloud})}))
+        self.assertEqual(oidi.scope_cache_info()[3], 2)
+
+        # The cache is shared across threads
+        raw_scopes = [json.dumps({'compute': f'Cloud{i}'}) for i in range(8)]
+
+        def get_scopes():
+            for raw_scope in raw_scopes * 50:
+                scope = oidi.get_scope(Request(
+                    'GET', self.the_c2service.url, {'X-Scope': raw_scope}))
+                self.assertEqual(json.dumps(dict(scope)), raw_scope)
+
+        threads = [threading.Thread(target=get_scopes) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        hits, misses, _, currsize = oidi.scope_cache_info()
+        self.assertEqual(hits + misses, 4 + 3 + 4 * 8 * 50)
+        self.assertEqual(currsize, 2)
+
     def test_interpret(self):
         the_scope = {'identity': 'CloudOne', 'compute': 'CloudOne'}
 
@@ -139,6 +298,9 @@ class TestInterpreter(TestCase):
         req = Request('GET', self.the_c2service.url, copy.copy(headers))
         self.the_oidi.interpret(req)
         self.assertEqual(req.url, self.the_c1service.url)
+        self.assertEqual(req.headers['X-Identity-Cloud'], 'CloudOne')
+        self.assertEqual(req.headers['X-Identity-Url'],
+                         self.the_i1service.url)
 
         # Scope + Identity ⇒ Delete Scope in token
         headers = {
@@ -149,6 +311,336 @@ class TestInterpreter(TestCase):
         self.assertEqual(req.url, self.the_i1service.url)
         self.assertEqual(req.headers['X-Auth-Token'], self.the_token)
 
+    def test_rewrite(self):
+        the_scope = {'identity': 'CloudOne', 'compute': 'CloudOne'}
+        headers = {
+            'X-Auth-Token':
+                f'{self.the_token}{SCOPE_DELIM}{json.dumps(the_scope)}'}
+
+        # No scope, no rewrite
+        self.assertFalse(self.the_oidi.rewrite(
+            Request('GET', self.the_i1service.url)))
+
+        # The rewrite only holds the changes and leaves the request as it is
+        req = Request('GET', self.the_i2service.url, copy.copy(headers))
+        rewrite = self.the_oidi.rewrite(req)
+        self.assertEqual(rewrite.url, self.the_i1service.url)
+        self.assertDictEqual(rewrite.headers, {
+            'X-Auth-Token': self.the_token,
+            'X-Scope': json.dumps(the_scope),
+            'X-Identity-Cloud': 'CloudOne',
+            'X-Identity-Url': self.the_i1service.url})
+        self.assertEqual(rewrite.plan.target, self.the_i1service)
+        self.assertEqual(req.url, self.the_i2service.url)
+        self.assertDictEqual(req.headers, headers)
+
+    def test_interpret_many(self):
+        the_scope = {'identity': 'CloudOne', 'compute': 'CloudOne'}
+        good = {'X-Scope': json.dumps(the_scope)}
+        unknown_cloud = {'X-Scope': json.dumps({'compute': 'CloudThree'})}
+        bad_json = {'X-Scope': '{"compute"'}
+        reqs = [Request('GET', self.the_c2service.url, copy.copy(good)),
+                Request('GET', 'https://wikipedia.org', copy.copy(good)),
+                Request('GET', self.the_c2service.url, unknown_cloud),
+                Request('GET', self.the_c2service.url, bad_json),
+                Request('GET', self.the_c2service.url),
+                Request('GET', f'{self.the_c2service.url}/servers',
+                        copy.copy(good))]
+
+        res = self.the_oidi.interpret_many(reqs)
+
+        # Results are in the order of requests, and errors don't stop the
+        # batch
+        self.assertEqual(len(res), len(reqs))
+        self.assertEqual(res[0].url, self.the_c1service.url)
+        self.assertFalse(res[1])
+        self.assertIsInstance(res[2], StopIteration)
+        self.assertIsInstance(res[3], ValueError)
+        self.assertFalse(res[4])
+        self.assertEqual(res[5].url, f'{self.the_c1service.url}/servers')
+
+        # Requests are updated in place as with `interpret`
+        expected = Request('GET', self.the_c2service.url, copy.copy(good))
+        self.the_oidi.interpret(expected)
+        self.assertEqual(reqs[0].url, expected.url)
+        self.assertDictEqual(reqs[0].headers, expected.headers)
+        self.assertEqual(reqs[2].url, self.the_c2service.url)
+
+    def test_metrics(self):
+        oidi = OidInterpreter(self.the_oidi.services)
+        headers = {'X-Scope': '1:CloudOne'}
+
+        # Without metrics, nothing is recorded
+        oidi.interpret(Request('GET', self.the_c2service.url, headers))
+        self.assertIsNone(oidi.metrics)
+
+        oidi.metrics = Metrics()
+        for _ in range(3):
+            oidi.interpret(Request('GET', self.the_c2service.url,
+                                   copy.copy(headers)))
+        oidi.interpret(Request('GET', self.the_c2service.url))
+        oidi.interpret_many([
+            Request('GET', self.the_i2service.url, copy.copy(headers)),
+            Request('GET', 'https://wikipedia.org', copy.copy(headers))])
+
+        # Each phase of `rewrite` is timed, and decisions are counted
+        phases = oidi.metrics.phases
+        self.assertEqual(phases['scope_parse'].count, 4)
+        self.assertEqual(phases['url_match'].count, 4)
+        self.assertEqual(phases['target_resolve'].count, 3)
+        self.assertEqual(phases['header_rewrite'].count, 3)
+        self.assertGreater(phases['scope_parse'].sum, 0)
+        self.assertDictEqual(oidi.metrics.decisions, {
+            ('CloudTwo', 'CloudOne', 'compute'): 3,
+            ('CloudTwo', 'CloudOne', 'identity'): 1})
+        self.assertEqual(oidi.metrics.passthrough, 2)
+
+        # The exposition is in the Prometheus text format
+        exposition = oidi.metrics.exposition()
+        self.assertIn('# TYPE oidinterpreter_phase_seconds histogram\n',
+                      exposition)
+        self.assertIn('oidinterpreter_phase_seconds_bucket{phase='
+                      '"header_rewrite",le="+Inf"} 3\n', exposition)
+        self.assertIn('oidinterpreter_decisions_total{source_cloud='
+                      '"CloudTwo",target_cloud="CloudOne",service_type='
+                      '"compute"} 3\n', exposition)
+        self.assertIn('oidinterpreter_passthrough_total 2\n', exposition)
+
+        server = serve_metrics(oidi.metrics, '127.0.0.1:0')
+        try:
+            port = server.server_address[1]
+            with urlopen(f'http://127.0.0.1:{port}/metrics') as res:
+                self.assertEqual(res.read().decode(),
+                                 oidi.metrics.exposition())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_alternatives(self):
+        compute1_bis = Service(
+            service_type='compute', cloud='CloudOne', interface='public',
+            url='http://192.168.141.246:8888/compute/v2.1')
+        oidi = OidInterpreter(self.the_oidi.services + [compute1_bis])
+        headers = {'X-Scope': '1:CloudOne'}
+
+        def target():
+            req = Request('GET', self.the_c2service.url, copy.copy(headers))
+            return oidi.rewrite(req).plan.target
+
+        # Several endpoints of a service give alternative plans
+        self.assertEqual(oidi.catalog.lookup_endpoints(
+            'compute', 'public', 'CloudOne'),
+            (self.the_c1service, compute1_bis))
+        plan = oidi.get_plan(self.the_c2service, 'CloudOne')
+        self.assertEqual([p.target for p in plan.alternatives],
+                         [self.the_c1service, compute1_bis])
+        self.assertEqual(
+            oidi.get_plan(self.the_c2service, 'CloudTwo').alternatives, ())
+
+        # Without balancer, requests go to the first endpoint
+        self.assertEqual(target(), self.the_c1service)
+
+        # With a balancer, to the fastest and least loaded one
+        balancer = oidi.balancer = Balancer(inter=0.1)
+        balancer.started(self.the_c1service)
+        balancer.finished(self.the_c1service, 0.05, True)
+        self.assertEqual(target(), compute1_bis)
+        balancer.started(compute1_bis)
+        balancer.finished(compute1_bis, 0.01, True)
+        self.assertEqual(target(), compute1_bis)
+        for _ in range(10):
+            balancer.started(compute1_bis)
+        self.assertEqual(target(), self.the_c1service)
+        for _ in range(10):
+            balancer.finished(compute1_bis, 0.01, True)
+
+        # Down after 5 failures, and probed every `inter` seconds
+        for _ in range(5):
+            balancer.started(compute1_bis)
+            balancer.finished(compute1_bis, 0.001, False)
+        stats = balancer.stats()[compute1_bis]
+        self.assertFalse(stats.healthy)
+        self.assertEqual((stats.requests, stats.failures), (16, 5))
+        self.assertEqual(target(), self.the_c1service)
+        time.sleep(0.1)
+        self.assertEqual(target(), compute1_bis)
+        for _ in range(2):
+            balancer.started(compute1_bis)
+            balancer.finished(compute1_bis, 0.001, True)
+        self.assertTrue(balancer.stats()[compute1_bis].healthy)
+
+        # Patches update the alternatives
+        catalog = oidi.catalog.patched(
+            self.the_oidi.services, {compute1_bis.url: None},
+            {('compute', 'public', 'CloudOne'): (self.the_c1service,)})
+        self.assertEqual(catalog.get_plan(self.the_c2service,
+                                          'CloudOne').alternatives, ())
+
+    def test_breaker(self):
+        breaker = CircuitBreaker(failures=3, reset_timeout=0.1)
+        oidi = OidInterpreter(self.the_oidi.services, breaker=breaker)
+
+        def request(cloud):
+            return Request('GET', self.the_c1service.url,
+                           {'X-Scope': f'1:{cloud}'})
+
+        # Closed until 3 failures in a row
+        for ok in [False, False, True, False, False]:
+            oidi.rewrite(request('CloudTwo'))
+            breaker.finished('CloudTwo', ok)
+        self.assertEqual(breaker.state('CloudTwo'), 'closed')
+        breaker.finished('CloudTwo', False)
+        self.assertEqual(breaker.state('CloudTwo'), 'open')
+
+        # Open: requests to CloudTwo fail fast, others go on
+        with self.assertRaises(CloudUnavailable) as cm:
+            oidi.rewrite(request('CloudTwo'))
+        self.assertEqual(cm.exception.cloud, 'CloudTwo')
+        self.assertTrue(0 < cm.exception.retry_after <= 0.1)
+        self.assertTrue(oidi.rewrite(request('CloudOne')))
+        self.assertFalse(oidi.rewrite(
+            Request('GET', self.the_c1service.url)))
+        results = oidi.interpret_many(
+            [request('CloudTwo'), request('CloudOne')])
+        self.assertIsInstance(results[0], CloudUnavailable)
+        self.assertTrue(results[1])
+
+        # Half-open: one probe goes, that opens the circuit again if it fails
+        time.sleep(0.1)
+        self.assertEqual(breaker.state('CloudTwo'), 'half-open')
+        self.assertTrue(oidi.rewrite(request('CloudTwo')))
+        self.assertRaises(CloudUnavailable, oidi.rewrite, request('CloudTwo'))
+        breaker.finished('CloudTwo', False)
+        self.assertEqual(breaker.state('CloudTwo'), 'open')
+
+        # And closes it if it succeeds
+        time.sleep(0.1)
+        self.assertTrue(oidi.rewrite(request('CloudTwo')))
+        breaker.finished('CloudTwo', True)
+        self.assertEqual(breaker.state('CloudTwo'), 'closed')
+        self.assertTrue(oidi.rewrite(request('CloudTwo')))
+        circuit = breaker.stats()['CloudTwo']
+        self.assertEqual((circuit.trips, circuit.rejected), (2, 3))
+
+    def test_iinterpret(self):
+        the_scope = {'identity': 'CloudOne', 'compute': 'CloudOne'}
+        headers = {'X-Scope': json.dumps(the_scope)}
+        body = b'0' * 1024
+
+        for req in [Request('PUT', self.the_c2service.url,
+                            copy.copy(headers), data=body),
+                    Request('PUT', self.the_c2service.url,
+                            copy.copy(headers), data=body).prepare()]:
+            req2 = self.the_oidi.iinterpret(req)
+
+            # Same result as `interpret`, `req` is left untouched
+            self.assertEqual(req2.url, self.the_c1service.url)
+            self.assertEqual(req2.headers['X-Identity-Cloud'], 'CloudOne')
+            self.assertEqual(req.url, self.the_c2service.url)
+            self.assertNotIn('X-Identity-Cloud', req.headers)
+
+            # The body is shared, not copied
+            self.assertIs(getattr(req2, 'data', None) or req2.body,
+                          getattr(req, 'data', None) or req.body)
+
+    def test_rewrite_plan(self):
+        oidi = OidInterpreter(self.the_oidi.services)
+        the_scope = {'identity': 'CloudTwo', 'compute': 'CloudOne'}
+        headers = {'X-Scope': json.dumps(the_scope),
+                   'X-Subject-Token': self.the_token}
+
+        # Plans are computed once per (service, cloud)
+        plan = oidi.get_plan(self.the_c2service, 'CloudOne')
+        self.assertEqual(plan.target, self.the_c1service)
+        self.assertFalse(plan.clean_auth_token)
+        self.assertIs(oidi.get_plan(self.the_c2service, 'CloudOne'), plan)
+        self.assertTrue(
+            oidi.get_plan(self.the_i1service, 'CloudTwo').clean_auth_token)
+
+        # Only the prefix of the url is rewritten. A token without scope is
+        # kept as it is.
+        req = Request('GET', f'{self.the_c2service.url}/servers',
+                      copy.copy(headers))
+        oidi.interpret(req)
+        self.assertEqual(req.url, f'{self.the_c1service.url}/servers')
+        self.assertEqual(req.headers['X-Subject-Token'], self.the_token)
+        self.assertEqual(req.headers['X-Identity-Cloud'], 'CloudTwo')
+
+        # Services x clouds, but services with the same url only count once
+        self.assertEqual(oidi.precompute_plans(), 4 * 2)
+
+        # No equivalent service in the targeted cloud
+        with self.assertRaises(StopIteration):
+            oidi.get_plan(self.the_c2service, 'CloudThree')
+
+    def test_reload(self):
+        oidi = OidInterpreter(oss2services(SERVICES))
+        oidi.precompute_plans()
+        req = Request('GET', f'{self.the_c2service.url}/servers',
+                      {'X-Scope': json.dumps({'compute': 'CloudOne'})})
+        old_catalog = oidi.catalog
+        self.assertEqual(oidi.reload_stats.generation, 0)
+
+        # Move compute of CloudOne to another url
+        services = oss2services(SERVICES)
+        c1 = Service(service_type='compute', cloud='CloudOne',
+                     url='http://192.168.141.246:8774/v2.1',
+                     interface='public')
+        services[2] = c1
+        catalog = oidi.reload(services)
+
+        self.assertIs(oidi.catalog, catalog)
+        self.assertEqual(oidi.reload_stats.generation, 1)
+        self.assertEqual(oidi.reload_stats.reloads, 1)
+        self.assertGreater(oidi.reload_stats.last_duration, 0.0)
+        self.assertEqual(oidi.services, services)
+        self.assertEqual(oidi.rewrite(req).url, f'{c1.url}/servers')
+
+        # Plans of the new catalog are precomputed as the old ones were
+        self.assertTrue(catalog.precomputed)
+        self.assertEqual(len(catalog.plans), len(old_catalog.plans))
+
+        # The old catalog is untouched, for requests that still use it
+        self.assertEqual(
+            old_catalog.get_plan(self.the_c2service, 'CloudOne').target,
+            self.the_c1service)
+
+    def test_watch(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(SERVICES, f)
+
+        oidi = get_oidinterpreter(path, reload_interval=0.01)
+        self.addCleanup(oidi.watcher.stop)
+        self.assertEqual(len(oidi.services), len(SERVICES))
+
+        def wait_for(predicate):
+            deadline = time.monotonic() + 5
+            while not predicate():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+        # Replace the file by a rename, as most tools do
+        def replace(content):
+            with open(f'{path}.new', 'w') as f:
+                f.write(content)
+            os.replace(f'{path}.new', path)
+
+        replace(json.dumps(SERVICES[:3]))
+        wait_for(lambda: oidi.reload_stats.generation == 1)
+        self.assertEqual(oidi.services, oss2services(SERVICES[:3]))
+
+        # A bad file keeps the current services
+        replace('{"not": "a list"')
+        wait_for(lambda: oidi.watcher.failures == 1)
+        self.assertEqual(oidi.reload_stats.generation, 1)
+        self.assertEqual(oidi.services, oss2services(SERVICES[:3]))
+
+        replace(json.dumps(SERVICES))
+        wait_for(lambda: oidi.reload_stats.generation == 2)
+        self.assertEqual(oidi.services, oss2services(SERVICES))
+
     @mock.patch('builtins.open',
                 mock.mock_open(read_data=json.dumps(SERVICES)))
     def test_get_oidinterpreter(self):
@@ -163,15 +655,56 @@ class TestInterpreter(TestCase):
         res_oidi2 = get_oidinterpreter('file://./services.json')
         self.assertEqual(res_oidi, res_oidi2)
 
-        # An interpreter with another URI results in a new Interpreter
+        # An interpreter with another URI results in a new Interpreter, that
+        # shares the indexes of the first one since the files are the same
         res_oidi2 = get_oidinterpreter('file://.//another-file.json')
         self.assertNotEqual(res_oidi, res_oidi2)
+        self.assertIs(res_oidi.catalog, res_oidi2.catalog)
 
-        # An interpreter with another URI results in a new Interpreter hence,
-        # doesn't resolve the absolute path.
+        # URIs are canonicalised, so the absolute path, or no scheme, give
+        # the same Interpreter
         fp = os.path.abspath('./services.json')
-        res_oidi2 = get_oidinterpreter('file://' + fp)
-        self.assertNotEqual(res_oidi, res_oidi2)
+        self.assertIs(get_oidinterpreter('file://' + fp), res_oidi)
+        self.assertIs(get_oidinterpreter('./services.json'), res_oidi)
+        self.assertEqual(canonical_uri('file://./services.json'),
+                         'file://' + fp)
+
+    @mock.patch('oidinterpreter.oidinterpreter.SCOPE_INTERPRETERS_SIZE', 2)
+    @mock.patch('oidinterpreter.oidinterpreter.SCOPE_INTERPRETERS',
+                collections.OrderedDict())
+    def test_interpreters_registry(self):
+        nb_loads = 0
+
+        def load_services(path):
+            nonlocal nb_loads
+            nb_loads += 1
+            time.sleep(0.05)
+            return oss2services(SERVICES)
+
+        with mock.patch('oidinterpreter.oidinterpreter.load_services',
+                        load_services):
+            # Concurrent first accesses build the interpreter once
+            oidis = []
+            threads = [threading.Thread(target=lambda: oidis.append(
+                get_oidinterpreter('/tmp/one.json'))) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(nb_loads, 1)
+            self.assertTrue(all(o is oidis[0] for o in oidis))
+
+            # The least recently used interpreter is evicted
+            two = get_oidinterpreter('/tmp/two.json')
+            get_oidinterpreter('/tmp/one.json')
+            get_oidinterpreter('/tmp/three.json')
+            self.assertEqual(nb_loads, 3)
+            self.assertIs(get_oidinterpreter('/tmp/one.json'), oidis[0])
+            self.assertIsNot(get_oidinterpreter('/tmp/two.json'), two)
+            self.assertEqual(nb_loads, 4)
+
+        with self.assertRaises(ValueError):
+            get_oidinterpreter('ldap://services')
 
 
 if __name__ == "__main__":
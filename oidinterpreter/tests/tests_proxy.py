@@ -0,0 +1,814 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+
+import asyncio
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import tempfile
+import time
+import unittest
+from unittest import TestCase
+
+from oidinterpreter import SCOPE_DELIM, Balancer, CircuitBreaker
+from oidinterpreter.cache import ResponseCache
+from oidinterpreter.proxy import (get_scope_proxy, frontends, read_head,
+                                  split_address)
+from oidinterpreter.tokens import TokenCache
+
+
+LOG = logging.getLogger('oidinterpreter')
+LOG.setLevel(int(os.environ.get('LOG_LEVEL', logging.WARNING)))
+
+TOKEN = '507582fc-57c6-4bc7-a051-9fb3f269da70'
+
+
+class StubBackend:
+    """HTTP server that records requests and echoes them in json, after
+    `delay` seconds.
+
+    Validations of tokens answer 404 for tokens starting with `invalid`,
+    and tokens expire after `token_lifetime` seconds.
+
+    """
+
+    def __init__(self, name: str, delay: float = 0.0):
+        self.name = name
+        self.delay = delay
+        self.token_lifetime = 3600.0
+        self.requests = []
+        self.connections = 0
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(
+            self.handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.address = f'127.0.0.1:{port}'
+        return self.address
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await read_head(reader)
+                if head is None:
+                    break
+                await self.respond(reader, writer, *head)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, reader, writer, request_line, header_list):
+        method, target, _ = request_line.split(' ')
+        headers = {k.lower(): v for k, v in header_list}
+        body = await read_body(reader, headers)
+        self.requests.append((method, target, headers, body))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        if target.endswith('/stream'):
+            # Chunked response of 4 x 1 MiB
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n')
+            for _ in range(4):
+                writer.write(b'100000\r\n' + b'x' * (1 << 20) + b'\r\n')
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        elif target.partition('?')[0].endswith('/auth/tokens'):
+            subject = headers.get('x-subject-token', '')
+            expires_at = datetime.fromtimestamp(
+                time.time() + self.token_lifetime, timezone.utc)
+            payload = json.dumps({'token': {
+                'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                'backend': self.name}}).encode()
+            status = (b'404 Not Found' if subject.startswith('invalid')
+                      else b'200 OK')
+            writer.write(b'HTTP/1.1 %s\r\n'
+                         b'Content-Type: application/json\r\n'
+                         b'X-Subject-Token: %s\r\n'
+                         b'Content-Length: %d\r\n\r\n'
+                         % (status, subject.encode(), len(payload))
+                         + payload)
+        else:
+            payload = json.dumps({
+                'backend': self.name, 'method': method, 'target': target,
+                'headers': headers, 'body_length': len(body)}).encode()
+            no_store = (b'Cache-Control: no-store\r\n'
+                        if target.endswith('/no-store') else b'')
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: application/json\r\n' + no_store +
+                         b'Content-Length: %d\r\n\r\n' % len(payload)
+                         + payload)
+        await writer.drain()
+
+
+async def read_body(reader, headers) -> bytes:
+    "Reads and decodes a body, `headers` have lower case names."
+    if 'chunked' in headers.get('transfer-encoding', ''):
+        body = b''
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                await reader.readuntil(b'\r\n')
+                return body
+            body += (await reader.readexactly(size + 2))[:-2]
+    return await reader.readexactly(int(headers.get('content-length', 0)))
+
+
+async def request(reader, writer, method, target, headers=None, body=b''):
+    "Sends a request on a connection and reads its response."
+    headers = dict(headers or {})
+    if body and 'Transfer-Encoding' not in headers:
+        headers['Content-Length'] = str(len(body))
+    writer.write(
+        (f'{method} {target} HTTP/1.1\r\n' +
+         ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) +
+         '\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+    status_line, header_list = await read_head(reader)
+    res_headers = {k.lower(): v for k, v in header_list}
+    res_body = await read_body(reader, res_headers)
+    return int(status_line.split(' ')[1]), res_headers, res_body
+
+
+def services_json(cloud_one: str, cloud_two_backend: str,
+                  cloud_two_frontend: str):
+    "Makes a services.json for two clouds and compute/identity services."
+    services = []
+    for cloud, frontend, backend in [
+            ('CloudOne', '10.0.0.1:8888', cloud_one),
+            ('CloudTwo', cloud_two_frontend, cloud_two_backend)]:
+        for service_type, interface, path in [
+                ('identity', 'admin', '/identity'),
+                ('identity', 'public', '/identity'),
+                ('compute', 'public', '/compute/v2.1'),
+                ('image', 'public', '/image')]:
+            services.append({
+                'Service Type': service_type, 'Interface': interface,
+                'URL': f'{frontend}{path}', 'Region': cloud,
+                'Frontend': frontend, 'Backend': backend})
+    return {'services': services}
+
+
+def close_loop(loop):
+    "Cancels the remaining tasks of `loop` and closes it."
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+class TestScopeProxy(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.backend_one = StubBackend('CloudOne')
+        self.frontend_two = StubBackend('CloudTwo')
+        self.transparent = StubBackend('transparent')
+        self.await_(self.backend_one.start())
+        self.await_(self.frontend_two.start())
+        self.await_(self.transparent.start())
+
+        fd, self.services_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(services_json(self.backend_one.address,
+                                    '10.0.2.15:80',
+                                    self.frontend_two.address), f)
+
+        self.proxy = get_scope_proxy(self.services_path, 'CloudOne')
+        self.servers = self.await_(self.proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[0].sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+        for stub in [self.backend_one, self.frontend_two, self.transparent]:
+            stub.server.close()
+        close_loop(self.loop)
+        os.remove(self.services_path)
+
+    def await_(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def connect(self):
+        return await asyncio.open_connection('127.0.0.1', self.port)
+
+    async def one_request(self, *args, **kwargs):
+        reader, writer = await self.connect()
+        try:
+            return await request(reader, writer, *args, **kwargs)
+        finally:
+            writer.close()
+
+    def test_split_address(self):
+        self.assertEqual(split_address('10.0.2.15:80'), ('10.0.2.15', 80))
+        self.assertEqual(split_address('10.0.2.15'), ('10.0.2.15', 80))
+        self.assertEqual(split_address('[::1]:8888'), ('::1', 8888))
+
+    def test_frontends(self):
+        self.assertEqual(frontends(self.proxy), ['10.0.0.1:8888'])
+
+    def test_route(self):
+        # No scope: the local backend, with the default scope
+        status, _, body = self.await_(self.one_request(
+            'GET', '/compute/v2.1/servers', {'Host': '10.0.0.1:8888'}))
+        res = json.loads(body)
+        self.assertEqual(status, 200)
+        self.assertEqual(res['backend'], 'CloudOne')
+        self.assertEqual(res['target'], '/compute/v2.1/servers')
+        self.assertEqual(json.loads(res['headers']['x-scope'])['compute'],
+                         'CloudOne')
+        self.assertEqual(res['headers']['host'], '10.0.0.1:8888')
+        self.assertEqual(res['headers']['x-identity-url'],
+                         'http://10.0.0.1:8888/identity')
+        self.assertIn('x-forwarded-for', res['headers'])
+
+        # Scope on CloudTwo: the frontend of CloudTwo, with its Host
+        scope = json.dumps({'compute': 'CloudTwo'})
+        status, _, body = self.await_(self.one_request(
+            'GET', '/compute/v2.1/servers',
+            {'Host': '10.0.0.1:8888',
+             'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}{scope}'}))
+        res = json.loads(body)
+        self.assertEqual(res['backend'], 'CloudTwo')
+        self.assertEqual(res['headers']['host'], self.frontend_two.address)
+        self.assertEqual(json.loads(res['headers']['x-scope']),
+                         {'compute': 'CloudTwo', 'identity': 'CloudOne',
+                          'image': 'CloudOne'})
+        self.assertEqual(res['headers']['x-identity-cloud'], 'CloudOne')
+
+        # Identity loses the scope of its token
+        scope = json.dumps({'identity': 'CloudTwo'})
+        _, _, body = self.await_(self.one_request(
+            'GET', '/identity/v3',
+            {'Host': '10.0.0.1:8888',
+             'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}{scope}'}))
+        res = json.loads(body)
+        self.assertEqual(res['backend'], 'CloudTwo')
+        self.assertEqual(res['headers']['x-auth-token'], TOKEN)
+
+        # A compact scope binds missing services to its default cloud,
+        # and backends get it in json
+        _, _, body = self.await_(self.one_request(
+            'GET', '/compute/v2.1/servers',
+            {'Host': '10.0.0.1:8888',
+             'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:CloudTwo;'
+                             f'compute=CloudOne'}))
+        res = json.loads(body)
+        self.assertEqual(res['backend'], 'CloudOne')
+        self.assertEqual(json.loads(res['headers']['x-scope']),
+                         {'compute': 'CloudOne', 'identity': 'CloudTwo',
+                          'image': 'CloudTwo'})
+        self.assertEqual(res['headers']['x-identity-cloud'], 'CloudTwo')
+
+        # An absolute-form target, as sent through HTTP_PROXY, is
+        # interpreted on its authority
+        _, _, body = self.await_(self.one_request(
+            'GET', 'http://10.0.0.1:8888/image/v2/images?limit=2',
+            {'Host': '10.0.0.1:8888',
+             'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:CloudTwo'}))
+        res = json.loads(body)
+        self.assertEqual(res['backend'], 'CloudTwo')
+        self.assertEqual(res['target'], '/image/v2/images?limit=2')
+        self.assertEqual(res['headers']['x-auth-token'],
+                         f'{TOKEN}{SCOPE_DELIM}1:CloudTwo')
+        self.assertEqual(json.loads(res['headers']['x-scope'])['image'],
+                         'CloudTwo')
+
+        # Not a service: the transparent backend
+        _, _, body = self.await_(self.one_request(
+            'GET', '/index.html', {'Host': self.transparent.address}))
+        self.assertEqual(json.loads(body)['backend'], 'transparent')
+        _, _, body = self.await_(self.one_request(
+            'GET', f'http://{self.transparent.address}/index.html',
+            {'Host': 'ignored:8080'}))
+        res = json.loads(body)
+        self.assertEqual(res['backend'], 'transparent')
+        self.assertEqual(res['target'], '/index.html')
+
+        # A scope with an unknown cloud
+        status, _, _ = self.await_(self.one_request(
+            'GET', '/compute/v2.1/servers',
+            {'Host': '10.0.0.1:8888',
+             'X-Scope': json.dumps({'compute': 'CloudThree'})}))
+        self.assertEqual(status, 400)
+
+    def test_reload(self):
+        frontend_three = StubBackend('CloudTwoMoved')
+        self.await_(frontend_three.start())
+        self.addCleanup(frontend_three.server.close)
+        scope = json.dumps({'compute': 'CloudTwo'})
+
+        async def reload():
+            reader, writer = await self.connect()
+            _, _, body = await request(
+                reader, writer, 'GET', '/compute/v2.1/servers',
+                {'Host': '10.0.0.1:8888', 'X-Scope': scope})
+            self.assertEqual(json.loads(body)['backend'], 'CloudTwo')
+
+            # Move the frontend of CloudTwo
+            watcher = self.proxy.watch(0.01)
+            self.addCleanup(watcher.stop)
+            with open(self.services_path, 'w') as f:
+                json.dump(services_json(self.backend_one.address,
+                                        '10.0.2.15:80',
+                                        frontend_three.address), f)
+            deadline = time.monotonic() + 5
+            while self.proxy.oidi.reload_stats.generation != 1:
+                self.assertLess(time.monotonic(), deadline)
+                await asyncio.sleep(0.01)
+
+            # The next request on the same connection takes the new route
+            _, _, body = await request(
+                reader, writer, 'GET', '/compute/v2.1/servers',
+                {'Host': '10.0.0.1:8888', 'X-Scope': scope})
+            res = json.loads(body)
+            self.assertEqual(res['backend'], 'CloudTwoMoved')
+            self.assertEqual(res['headers']['host'], frontend_three.address)
+            writer.close()
+
+        self.await_(reload())
+        self.assertEqual(self.proxy.watcher.failures, 0)
+
+    def test_cache(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne',
+                                cache=ResponseCache(['image'], ttl=0.2))
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+
+        def get(target, token=TOKEN, scope='1:CloudOne;image=CloudTwo',
+                **headers):
+            headers.update({'Host': '10.0.0.1:8888',
+                            'X-Auth-Token': f'{token}{SCOPE_DELIM}{scope}'})
+            return self.await_(self.one_request('GET', target, headers))
+
+        # The second GET of an image of CloudTwo comes from the cache
+        _, _, body = get('/image/v2/images/cirros')
+        status, headers, cached_body = get('/image/v2/images/cirros')
+        self.assertEqual(status, 200)
+        self.assertEqual(cached_body, body)
+        self.assertIn('age', headers)
+        self.assertEqual(len(self.frontend_two.requests), 1)
+        stats = proxy.cache_stats()
+        self.assertEqual((stats.hits, stats.misses, stats.stores), (1, 1, 1))
+        self.assertEqual(stats.hit_rate, 0.5)
+
+        # Not for another token, nor for a request with no-cache
+        get('/image/v2/images/cirros', token='another-token')
+        get('/image/v2/images/cirros', **{'Cache-Control': 'no-cache'})
+        self.assertEqual(len(self.frontend_two.requests), 3)
+
+        # Neither for local services, other service types, nor no-store
+        # responses
+        get('/image/v2/images/cirros', scope='1:CloudOne')
+        get('/image/v2/images/cirros', scope='1:CloudOne')
+        self.assertEqual(len(self.backend_one.requests), 2)
+        get('/compute/v2.1/flavors', scope='1:CloudTwo')
+        get('/compute/v2.1/flavors', scope='1:CloudTwo')
+        get('/image/v2/images/no-store')
+        get('/image/v2/images/no-store')
+        self.assertEqual(len(self.frontend_two.requests), 7)
+
+        # A change of an image of CloudTwo drops the cached images
+        self.await_(self.one_request(
+            'DELETE', '/image/v2/images/cirros',
+            {'Host': '10.0.0.1:8888',
+             'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:CloudTwo'}))
+        self.assertEqual(proxy.cache_stats().invalidations, 2)
+        get('/image/v2/images/cirros')
+        self.assertEqual(len(self.frontend_two.requests), 9)
+
+        # Responses expire
+        time.sleep(0.2)
+        get('/image/v2/images/cirros')
+        self.assertEqual(len(self.frontend_two.requests), 10)
+        self.assertEqual(proxy.cache_stats().expirations, 1)
+
+    def test_token_cache(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne',
+                                tokens=TokenCache(ttl=10, negative_ttl=10))
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+        scope = f'{SCOPE_DELIM}1:CloudOne;identity=CloudTwo'
+
+        def validate(subject, caller='service-token', method='GET',
+                     target='/identity/v3/auth/tokens', identity='CloudTwo'):
+            return self.await_(self.one_request(method, target, {
+                'Host': '10.0.0.1:8888', 'X-Auth-Token': caller,
+                'X-Subject-Token': subject,
+                'X-Scope': f'1:CloudOne;identity={identity}'}))
+
+        # A validation by the Keystone of CloudTwo is made once, for the
+        # token without its scope
+        status, _, body = validate(f'{TOKEN}{scope}')
+        self.assertEqual(status, 200)
+        status, headers, cached_body = validate(TOKEN)
+        self.assertEqual((status, cached_body), (200, body))
+        self.assertEqual(headers['x-subject-token'], TOKEN)
+        self.assertEqual(len(self.frontend_two.requests), 1)
+        self.assertEqual(
+            self.frontend_two.requests[0][2]['x-subject-token'], TOKEN)
+        stats = proxy.token_stats()
+        self.assertEqual((stats.hits, stats.misses, stats.stores), (1, 1, 1))
+
+        # Not for another caller, another target, nor the local Keystone
+        validate(TOKEN, caller='another-service-token')
+        validate(TOKEN, target='/identity/v3/auth/tokens?allow_expired=1')
+        validate(TOKEN, target='/identity/v3/auth/tokens?allow_expired=1')
+        validate(TOKEN, identity='CloudOne')
+        validate(TOKEN, identity='CloudOne')
+        self.assertEqual(len(self.frontend_two.requests), 4)
+        self.assertEqual(len(self.backend_one.requests), 2)
+
+        # Invalid tokens are kept as well
+        self.assertEqual(validate('invalid-token')[0], 404)
+        self.assertEqual(validate('invalid-token')[0], 404)
+        self.assertEqual(len(self.frontend_two.requests), 5)
+
+        # Issuing tokens drops nothing, revoking a token drops its
+        # validations, and any other change drops them all
+        validate(TOKEN, method='POST')
+        self.assertEqual(len(proxy.tokens), 3)
+        validate(TOKEN, method='DELETE')
+        self.assertEqual(len(proxy.tokens), 1)
+        validate(TOKEN, method='PATCH', target='/identity/v3/users/admin')
+        self.assertEqual(len(proxy.tokens), 0)
+        self.assertEqual(proxy.token_stats().invalidations, 3)
+
+        # Tokens are kept until they expire
+        self.frontend_two.token_lifetime = 0.2
+        validate(TOKEN)
+        validate(TOKEN)
+        self.assertEqual(proxy.token_stats().hits, 3)
+        time.sleep(0.2)
+        validate(TOKEN)
+        self.assertEqual(proxy.token_stats().expirations, 1)
+
+    def test_balance(self):
+        # CloudTwo has a second Glance, faster than the first one
+        mirror = StubBackend('mirror')
+        self.await_(mirror.start())
+        with open(self.services_path) as f:
+            services = json.load(f)
+        services['services'].append({
+            'Service Type': 'image', 'Interface': 'public',
+            'URL': f'{mirror.address}/image', 'Region': 'CloudTwo',
+            'Frontend': mirror.address, 'Backend': '10.0.2.15:80'})
+        with open(self.services_path, 'w') as f:
+            json.dump(services, f)
+        proxy = get_scope_proxy(self.services_path, 'CloudOne')
+        proxy.oidi.balancer = Balancer()
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+        self.frontend_two.delay = 0.05
+
+        def get():
+            return self.await_(self.one_request(
+                'GET', '/image/v2/images/cirros', {
+                    'Host': '10.0.0.1:8888',
+                    'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:CloudTwo'}))[0]
+
+        # Requests go to the fastest Glance, once both have been tried
+        for _ in range(10):
+            self.assertEqual(get(), 200)
+        self.assertEqual(len(self.frontend_two.requests), 1)
+        self.assertEqual(len(mirror.requests), 9)
+        self.assertEqual(mirror.requests[0][2]['host'], mirror.address)
+
+        # Until it fails and is taken out
+        async def unavailable(reader, writer, *head):
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\n'
+                         b'Content-Length: 0\r\n\r\n')
+
+        mirror.respond = unavailable
+        stats = proxy.oidi.balancer.stats()
+        mirror_service = next(s for s in stats if s.url.startswith(
+            mirror.address))
+        while stats[mirror_service].healthy:
+            get()
+        self.assertEqual(stats[mirror_service].failures, 5)
+        for _ in range(3):
+            self.assertEqual(get(), 200)
+        self.assertEqual(len(self.frontend_two.requests), 4)
+        mirror.server.close()
+
+    def test_breaker(self):
+        breaker = self.proxy.oidi.breaker = CircuitBreaker(
+            failures=2, reset_timeout=0.2)
+
+        def get(cloud):
+            return self.await_(self.one_request(
+                'GET', '/compute/v2.1/servers', {
+                    'Host': '10.0.0.1:8888',
+                    'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:{cloud}'}))
+
+        # The frontend of CloudTwo is down: its circuit opens after 2
+        # failures, then requests to CloudTwo fail fast
+        self.frontend_two.server.close()
+        self.await_(self.frontend_two.server.wait_closed())
+        self.assertEqual(get('CloudTwo')[0], 502)
+        self.assertEqual(breaker.state('CloudTwo'), 'closed')
+        self.assertEqual(get('CloudTwo')[0], 502)
+        self.assertEqual(breaker.state('CloudTwo'), 'open')
+        status, headers, body = get('CloudTwo')
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '1')
+        self.assertIn(b'CloudTwo is unavailable', body)
+
+        # Requests to CloudOne go on
+        self.assertEqual(get('CloudOne')[0], 200)
+        self.assertEqual(breaker.stats().keys(), {'CloudTwo'})
+
+        # Back up, the probe closes the circuit
+        port = int(self.frontend_two.address.rpartition(':')[2])
+        self.frontend_two.server = self.await_(asyncio.start_server(
+            self.frontend_two.handle, '127.0.0.1', port))
+        self.assertEqual(get('CloudTwo')[0], 503)
+        time.sleep(0.2)
+        self.assertEqual(get('CloudTwo')[0], 200)
+        self.assertEqual(breaker.state('CloudTwo'), 'closed')
+        self.assertEqual(self.proxy.breaker_stats()['CloudTwo'].rejected, 2)
+
+        # Gateway errors of the frontend count as failures
+        async def unavailable(reader, writer, *head):
+            writer.write(b'HTTP/1.1 503 Service Unavailable\r\n'
+                         b'Content-Length: 0\r\n\r\n')
+
+        self.frontend_two.respond = unavailable
+        get('CloudTwo')
+        get('CloudTwo')
+        self.assertEqual(breaker.state('CloudTwo'), 'open')
+        self.assertEqual(breaker.stats()['CloudTwo'].trips, 2)
+
+    def test_bad_upstream(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne',
+                                server_timeout=0.1)
+        breaker = proxy.oidi.breaker = CircuitBreaker(failures=10)
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+
+        def get():
+            return self.await_(self.one_request(
+                'GET', '/compute/v2.1/servers', {
+                    'Host': '10.0.0.1:8888',
+                    'X-Auth-Token': f'{TOKEN}{SCOPE_DELIM}1:CloudTwo'}))[0]
+
+        def respond_with(data, stall=False):
+            async def respond(reader, writer, *head):
+                writer.write(data)
+                if stall:
+                    await asyncio.sleep(1)
+                writer.close()
+            self.frontend_two.respond = respond
+
+        # A stalled frontend times out, and so does a stalled body
+        self.frontend_two.delay = 1
+        self.assertEqual(get(), 504)
+        self.frontend_two.delay = 0
+        respond_with(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n12',
+                     stall=True)
+        self.assertRaises(asyncio.IncompleteReadError, get)
+
+        # Truncated and malformed heads are bad gateways
+        for data in [b'HTTP/1.1 200 OK\r\nContent-',
+                     b'HTTP/1.1 200 OK\r\nBad header\r\n\r\n',
+                     b'HTTP/1.1 OK\r\n\r\n', b'Garbage\r\n\r\n']:
+            respond_with(data)
+            self.assertEqual(get(), 502, data)
+
+        # All of them count as failures of CloudTwo
+        self.assertEqual(breaker.stats()['CloudTwo'].failures, 6)
+
+    def test_client_timeout(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne',
+                                client_timeout=0.1)
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+
+        # A stalled body is answered 408, and its upstream connection is
+        # not pooled
+        async def stalled_body():
+            reader, writer = await self.connect()
+            writer.write(b'PUT /image/v2/images/42/file HTTP/1.1\r\n'
+                         b'Host: 10.0.0.1:8888\r\n'
+                         b'Content-Length: 10\r\n\r\n12')
+            status_line, _ = await asyncio.wait_for(read_head(reader), 1)
+            writer.close()
+            return status_line
+
+        self.assertEqual(self.await_(stalled_body()),
+                         'HTTP/1.1 408 Request Timeout')
+        stats = proxy.pool_stats()[('CloudOne', 'image', 'public')]
+        self.assertEqual((stats.acquired, stats.in_use, stats.idle,
+                          stats.closed), (1, 0, 0, 1))
+
+        # An idle keep-alive connection is closed
+        async def idle():
+            reader, writer = await self.connect()
+            status, _, _ = await request(reader, writer, 'GET',
+                                         '/compute/v2.1/servers',
+                                         {'Host': '10.0.0.1:8888'})
+            self.assertEqual(status, 200)
+            data = await asyncio.wait_for(reader.read(), 1)
+            writer.close()
+            return data
+
+        self.assertEqual(self.await_(idle()), b'')
+
+    def test_coalesce(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne',
+                                coalesce=True)
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+        self.frontend_two.delay = 0.1
+
+        async def gather(targets, tokens):
+            return await asyncio.gather(*(
+                self.one_request('GET', target, {
+                    'Host': '10.0.0.1:8888',
+                    'X-Auth-Token': f'{token}{SCOPE_DELIM}1:CloudTwo'})
+                for target in targets for token in tokens))
+
+        def get_all(targets, tokens=(TOKEN,)):
+            return self.await_(gather(targets, tokens))
+
+        # Identical requests share one upstream call
+        responses = get_all(['/image/v2/images/cirros'] * 10)
+        self.assertEqual(len(self.frontend_two.requests), 1)
+        self.assertEqual({(status, body) for status, _, body in responses},
+                         {(responses[0][0], responses[0][2])})
+        stats = proxy.coalesce_stats
+        self.assertEqual((stats.flights, stats.coalesced, stats.saved),
+                         (1, 9, 9))
+
+        # Requests that differ are not coalesced
+        get_all(['/image/v2/images/cirros', '/image/v2/images/fedora'],
+                tokens=(TOKEN, 'another-token'))
+        self.assertEqual(len(self.frontend_two.requests), 5)
+
+        # Large responses are not shared: waiting requests go upstream
+        responses = get_all(['/image/v2/images/stream'] * 3)
+        self.assertEqual(len(self.frontend_two.requests), 8)
+        self.assertEqual([len(body) for _, _, body in responses],
+                         [4 << 20] * 3)
+        self.assertEqual(proxy.coalesce_stats.fallbacks, 2)
+
+    def test_stream_bodies(self):
+        body = os.urandom(3 << 20)
+
+        # Content-Length body
+        _, _, res_body = self.await_(self.one_request(
+            'PUT', '/image/v2/images/42/file', {'Host': '10.0.0.1:8888'},
+            body))
+        self.assertEqual(json.loads(res_body)['body_length'], len(body))
+        self.assertEqual(self.backend_one.requests[-1][3], body)
+
+        # Chunked body, with Expect: 100-continue
+        chunked = b''.join(b'%x\r\n%s\r\n' % (len(c), c)
+                           for c in [body[:1 << 20], body[1 << 20:]])
+        chunked += b'0\r\n\r\n'
+        _, _, res_body = self.await_(self.one_request(
+            'PUT', '/image/v2/images/42/file',
+            {'Host': '10.0.0.1:8888', 'Transfer-Encoding': 'chunked',
+             'Expect': '100-continue'}, chunked))
+        self.assertEqual(self.backend_one.requests[-1][3], body)
+
+        # Chunked response
+        status, headers, res_body = self.await_(self.one_request(
+            'GET', '/image/v2/images/42/stream', {'Host': '10.0.0.1:8888'}))
+        self.assertEqual(len(res_body), 4 << 20)
+
+    def test_keep_alive(self):
+        async def requests():
+            reader, writer = await self.connect()
+            for i in range(3):
+                status, headers, _ = await request(
+                    reader, writer, 'GET', f'/compute/v2.1/servers/{i}',
+                    {'Host': '10.0.0.1:8888'})
+                self.assertEqual(status, 200)
+                self.assertEqual(headers['connection'], 'keep-alive')
+            writer.close()
+
+        self.await_(requests())
+        self.assertEqual(len(self.backend_one.requests), 3)
+
+    def test_pool(self):
+        async def requests(nb_requests):
+            reader, writer = await self.connect()
+            for i in range(nb_requests):
+                await request(reader, writer, 'GET',
+                              f'/compute/v2.1/servers/{i}',
+                              {'Host': '10.0.0.1:8888'})
+            writer.close()
+
+        # Sequential requests reuse the same upstream connection
+        self.await_(requests(5))
+        self.assertEqual(self.backend_one.connections, 1)
+        stats = self.proxy.pool_stats()[('CloudOne', 'compute', 'public')]
+        self.assertEqual((stats.acquired, stats.opened, stats.reused,
+                          stats.in_use, stats.idle), (5, 1, 4, 0, 1))
+
+        # An upstream that closed the idle connection is not a failure
+        for conn in self.proxy.pools.pools[
+                ('CloudOne', 'compute', 'public')]._idle:
+            conn.reader.feed_eof()
+        self.await_(requests(1))
+        self.assertEqual(self.backend_one.connections, 2)
+
+        # Concurrent requests are bounded by the size of the pool
+        proxy = get_scope_proxy(self.services_path, 'CloudOne', pool_size=2)
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+        async def concurrent_requests():
+            await asyncio.gather(*(requests(2) for _ in range(10)))
+
+        self.await_(concurrent_requests())
+        stats = proxy.pool_stats()[('CloudOne', 'compute', 'public')]
+        self.assertEqual(stats.peak_in_use, 2)
+        self.assertEqual(stats.opened, 2)
+        self.assertGreater(stats.waited, 0)
+        self.assertEqual(stats.acquired, 20)
+
+        # Requests to the transparent backend are not pooled
+        self.await_(self.one_request('GET', '/index.html',
+                                     {'Host': self.transparent.address}))
+        self.await_(self.one_request('GET', '/index.html',
+                                     {'Host': self.transparent.address}))
+        self.assertEqual(self.transparent.connections, 2)
+        self.assertNotIn((self.transparent.address,), proxy.pool_stats())
+
+    def test_pool_queue_timeout(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne', pool_size=1,
+                                queue_timeout=0.1)
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+        self.backend_one.delay = 0.5
+
+        # The second request cannot get the connection of the first one
+        async def requests():
+            return await asyncio.gather(*(
+                self.one_request('GET', f'/compute/v2.1/servers/{i}',
+                                 {'Host': '10.0.0.1:8888'})
+                for i in range(2)))
+
+        statuses = sorted(status for status, _, _ in self.await_(requests()))
+        self.assertEqual(statuses, [200, 503])
+        stats = proxy.pool_stats()[('CloudOne', 'compute', 'public')]
+        self.assertEqual((stats.timeouts, stats.in_use, stats.acquired),
+                         (1, 0, 1))
+
+    def test_pool_idle_timeout(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne',
+                                pool_idle_timeout=0.1)
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+
+        self.await_(self.one_request('GET', '/compute/v2.1/servers',
+                                     {'Host': '10.0.0.1:8888'}))
+        stats = proxy.pool_stats()[('CloudOne', 'compute', 'public')]
+        self.assertEqual(stats.idle, 1)
+        self.await_(asyncio.sleep(0.3))
+        self.assertEqual((stats.idle, stats.closed), (0, 1))
+
+    def test_no_pool(self):
+        proxy = get_scope_proxy(self.services_path, 'CloudOne', pool_size=0)
+        self.servers += self.await_(proxy.start(['127.0.0.1:0']))
+        self.port = self.servers[-1].sockets[0].getsockname()[1]
+
+        async def requests():
+            reader, writer = await self.connect()
+            for i in range(3):
+                _, _, body = await request(
+                    reader, writer, 'GET', f'/compute/v2.1/servers/{i}',
+                    {'Host': '10.0.0.1:8888'})
+                self.assertEqual(
+                    json.loads(body)['headers']['connection'], 'close')
+            writer.close()
+
+        self.await_(requests())
+        self.assertEqual(self.backend_one.connections, 3)
+
+    def test_concurrent_connections(self):
+        async def requests():
+            return await asyncio.gather(*(
+                self.one_request('GET', f'/compute/v2.1/servers/{i}',
+                                 {'Host': '10.0.0.1:8888'})
+                for i in range(500)))
+
+        responses = self.await_(requests())
+        self.assertTrue(all(status == 200 for status, _, _ in responses))
+        self.assertEqual(len(self.backend_one.requests), 500)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+
+from requests import Request
+
+from oidinterpreter import (Balancer, Catalog, OidInterpreter, Service,
+                            get_oidinterpreter, oss2services, SCOPE_DELIM)
+from oidinterpreter.snapshot import (SNAPSHOT_MAGIC, SnapshotCatalog,
+                                     dump_snapshot, load_snapshot, main,
+                                     write_snapshot)
+
+from tests.tests_oidinterpreter import SERVICES
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.services = oss2services(SERVICES) + [
+            Service(service_type='image', cloud='CloudOne',
+                    url='http://192.168.141.245:9292')]
+        self.path = os.path.join(self.dir, 'services.snap')
+        write_snapshot(self.services, self.path)
+
+    def test_lookups(self):
+        catalog = load_snapshot(self.path)
+        the_catalog = Catalog(self.services)
+
+        self.assertEqual(catalog.services, self.services)
+        self.assertIsNone(catalog.services[-1].interface)
+
+        for s in self.services:
+            url = f'{s.url}/v2?limit=1'
+            self.assertEqual(catalog.url_index.lookup(url),
+                             the_catalog.url_index.lookup(url))
+            self.assertEqual(
+                catalog.lookup_endpoint(s.service_type, s.interface,
+                                        s.cloud),
+                the_catalog.lookup_endpoint(s.service_type, s.interface,
+                                            s.cloud))
+        self.assertEqual(catalog.lookup_identity('CloudTwo'),
+                         the_catalog.lookup_identity('CloudTwo'))
+        self.assertEqual(catalog.get_identity_headers('CloudOne'),
+                         the_catalog.get_identity_headers('CloudOne'))
+        self.assertEqual(catalog.precompute_plans(),
+                         the_catalog.precompute_plans())
+
+        # Bad lookups
+        self.assertIsNone(catalog.url_index.lookup('http://10.0.0.1/image'))
+        self.assertIsNone(catalog.get_identity_headers('CloudThree'))
+        with self.assertRaises(StopIteration):
+            catalog.lookup_endpoint('compute', 'admin', 'CloudTwo')
+        with self.assertRaises(StopIteration):
+            catalog.lookup_identity('CloudThree')
+
+        # Strings are stored, and loaded, once
+        self.assertIs(catalog.services[0].cloud, catalog.services[1].cloud)
+
+    def test_bad_snapshot(self):
+        snapshot = dump_snapshot(self.services)
+        self.assertTrue(snapshot.startswith(SNAPSHOT_MAGIC))
+
+        with self.assertRaisesRegex(ValueError, 'Not a services snapshot'):
+            SnapshotCatalog(json.dumps(SERVICES).encode())
+        with self.assertRaisesRegex(ValueError, 'version'):
+            SnapshotCatalog(snapshot[:8] + b'\xff' + snapshot[9:])
+        with self.assertRaisesRegex(ValueError, 'Truncated'):
+            SnapshotCatalog(snapshot[:-4])
+        with self.assertRaises(ValueError):
+            dump_snapshot([Service('compute', 'Cloud\0One', 'http://a')])
+
+    def test_alternatives(self):
+        compute1_bis = Service(
+            service_type='compute', cloud='CloudOne', interface='public',
+            url='http://192.168.141.246:8888/compute/v2.1')
+        services = self.services + [compute1_bis, self.services[0]]
+        write_snapshot(services, self.path)
+        catalog = load_snapshot(self.path)
+        the_catalog = Catalog(services)
+
+        # The snapshot has every attribute of a Catalog
+        for name in vars(the_catalog):
+            self.assertTrue(hasattr(catalog, name), name)
+
+        # Several endpoints of a service give alternative plans, the
+        # first endpoint of the catalog first
+        for s in services:
+            self.assertEqual(
+                catalog.lookup_endpoints(s.service_type, s.interface,
+                                         s.cloud),
+                the_catalog.lookup_endpoints(s.service_type, s.interface,
+                                             s.cloud))
+        compute2 = catalog.lookup_endpoint('compute', 'public', 'CloudTwo')
+        plan = catalog.get_plan(compute2, 'CloudOne')
+        self.assertEqual(plan, the_catalog.get_plan(compute2, 'CloudOne'))
+        self.assertEqual(len(plan.alternatives), 2)
+        self.assertEqual(plan.alternatives[1].target, compute1_bis)
+
+        # A balancer picks among them
+        oidi = OidInterpreter(catalog)
+        oidi.balancer = Balancer()
+        oidi.balancer.started(plan.target)
+        req = Request('GET', compute2.url, {'X-Scope': '1:CloudOne'})
+        self.assertEqual(oidi.rewrite(req).plan.target, compute1_bis)
+
+    def test_get_oidinterpreter(self):
+        oidi = get_oidinterpreter(f'snapshot://{self.path}')
+        self.assertIsInstance(oidi.catalog, SnapshotCatalog)
+        self.assertIs(get_oidinterpreter(f'snapshot://{self.path}'), oidi)
+        the_oidi = OidInterpreter(self.services)
+
+        scope = json.dumps({'compute': 'CloudTwo', 'identity': 'CloudTwo'})
+        for url, headers in [
+                ('http://192.168.141.245:8888/compute/v2.1/servers',
+                 {'X-Scope': scope}),
+                ('http://192.168.141.245:8888/identity/v3/auth/tokens',
+                 {'X-Auth-Token': f'token{SCOPE_DELIM}{scope}'}),
+                ('http://192.168.141.245:9292/v2/images', {}),
+                ('https://wikipedia.org', {'X-Scope': scope})]:
+            self.assertEqual(oidi.rewrite(Request('GET', url, headers)),
+                             the_oidi.rewrite(Request('GET', url, headers)))
+
+        # A new snapshot is reloaded
+        oidi.watch(self.path, interval=60,
+                   load=load_snapshot).stop()
+        write_snapshot(self.services[:3], self.path)
+        self.assertTrue(oidi.watcher.check())
+        self.assertEqual(oidi.services, self.services[:3])
+        self.assertEqual(oidi.reload_stats.generation, 1)
+
+    def test_convert(self):
+        for name, content in [('endpoints.json', SERVICES),
+                              ('services.json', {'services': SERVICES})]:
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as f:
+                json.dump(content, f)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                main([path, self.path])
+            self.assertEqual(load_snapshot(self.path).services,
+                             oss2services(SERVICES))
+
+
+if __name__ == "__main__":
+    unittest.main()
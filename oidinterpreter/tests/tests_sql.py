@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import TestCase
+
+from requests import Request
+
+from oidinterpreter import (Catalog, Service, UrlIndex, get_oidinterpreter,
+                            oss2services)
+from oidinterpreter.sql import (MAX_VARIABLES, SqlCatalog, SqlProvider,
+                                load_sql, main)
+
+from tests.tests_oidinterpreter import SERVICES
+
+
+class TestSql(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'services.db')
+        self.provider = SqlProvider(self.path)
+        self.addCleanup(self.provider.close)
+        self.services = oss2services(SERVICES)
+        self.ids = self.provider.add(self.services)
+
+    def assertSameCatalog(self, catalog: Catalog, services):
+        "Asserts that `catalog` indexes `services` as a new Catalog does."
+        the_catalog = Catalog(services)
+        self.assertEqual(catalog.services, services)
+        self.assertEqual(catalog.endpoints, the_catalog.endpoints)
+        self.assertEqual(catalog.endpoint_groups,
+                         the_catalog.endpoint_groups)
+        self.assertEqual(catalog.identity_headers,
+                         the_catalog.identity_headers)
+        self.assertEqual(catalog.url_index._buckets,
+                         the_catalog.url_index._buckets)
+
+    def test_lookups(self):
+        legacy = Service(service_type='compute', cloud='CloudOne',
+                         url='http://192.168.141.245:8888/compute/v2',
+                         interface='public')
+        other = Service(service_type='compute', cloud='CloudOne',
+                        url='http://192.168.141.245:88', interface='admin')
+        services = self.services + [legacy, other]
+        self.provider.add([legacy, other])
+        index = UrlIndex(services)
+
+        for url in ['http://192.168.141.245:8888/compute/v2.1/servers',
+                    'http://192.168.141.245:8888/compute/v2/servers',
+                    'http://192.168.141.245:8888/compute/v',
+                    'http://192.168.141.245:8888/identity',
+                    'http://192.168.142.245:8888/identity/v3',
+                    'http://192.168.141.245:8888/image',
+                    'http://192.168.141.245:8888',
+                    'http://192.168.141.245:88/',
+                    'http://192.168.141.245:8',
+                    'https://wikipedia.org']:
+            self.assertEqual(self.provider.lookup_url(url),
+                             index.lookup(url), url)
+
+        # The first service wins
+        self.assertEqual(
+            self.provider.lookup_url(self.services[1].url, exact=True),
+            self.services[0])
+        self.assertEqual(
+            self.provider.lookup_endpoint('compute', 'public', 'CloudOne'),
+            self.services[2])
+        self.assertEqual(
+            self.provider.lookup_endpoints('compute', 'public', 'CloudOne'),
+            (self.services[2], legacy))
+        self.assertEqual(
+            self.provider.lookup_endpoints('compute', 'admin', 'CloudTwo'),
+            ())
+        self.assertIsNone(
+            self.provider.lookup_endpoint('compute', 'admin', 'CloudTwo'))
+
+    def test_sync(self):
+        catalog = SqlCatalog.load(self.provider)
+        self.assertSameCatalog(catalog, self.services)
+        self.assertIs(catalog.sync(self.provider), catalog)
+        catalog.precompute_plans()
+        c1_plan = catalog.get_plan(self.services[5], 'CloudOne')
+
+        # Move compute of CloudOne, remove identity admin of CloudTwo, and
+        # add an image service
+        c1 = Service(service_type='compute', cloud='CloudOne',
+                     url='http://192.168.141.246:8774/v2.1',
+                     interface='public')
+        image = Service(service_type='image', cloud='CloudOne',
+                        url='http://192.168.141.245:9292',
+                        interface='public')
+        self.provider.update(self.ids[2], c1)
+        self.provider.remove([self.ids[3]])
+        self.provider.add([image])
+        services = (self.services[:2] + [c1] + self.services[4:] + [image])
+
+        patched = catalog.sync(self.provider)
+        self.assertSameCatalog(patched, services)
+        self.assertEqual(patched.seq, self.provider.last_seq())
+
+        # Plans to the moved service are recomputed, the others are kept
+        self.assertEqual(
+            patched.get_plan(self.services[5], 'CloudOne').target, c1)
+        self.assertIs(catalog.get_plan(self.services[5], 'CloudOne'),
+                      c1_plan)
+        self.assertIs(patched.get_plan(self.services[5], 'CloudTwo'),
+                      catalog.get_plan(self.services[5], 'CloudTwo'))
+
+        # CloudTwo has no more admin identity
+        with self.assertRaises(StopIteration):
+            patched.lookup_identity('CloudTwo')
+        self.assertEqual(catalog.lookup_identity('CloudTwo'),
+                         self.services[3])
+
+        # A catalog that missed trimmed changes reloads everything
+        self.provider.remove([self.ids[0]])
+        self.provider.trim(self.provider.last_seq())
+        reloaded = patched.sync(self.provider)
+        self.assertSameCatalog(reloaded, services[1:])
+        self.assertIs(reloaded.sync(self.provider), reloaded)
+
+    def test_sync_many(self):
+        # More changes than SQLite binds variables in one statement
+        if hasattr(self.provider._conn, 'setlimit'):
+            # Python >= 3.11, builds of SQLite >= 3.32 bind more of them
+            self.provider._conn.setlimit(
+                sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, MAX_VARIABLES)
+        catalog = SqlCatalog.load(self.provider)
+        services = [Service(service_type='compute', cloud=f'Cloud{i}',
+                            url=f'http://10.0.{i // 250}.{i % 250}:8774',
+                            interface='public')
+                    for i in range(2 * MAX_VARIABLES + 1)]
+        self.provider.add(services)
+        self.assertSameCatalog(catalog.sync(self.provider),
+                               self.services + services)
+
+    def test_get_oidinterpreter(self):
+        oidi = get_oidinterpreter(f'sql://{self.path}', reload_interval=60)
+        self.addCleanup(oidi.close)
+        self.assertIsInstance(oidi.catalog, SqlCatalog)
+        self.assertEqual(oidi.services, self.services)
+
+        req = Request('GET', 'http://192.168.142.245:8888/compute/v2.1',
+                      {'X-Scope': json.dumps({'compute': 'CloudOne'})})
+        self.assertEqual(oidi.rewrite(req).url, self.services[2].url)
+
+        c1 = Service(service_type='compute', cloud='CloudOne',
+                     url='http://192.168.141.246:8774/v2.1',
+                     interface='public')
+        self.provider.update(self.ids[2], c1)
+        self.assertTrue(oidi.watcher.check())
+        self.assertEqual(oidi.reload_stats.generation, 1)
+        self.assertEqual(oidi.rewrite(req).url, c1.url)
+        self.assertIs(load_sql(self.path), oidi.catalog)
+
+        # A mistyped path is an error, not an empty catalog
+        missing = os.path.join(self.dir, 'servcies.db')
+        self.assertRaises(sqlite3.OperationalError, get_oidinterpreter,
+                          f'sql://{missing}')
+        self.assertFalse(os.path.exists(missing))
+
+    def test_import(self):
+        services_path = os.path.join(self.dir, 'services.json')
+        with open(services_path, 'w') as f:
+            json.dump({'services': SERVICES}, f)
+
+        path = os.path.join(self.dir, 'imported.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            main([services_path, path])
+        provider = SqlProvider(path)
+        self.addCleanup(provider.close)
+        self.assertEqual(list(provider.services().values()), self.services)
+
+
+if __name__ == "__main__":
+    unittest.main()
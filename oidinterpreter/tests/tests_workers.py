@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import TestCase
+
+from tests.tests_proxy import (StubBackend, close_loop, request,
+                               services_json)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def children(pid: int):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return f.read().split()
+
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and
+                     os.path.exists('/proc/self/task'),
+                     'Requires SO_REUSEPORT and /proc')
+class TestWorkers(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.backend = StubBackend('CloudOne')
+        self.loop.run_until_complete(self.backend.start())
+
+        fd, self.services_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(services_json(self.backend.address, '10.0.2.15:80',
+                                    '10.0.0.2:8888'), f)
+
+        self.port = free_port()
+        self.proxy = subprocess.Popen(
+            [sys.executable, '-m', 'oidinterpreter.proxy',
+             '--services', self.services_path, '--cloud', 'CloudOne',
+             '--bind', f'127.0.0.1:{self.port}', '--workers', '2'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        wait_port(self.port)
+
+    def tearDown(self):
+        if self.proxy.poll() is None:
+            self.proxy.kill()
+            self.proxy.wait()
+        self.backend.server.close()
+        close_loop(self.loop)
+        os.remove(self.services_path)
+
+    def test_workers(self):
+        async def requests():
+            async def one_request(i):
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', self.port)
+                try:
+                    return await request(
+                        reader, writer, 'GET', f'/compute/v2.1/servers/{i}',
+                        {'Host': '10.0.0.1:8888'})
+                finally:
+                    writer.close()
+            return await asyncio.gather(*(one_request(i) for i in range(50)))
+
+        responses = self.loop.run_until_complete(requests())
+        self.assertTrue(all(status == 200 for status, _, _ in responses))
+        self.assertEqual(len(self.backend.requests), 50)
+
+        # A dead worker is respawned
+        self.assertEqual(len(children(self.proxy.pid)), 2)
+        worker = children(self.proxy.pid)[0]
+        os.kill(int(worker), signal.SIGKILL)
+        deadline = time.monotonic() + 10
+        while worker in children(self.proxy.pid) \
+                or len(children(self.proxy.pid)) != 2:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+        # SIGTERM stops the parent and its workers
+        self.proxy.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proxy.wait(10), 0)
+
+    def test_crash_loop(self):
+        # Workers cannot bind a port taken without SO_REUSEPORT, so they
+        # die right after their start: the parent backs off, then gives up
+        with socket.socket() as taken:
+            taken.bind(('127.0.0.1', 0))
+            taken.listen()
+            start = time.monotonic()
+            proxy = subprocess.Popen(
+                [sys.executable, '-m', 'oidinterpreter.proxy',
+                 '--services', self.services_path, '--cloud', 'CloudOne',
+                 '--bind', f'127.0.0.1:{taken.getsockname()[1]}',
+                 '--workers', '2'],
+                cwd=os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))),
+                stderr=subprocess.PIPE)
+            _, stderr = proxy.communicate(timeout=30)
+
+        self.assertEqual(proxy.returncode, 1)
+        self.assertIn(b'times in a row right after its start', stderr)
+        # 0.1 + 0.2 + 0.4 + 0.8 seconds of backoff before giving up
+        self.assertGreater(time.monotonic() - start, 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,8 +18,11 @@
 local inspect  = require('inspect')
 local json     = require('json')
 local services = require('services')
+local parse_scope = require('scope').parse
+local BAD_SCOPE   = require('scope').BAD_SCOPE
 
--- Returns the scope of the request.
+-- Returns the scope of the request, and the cloud of services missing
+-- in the scope. Raises an error if the scope is malformed.
 local function get_scope(headers, current_region)
   -- Initialize to default scope
   local scope = {
@@ -30,11 +33,21 @@ local function get_scope(headers, current_region)
     ["placement"] = current_region
   }
 
-  -- Update the default scope with values in `s`.
+  local default = current_region
+
+  -- Update the default scope with values of the raw scope `raw`.
   --
   -- This function prevents to fully fill the scope at the OpenStack
-  -- CLI.
-  local function update_scope(s)
+  -- CLI. A compact scope brings its own default cloud, which is the
+  -- one of the client and not the current region on later hops.
+  local function update_scope(raw)
+    local s, scope_default = parse_scope(raw)
+    if scope_default then
+      default = scope_default
+      for k, _ in pairs(scope) do
+        scope[k] = default
+      end
+    end
     for k, v in pairs(s) do
       scope[k] = v
     end
@@ -47,21 +60,19 @@ local function get_scope(headers, current_region)
   if x_scope then
     -- X-Scope header, the scope is here
     core.log(core.info, 'x-scope: '..inspect(x_scope))
-    update_scope(json.decode(x_scope[0]))
+    update_scope(x_scope[0])
   elseif x_auth_scope then
     -- Oh X-Auth-Token, OK then scope maybe be there
     core.log(core.info,'x-auth-token: '..inspect(x_auth_scope))
 
     local i,j = string.find(x_auth_scope[0], "!SCOPE!")
     if i then -- Yeah! scope is here
-      update_scope(
-        json.decode(
-          string.sub(x_auth_scope[0], j+1, #x_auth_scope[0])))
+      update_scope(string.sub(x_auth_scope[0], j+1, #x_auth_scope[0]))
     end
   end
 
   core.log(core.info, 'scope: '..inspect(scope))
-  return scope
+  return scope, default
 end
 
 -- Remove !SCOPE! from X-*-Token.
@@ -101,8 +112,12 @@ local function interpret_scope(txn, current_region)
   end
 
   -- Find the scope and targeted region
-  local scope = get_scope(headers, current_region)
-  local targeted_region = scope[service["Service Type"]]
+  local ok, scope, default = pcall(get_scope, headers, current_region)
+  if not ok then
+    core.log(core.warning, 'Bad scope: '..scope)
+    return BAD_SCOPE
+  end
+  local targeted_region = scope[service["Service Type"]] or default
   core.log(core.info, 'targeted region: '..inspect(targeted_region))
 
   -- Compute the backend name
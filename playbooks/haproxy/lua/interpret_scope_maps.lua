@@ -0,0 +1,205 @@
+--   ____                ______           __        _    __
+--  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+-- / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+-- \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+--     /_/
+-- Make your OpenStacks Collaborative
+--
+-- Module for scope interpretation on precompiled maps.
+--
+-- Same interpretation as `interpret_scope.lua`, on the maps generated
+-- from services.json by `python -m oidinterpreter.haproxy` (see that
+-- module for their format) in $OIDI_MAPS, /etc/haproxy/maps by default.
+--
+-- The maps are read once at load. Then, a request costs a longest
+-- prefix lookup of its url in services.map, done by HAProxy, and a few
+-- table lookups. Scopes are parsed, completed and encoded once, and
+-- memoized per raw scope. Nothing is logged on the way but bad scopes,
+-- which go to the `bad_scope` backend.
+--
+-- Load it in place of `interpret_scope.lua`, it registers the same
+-- `interpret_scope` fetch.
+
+local json = require('json')
+local parse_scope = require('scope').parse
+local BAD_SCOPE   = require('scope').BAD_SCOPE
+
+local MAPS = os.getenv('OIDI_MAPS') or '/etc/haproxy/maps'
+local SCOPE_DELIM = '!SCOPE!'
+local SCOPES_SIZE = 1024
+
+-- Reads the {key, value} entries of the map file `filename`.
+local function read_map(filename)
+  local entries = {}
+  local file = io.open(filename, 'r')
+  if not file then
+    core.log(core.err, 'Map not found: '..filename)
+    return entries
+  end
+
+  for line in file:lines() do
+    local key, value = string.match(line, '^%s*([^#%s]%S*)%s*(.-)%s*$')
+    if key then
+      table.insert(entries, {key, value})
+    end
+  end
+  file:close()
+  return entries
+end
+
+-- Url prefixes of services, matched by HAProxy.
+local services_map = Map.new(MAPS..'/services.map', Map._beg)
+
+-- Kinds of services, i.e., the values of services.map. A kind holds
+-- its service type, the suffix of its backends and whether it is an
+-- identity service.
+local kinds = {}
+
+-- Service types of services.map, bound to the default cloud of scopes
+-- that miss them.
+local service_types = {}
+
+local seen = {}
+for _, entry in ipairs(read_map(MAPS..'/services.map')) do
+  local kind = entry[2]
+  if not kinds[kind] then
+    local service_type, interface = string.match(kind, '^(%S+)%s+(%S+)$')
+    kinds[kind] = {
+      service_type = service_type,
+      suffix       = '_'..service_type..'_'..interface,
+      identity     = service_type == 'identity'
+    }
+    if not seen[service_type] then
+      seen[service_type] = true
+      table.insert(service_types, service_type)
+    end
+  end
+end
+
+-- Urls of the admin identity service of each cloud.
+--
+-- FIXME: find the proper protocol (e.g., http, https) instead of
+-- hardcoding it, as in `interpret_scope.lua`.
+local identities = {}
+for _, entry in ipairs(read_map(MAPS..'/identities.map')) do
+  identities[entry[1]] = 'http://'..entry[2]
+end
+
+-- Interpretations of raw scopes, by current region and raw scope.
+local scopes, nb_scopes = {}, 0
+
+-- Interprets `raw_scope` (nil without scope) in `current_region`.
+--
+-- @return the interpretation of the scope: the scope completed with its
+-- default cloud, its `X-Scope` header, the `X-Identity-*` headers of its
+-- identity cloud, and the backends of each kind of service filled on
+-- demand. Or nil if the scope is malformed, which is not memoized.
+local function interpret(raw_scope, current_region)
+  local key = current_region..'\n'..(raw_scope or '')
+  local interpretation = scopes[key]
+  if interpretation then
+    return interpretation
+  end
+
+  local scope, default = {}, current_region
+  if raw_scope then
+    local ok, parsed, scope_default = pcall(parse_scope, raw_scope)
+    if not ok then
+      core.log(core.warning, 'Bad scope: '..parsed)
+      return nil
+    end
+    scope, default = parsed, scope_default or current_region
+  end
+
+  local complete = {}
+  for _, service_type in ipairs(service_types) do
+    complete[service_type] = default
+  end
+  for service_type, cloud in pairs(scope) do
+    complete[service_type] = cloud
+  end
+
+  interpretation = {
+    scope          = complete,
+    x_scope        = json.encode(complete),
+    identity_cloud = complete["identity"],
+    identity_url   = identities[complete["identity"]],
+    backends       = {}
+  }
+
+  -- Start over rather than evicting one by one, scopes of a running
+  -- workflow come back at once
+  if nb_scopes >= SCOPES_SIZE then
+    scopes, nb_scopes = {}, 0
+  end
+  scopes[key] = interpretation
+  nb_scopes = nb_scopes + 1
+  return interpretation
+end
+
+-- Sets header `name` to the token of `value` without its scope, if
+-- any.
+local function clean_token(txn, name, value)
+  if value then
+    local i = string.find(value, SCOPE_DELIM, 1, true)
+    if i then
+      txn.http:req_set_header(name, string.sub(value, 1, i - 1))
+    end
+  end
+end
+
+-- Extract the scope of the request and interpret it.
+local function interpret_scope(txn, current_region)
+  local kind = kinds[services_map:lookup(txn.sf:base()) or '']
+  if not kind then
+    -- The request does not target a service: use the transparent
+    -- backend.
+    return 'transparent'
+  end
+
+  -- X-Scope first, then the scope in X-Auth-Token
+  local raw_scope = txn.sf:req_fhdr('x-scope')
+  local auth_token = txn.sf:req_fhdr('x-auth-token')
+  if not raw_scope and auth_token then
+    local _, j = string.find(auth_token, SCOPE_DELIM, 1, true)
+    if j then
+      raw_scope = string.sub(auth_token, j + 1)
+    end
+  end
+
+  local interpretation = interpret(raw_scope, current_region)
+  if not interpretation then
+    return BAD_SCOPE
+  end
+
+  local backend = interpretation.backends[kind]
+  if not backend then
+    backend = interpretation.scope[kind.service_type]..kind.suffix
+    interpretation.backends[kind] = backend
+  end
+
+  -- Clean X-*-Token headers
+  clean_token(txn, 'X-Subject-Token', txn.sf:req_fhdr('x-subject-token'))
+  if kind.identity then
+    clean_token(txn, 'X-Auth-Token', auth_token)
+  end
+
+  -- Add X-Identity-* for identity_server of keystone middleware
+  if interpretation.identity_url then
+    txn.http:req_set_header('X-Identity-Cloud',
+                            interpretation.identity_cloud)
+    txn.http:req_set_header('X-Identity-Url', interpretation.identity_url)
+  end
+  txn.http:req_set_header('X-Scope', interpretation.x_scope)
+
+  return backend
+end
+
+core.register_fetches("interpret_scope", function(txn, current_region)
+  -- Only works with http txn, no tcp
+  if txn.sf:req_fhdr("host")..txn.sf:path() == "" then
+    return
+  else
+    return interpret_scope(txn, current_region)
+  end
+end)
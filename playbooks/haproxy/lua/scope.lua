@@ -0,0 +1,85 @@
+--   ____                ______           __        _    __
+--  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+-- / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+-- \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+--     /_/
+-- Make your OpenStacks Collaborative
+--
+-- Module for raw scopes.
+--
+-- This module parses the scopes of requests, as `oidinterpreter.parse_scope`
+-- does, for `interpret_scope.lua` and `interpret_scope_maps.lua`.
+--
+-- Provides:
+-- * scope.unquote(s):
+--   Decodes a percent-encoded name of a compact scope.
+--
+-- * scope.parse(raw_scope):
+--   Returns the scope of `raw_scope` and the default cloud of a compact
+--   scope. Raises an error if `raw_scope` is malformed.
+--
+-- * scope.BAD_SCOPE:
+--   Backend of requests with a malformed scope, which answers 400.
+
+local json  = require('json')
+local scope = {}
+
+scope.BAD_SCOPE = 'bad_scope'
+
+function scope.unquote(s)
+  return (string.gsub(s, "%%(%x%x)", function(h)
+    return string.char(tonumber(h, 16))
+  end))
+end
+
+-- Parses the compact format "1:<default>;<service>=<cloud>;..." of
+-- `oidinterpreter.encode_scope`.
+local function decode(raw_scope)
+  local fields = {}
+  for field in string.gmatch(string.sub(raw_scope, 3)..";", "([^;]*);") do
+    table.insert(fields, field)
+  end
+
+  local default = fields[1]
+  if default == "" then
+    error('Scope '..raw_scope..' has no default cloud')
+  end
+
+  local s = {}
+  for i = 2, #fields do
+    local service, cloud = string.match(fields[i], "^([^=]+)=(.+)$")
+    if not service then
+      error('Scope '..raw_scope..' has a bad binding '..fields[i])
+    end
+    s[scope.unquote(service)] = scope.unquote(cloud)
+  end
+  return s, scope.unquote(default)
+end
+
+-- Parses a raw scope, either in json or in the compact format.
+--
+-- @return the scope, and the default cloud of a compact scope (nil
+-- for a json scope).
+function scope.parse(raw_scope)
+  if string.sub(raw_scope, 1, 2) == "1:" then
+    return decode(raw_scope)
+  end
+
+  -- json.lua decodes arrays to tables as well
+  local ok, s = pcall(json.decode, raw_scope)
+  local is_object = ok and type(s) == 'table'
+    and string.match(raw_scope, "^%s*{") ~= nil
+  if is_object then
+    for k, v in pairs(s) do
+      if type(k) ~= 'string' or type(v) ~= 'string' then
+        is_object = false
+      end
+    end
+  end
+  if not is_object then
+    error('Scope '..raw_scope..' is not an object of strings')
+  end
+  return s, nil
+end
+
+return scope
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+"""
+Measures the import of the plugin with `python -X importtime`, as every
+`openstack` command pays it.
+
+Exits with an error if the import pulls a module of `FORBIDDEN`, i.e., if
+heavy imports are no longer deferred to the shell hooks, or if it takes more
+than `--budget` microseconds.
+
+Run with
+
+  python benchmarks/bench_importtime.py [--budget US] [--runs N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = 'openstackoidclient.client'
+
+# Modules that the plugin only imports once the shell runs
+FORBIDDEN = ['osc_lib', 'requests', 'keystoneauth1', 'oslo_utils']
+
+
+def importtime(module):
+    """Imports `module` in a fresh interpreter.
+
+    Returns the cumulative import time of `module` in microseconds, and the
+    modules that its import loaded.
+
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        cwd=os.path.dirname(HERE), stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+    # Lines are `import time: self [us] | cumulative | imported package`,
+    # with nested imports listed before the module that imports them.
+    lines = [line.split('|') for line in proc.stderr.splitlines()
+             if line.startswith('import time:') and '[us]' not in line]
+    modules = [name.strip() for _, _, name in lines]
+    plugin = modules.index(module)
+    start = plugin
+    while start > 0 and lines[start - 1][2].startswith('  '):
+        start -= 1
+    return int(lines[plugin][1]), modules[start:plugin + 1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--budget', type=int, default=20000,
+                        help='Maximum import time, in microseconds')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    runs = [importtime(PLUGIN) for _ in range(args.runs)]
+    best = min(us for us, _ in runs)
+    modules = runs[0][1]
+    print('%s | best of %d: %8d us | %d modules imported'
+          % (PLUGIN, args.runs, best, len(modules)))
+
+    heavy = [m for m in modules if m.split('.')[0] in FORBIDDEN]
+    if heavy:
+        sys.exit('%s imports %s at load time' % (PLUGIN, ', '.join(heavy)))
+    if best > args.budget:
+        sys.exit('%s takes %d us to import, over the budget of %d us'
+                 % (PLUGIN, best, args.budget))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,11 +20,33 @@ Adds `--os-scope` global parameter:
   "network": "OS_SCOPE_NETWORK | OS_REGION_NAME",
   "placement": "OS_SCOPE_PLACEMENT | OS_REGION_NAME",
 }' (Env: OS_SCOPE)
+
+A service may also be bound to several clouds, e.g., `--os-scope '{"image":
+["CloudOne", "CloudTwo"]}'`. Then, listing requests (GET on a collection) to
+that service are sent to every cloud concurrently, and their lists merged into
+one response, each item tagged with its cloud under `SCOPE_CLOUD_KEY`. A cloud
+that fails or does not answer within `OS_SCOPE_TIMEOUT` seconds is left out of
+the response. Only the first page of each cloud is merged: clouds with more
+pages are named in `X-Scope-Truncated-Clouds`. Other requests, e.g., to show
+a resource, discover versions or get schemas, use the first cloud of the
+list.
+
+The scope goes over the wire in a compact format that only lists services
+bound to another cloud than OS_REGION_NAME, e.g., `1:CloudOne;image=CloudTwo`
+(see `oidinterpreter.encode_scope`). Set `OS_SCOPE_FORMAT=json` to send it in
+json to proxies that do not read the compact format.
+
+The plugin is imported by every `openstack` command, so it only imports
+the standard library at load time. OpenStackShell and `Session.request` are
+patched by the hooks of the plugin interface, once the shell runs.
 """
 
 import json
 import logging
-from osc_lib import utils
+import os
+import re
+import threading
+import time
 
 
 LOG = logging.getLogger(__name__)
@@ -39,6 +61,26 @@ API_VERSIONS = {
 }
 
 DEFAULT_OS_REGION_NAME = "RegionOne"
+SCOPE_SERVICES = ["compute", "identity", "image", "network", "placement"]
+
+# Fan-out of requests to services bound to several clouds
+SCOPE_CLOUD_KEY = 'scope_cloud'
+DEFAULT_OS_SCOPE_TIMEOUT = 30.0
+
+# Last segment of the path of a single resource, i.e., its id: a UUID, with
+# or without dashes, or a number
+ID_RE = re.compile(r'^([0-9a-fA-F]{8}-?([0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}'
+                   r'|[0-9]+)$')
+# Version of an API, e.g., v2 or v2.1
+VERSION_RE = re.compile(r'^v[0-9]+(\.[0-9]+)?$')
+
+# Compact scope format, as in `oidinterpreter.encode_scope`
+SCOPE_COMPACT_PREFIX = "1:"
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 
 # Required by the OSC plugin interface
@@ -62,13 +104,10 @@ def build_option_parser(parser):
         default=_get_default_os_scope(),
         help=("OpenStackoid Scope, "
               "default='%s'"
-              % json.dumps({
-                  "compute": _fmt_doc('compute'),
-                  "identity": _fmt_doc('identity'),
-                  "image": _fmt_doc('image'),
-                  "network": _fmt_doc('network'),
-                  "placement": _fmt_doc('placement')})))
+              % json.dumps(dict((s, _fmt_doc(s)) for s in SCOPE_SERVICES))))
 
+    # The shell is initialized right after its parser
+    patch_shell()
     return parser
 
 
@@ -79,10 +118,16 @@ def _get_os_scope_service_env(service):
     function returns the value of `DEFAULT_OS_REGION_NAME`.
 
     """
-    env_name = "OS_SCOPE_%s" % service.upper()
-    default = {'default': DEFAULT_OS_REGION_NAME}
+    # Same as `osc_lib.utils.env`, without importing osc_lib
+    for env_name in ("OS_SCOPE_%s" % service.upper(), 'OS_REGION_NAME'):
+        value = os.environ.get(env_name)
+        if value:
+            return value
+
+    return DEFAULT_OS_REGION_NAME
 
-    return utils.env(env_name, 'OS_REGION_NAME', **default)
+
+_DEFAULT_OS_SCOPE = None
 
 
 def _get_default_os_scope():
@@ -95,27 +140,31 @@ def _get_default_os_scope():
       "image": "OS_SCOPE_IMAGE | OS_REGION_NAME",
       "network": "OS_SCOPE_NETWORK | OS_REGION_NAME",
       "placement": "OS_SCOPE_PLACEMENT | OS_REGION_NAME",
-    }"""
-    return {
-        "compute": _get_os_scope_service_env('compute'),
-        "identity": _get_os_scope_service_env('identity'),
-        "image": _get_os_scope_service_env('image'),
-        "network": _get_os_scope_service_env('network'),
-        "placement": _get_os_scope_service_env('placement')
     }
 
-
+    The environment is only read once, callers get a copy of the scope.
+    """
+    global _DEFAULT_OS_SCOPE
+
+    if _DEFAULT_OS_SCOPE is None:
+        _DEFAULT_OS_SCOPE = dict(
+            (s, _get_os_scope_service_env(s)) for s in SCOPE_SERVICES)
+
+    return dict(_DEFAULT_OS_SCOPE)
+
+
 # -- 🐒 Monkey Patching 🐒
 OS_SCOPE = None
+OS_SCOPE_HEADER = None
+
+init_app = None
+session_request = None
+
 
 # 1. Monkeypatch OpenStackShell.initialize_app to retrieve the scope value
 #
 # See,
 # https://github.com/openstack/osc-lib/blob/aaf18dad8dd0b73db31aa95a6f2fce431c4cafda/osc_lib/shell.py#L390
-from osc_lib import shell
-
-
-init_app = shell.OpenStackShell.initialize_app
 def mkeypatch_initialize_app(cls, argv):
     """Get the `os-scope` at the initialization of the app.
 
@@ -123,7 +172,7 @@ def mkeypatch_initialize_app(cls, argv):
     latter use in `Session.request`.
 
     """
-    global OS_SCOPE
+    global OS_SCOPE, OS_SCOPE_HEADER
 
     os_scope = _get_default_os_scope()
     shell_scope = cls.options.os_scope
@@ -132,7 +181,7 @@ def mkeypatch_initialize_app(cls, argv):
 
     if isinstance(shell_scope, dict):
         os_scope.update(shell_scope)
-    elif isinstance(shell_scope, basestring):
+    elif isinstance(shell_scope, string_types):
         try:
             os_scope.update(json.loads(shell_scope))
         except ValueError:
@@ -140,8 +189,18 @@ def mkeypatch_initialize_app(cls, argv):
     else:
         raise ValueError(error_msg)
 
+    for clouds in os_scope.values():
+        if isinstance(clouds, list) and (
+                not clouds or
+                not all(isinstance(c, string_types) for c in clouds)):
+            raise ValueError(error_msg)
+
     OS_SCOPE = os_scope
-    LOG.info("Save the current os-scope: ", OS_SCOPE)
+    OS_SCOPE_HEADER = _serialize_scope(_bind_scope(os_scope))
+    LOG.info("Save the current os-scope: %s", OS_SCOPE_HEADER)
+
+    # The scope is known, requests may now carry it
+    patch_session()
 
     # XXX(rcherrueau): We remove the `os_scope` from the list of command
     # options (i.e., `cls.options`). We have to do so because of openstack
@@ -160,7 +219,17 @@ def mkeypatch_initialize_app(cls, argv):
     del cls.options.os_scope
 
     return init_app(cls, argv)
-shell.OpenStackShell.initialize_app = mkeypatch_initialize_app
+
+
+def patch_shell():
+    """Patch `OpenStackShell.initialize_app`, once."""
+    global init_app
+
+    if init_app is None:
+        from osc_lib import shell
+
+        init_app = shell.OpenStackShell.initialize_app
+        shell.OpenStackShell.initialize_app = mkeypatch_initialize_app
 
 
 # 2. Monkey patch `Session.request` to piggyback the scope with the keystone
@@ -168,25 +237,278 @@ shell.OpenStackShell.initialize_app = mkeypatch_initialize_app
 #
 # See,
 # https://github.com/requests/requests/blob/64bde6582d9b49e9345d9b8df16aaa26dc372d13/requests/sessions.py#L466
-from requests import Session
+def _bind_scope(os_scope, service_type=None, cloud=None):
+    """Bind each service of `os_scope` to one cloud.
+
+    `service_type` is bound to `cloud`, and other services bound to several
+    clouds to the first one.
+
+    """
+    scope = dict((s, c[0] if isinstance(c, list) else c)
+                 for s, c in os_scope.items())
+    if service_type is not None:
+        scope[service_type] = cloud
+
+    return scope
+
+
+def _serialize_scope(scope):
+    """Serialize `scope` for the headers of requests.
+
+    Serializes in the compact format, unless `OS_SCOPE_FORMAT` is `json`.
+
+    """
+    if os.environ.get('OS_SCOPE_FORMAT') == 'json':
+        return json.dumps(scope)
+
+    try:
+        from urllib.parse import quote
+    except ImportError:
+        from urllib import quote
+
+    default = os.environ.get('OS_REGION_NAME') or DEFAULT_OS_REGION_NAME
+    return SCOPE_COMPACT_PREFIX + quote(default, safe='') + ''.join(
+        ';%s=%s' % (quote(service, safe=''), quote(cloud, safe=''))
+        for service, cloud in scope.items() if cloud != default)
+
+
+def _scope_headers(headers, os_scope_header):
+    """Put the scope in `headers`."""
+    # Put the scope in X-Scope header
+    LOG.info("Find a os-scope %s...", os_scope_header)
+    headers['X-Scope'] = os_scope_header
+
+    # Piggyback OS_SCOPE with X-Auth-Token
+    if 'X-Auth-Token' in headers:
+        LOG.info("...to piggyback on token %s", headers['X-Auth-Token'])
+        headers['X-Auth-Token'] = "%s!SCOPE!%s" % (
+            headers['X-Auth-Token'], os_scope_header)
+        LOG.debug("Piggyback os-scope %r", headers)
+
+
+# Urls of the services in the catalog of the last token, longest first, to
+# tell the service targeted by a request.
+SERVICE_URLS = []
+
+
+def _learn_catalog(method, url, resp):
+    """Save the service urls of the catalog that comes with a new token."""
+    global SERVICE_URLS
+
+    if method.upper() != 'POST' or not url.rstrip('/').endswith(
+            '/auth/tokens') or not resp.ok:
+        return
+
+    try:
+        catalog = resp.json()['token']['catalog']
+    except (ValueError, KeyError, TypeError):
+        return
+
+    SERVICE_URLS = sorted(
+        ((e['url'].rstrip('/'), s['type'])
+         for s in catalog for e in s.get('endpoints', [])),
+        key=lambda u: -len(u[0]))
+
+
+def _lookup_service(url):
+    """Find the url and type of the service targeted by `url`.
+
+    Returns (None, None) if `url` targets no service of the catalog.
+
+    """
+    for service_url, service_type in SERVICE_URLS:
+        if url.startswith(service_url):
+            return service_url, service_type
+
+    return None, None
+
+
+def _is_listing(url, service_url):
+    """Tell whether `url` lists a collection of the service at `service_url`.
+
+    Version discovery (e.g., `/`, `/v2`), schemas (e.g., `/v2/schemas/image`)
+    and single resources, whose path ends with an id, are not listings.
+
+    """
+    path = url[len(service_url):].split('?', 1)[0]
+    segments = [s for s in path.split('/') if s]
+    if segments and VERSION_RE.match(segments[0]):
+        segments = segments[1:]
+
+    return bool(segments) and not ID_RE.match(segments[-1]) and not any(
+        s in ('schemas', 'schema') for s in segments)
+
+
+def _get_os_scope_timeout():
+    """Timeout of each cloud in a fan-out (Env: OS_SCOPE_TIMEOUT)."""
+    try:
+        return float(os.environ['OS_SCOPE_TIMEOUT'])
+    except (KeyError, ValueError):
+        return DEFAULT_OS_SCOPE_TIMEOUT
+
+
+def _fan_out(cls, method, url, service_type, clouds, kwargs):
+    """Send the request to `service_type` of every cloud of `clouds`.
+
+    Requests run concurrently, each one bound by the timeout, so that the
+    fan-out takes as long as the slowest cloud, and at most the timeout.
+
+    """
+    timeout = _get_os_scope_timeout()
+    results = {}
+
+    def request(cloud):
+        headers = dict(kwargs.get('headers') or {})
+        _scope_headers(headers, _serialize_scope(
+            _bind_scope(OS_SCOPE, service_type, cloud)))
+        cloud_kwargs = dict(kwargs, headers=headers)
+        if not isinstance(kwargs.get('timeout'), (int, float)):
+            cloud_kwargs['timeout'] = timeout
+        try:
+            results[cloud] = session_request(cls, method, url, **cloud_kwargs)
+        except Exception as e:
+            results[cloud] = e
+
+    threads = [threading.Thread(target=request, args=(c,)) for c in clouds]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    deadline = time.time() + timeout
+    for t in threads:
+        t.join(max(0, deadline - time.time()))
+
+    return _merge(service_type, [(c, results.get(c)) for c in clouds])
+
+
+def _collection_key(body):
+    """Find the key of the list of a collection in a json `body`, or None.
+
+    A collection is a json object with exactly one list, besides its
+    pagination links (`*_links`).
+
+    """
+    if not isinstance(body, dict):
+        return None
+
+    keys = [k for k, v in body.items()
+            if isinstance(v, list) and not k.endswith('_links')]
+    return keys[0] if len(keys) == 1 else None
+
+
+def _has_next_page(body):
+    """Tell whether the collection `body` has a next page.
+
+    Glance names the next page in `next`, and Nova or Neutron in a link of
+    `rel` next in `<collection>_links`.
+
+    """
+    if body.get('next'):
+        return True
+
+    return any(isinstance(link, dict) and link.get('rel') == 'next'
+               for k, links in body.items()
+               if k.endswith('_links') and isinstance(links, list)
+               for link in links)
+
+
+def _merge(service_type, results):
+    """Merge the responses of `results`, a list of (cloud, response).
+
+    The lists of json collections (see `_collection_key`) are concatenated,
+    and their items tagged with their cloud. Pagination links are dropped,
+    since each one only makes sense to its cloud: the response holds the
+    first page of every cloud, and names the clouds with more pages in
+    `X-Scope-Truncated-Clouds`. Returns the first successful response as
+    is, if there is nothing to merge.
+
+    """
+    ok, failed = [], []
+    for cloud, resp in results:
+        if getattr(resp, 'ok', False):
+            ok.append((cloud, resp))
+        else:
+            failed.append(cloud)
+            LOG.warning("No %s from %s: %s", service_type, cloud,
+                        'timed out' if resp is None else resp)
+
+    if not ok:
+        # Report the error of the first cloud
+        cloud, resp = results[0]
+        if resp is None:
+            from requests.exceptions import Timeout
+            raise Timeout("%s of %s timed out" % (service_type, cloud))
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+    try:
+        bodies = [(cloud, resp.json()) for cloud, resp in ok]
+    except ValueError:
+        return ok[0][1]
+    key = _collection_key(bodies[0][1])
+    if key is None or not all(_collection_key(body) == key
+                              for _, body in bodies):
+        return ok[0][1]
+
+    def tag(item, cloud):
+        if isinstance(item, dict):
+            item = dict(item)
+            item.setdefault(SCOPE_CLOUD_KEY, cloud)
+        return item
+
+    merged = dict((k, v) for k, v in bodies[0][1].items()
+                  if k != 'next' and not k.endswith('_links'))
+    merged[key] = [tag(item, cloud) for cloud, body in bodies
+                   for item in body[key]]
+
+    truncated = [cloud for cloud, body in bodies if _has_next_page(body)]
+    if truncated:
+        LOG.warning("Only the first page of %s from %s is listed",
+                    service_type, ', '.join(truncated))
+
+    resp = ok[0][1]
+    resp._content = json.dumps(merged).encode('utf-8')
+    resp.headers['Content-Length'] = str(len(resp._content))
+    resp.headers['X-Scope-Clouds'] = ','.join(cloud for cloud, _ in ok)
+    if failed:
+        resp.headers['X-Scope-Failed-Clouds'] = ','.join(failed)
+    if truncated:
+        resp.headers['X-Scope-Truncated-Clouds'] = ','.join(truncated)
+
+    return resp
+
 
-session_request = Session.request
 def mkeypatch_session_request(cls, method, url, **kwargs):
-    """Piggyback the `OS_SCOPE` on `X-Auth-Token`."""
+    """Piggyback the `OS_SCOPE` on `X-Auth-Token`.
+
+    Fan out listing requests to services bound to several clouds.
+
+    """
+    if not OS_SCOPE:
+        return session_request(cls, method, url, **kwargs)
+
+    service_url, service_type = _lookup_service(url)
+    clouds = OS_SCOPE.get(service_type)
+    if (method.upper() == 'GET' and isinstance(clouds, list) and
+            len(clouds) > 1 and _is_listing(url, service_url)):
+        return _fan_out(cls, method, url, service_type, clouds, kwargs)
+
     # Retrieve headers of the request
-    headers = kwargs.get('headers', {})
+    headers = kwargs.setdefault('headers', {})
+    _scope_headers(headers, OS_SCOPE_HEADER)
 
-    # Put the scope in X-Scope header
-    if OS_SCOPE:
-        LOG.info("Find a os-scope %s..." % OS_SCOPE)
-        os_scope_json = json.dumps(OS_SCOPE)
-        headers['X-Scope'] = os_scope_json
-
-        # Piggyback OS_SCOPE with X-Auth-Token
-        if 'X-Auth-Token' in headers:
-            LOG.info("...to piggyback on token %s " % headers['X-Auth-Token'])
-            headers['X-Auth-Token'] = "%s!SCOPE!%s" % (headers['X-Auth-Token'], os_scope_json)
-            LOG.debug("Piggyback os-scope %s" % repr(headers))
-
-    return session_request(cls, method, url, **kwargs)
-Session.request = mkeypatch_session_request
+    resp = session_request(cls, method, url, **kwargs)
+    _learn_catalog(method, url, resp)
+    return resp
+
+
+def patch_session():
+    """Patch `requests.Session.request`, once."""
+    global session_request
+
+    if session_request is None:
+        from requests import Session
+
+        session_request = Session.request
+        Session.request = mkeypatch_session_request
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -
+#   ____                ______           __        _    __
+#  / __ \___  ___ ___  / __/ /____ _____/ /_____  (_)__/ /
+# / /_/ / _ \/ -_) _ \_\ \/ __/ _ `/ __/  '_/ _ \/ / _  /
+# \____/ .__/\__/_//_/___/\__/\_,_/\__/_/\_\\___/_/\_,_/
+#     /_/
+# Make your OpenStacks Collaborative
+
+import json
+import unittest
+from unittest import TestCase, mock
+
+from requests import Response
+from requests.exceptions import ConnectionError, Timeout
+
+from openstackoidclient import client
+
+
+IMAGE_URL = 'http://10.0.0.1:8888/image'
+
+
+def response(status, body):
+    "Makes a response of `status` with the json `body`."
+    resp = Response()
+    resp.status_code = status
+    resp._content = json.dumps(body).encode('utf-8')
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
+def images(*names, **extra):
+    "Makes a Glance listing of images `names`."
+    return dict({'images': [{'name': name} for name in names],
+                 'first': '/v2/images', 'schema': '/v2/schemas/images'},
+                **extra)
+
+
+class TestFanOut(TestCase):
+    def setUp(self):
+        patches = {
+            'OS_SCOPE': {'image': ['CloudOne', 'CloudTwo', 'CloudThree'],
+                         'compute': 'CloudOne'},
+            'SERVICE_URLS': [(IMAGE_URL, 'image')],
+        }
+        for name, value in patches.items():
+            patcher = mock.patch.object(client, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.requests = []
+        self.responses = {}
+
+        def session_request(session, method, url, **kwargs):
+            scope = kwargs['headers']['X-Scope']
+            cloud = next(c for c in self.responses
+                         if scope.endswith('image=%s' % c) or
+                         scope == '1:%s' % c)
+            self.requests.append((method, url, cloud))
+            resp = self.responses[cloud]
+            if isinstance(resp, Exception):
+                raise resp
+            return resp
+
+        patcher = mock.patch.object(client, 'session_request',
+                                    session_request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict('os.environ', {'OS_REGION_NAME': 'CloudOne'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(client, 'OS_SCOPE_HEADER', '1:CloudOne')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_merge(self):
+        with self.assertLogs(client.LOG, 'WARNING') as logs:
+            resp = client._merge('image', [
+                ('CloudOne', response(200, images('cirros'))),
+                ('CloudTwo', response(200, images(
+                    'fedora', 'debian', next='/v2/images?marker=42'))),
+                ('CloudThree', ConnectionError('refused')),
+                ('CloudFour', None)])
+
+        self.assertEqual(resp.json(), {
+            'images': [{'name': 'cirros', 'scope_cloud': 'CloudOne'},
+                       {'name': 'fedora', 'scope_cloud': 'CloudTwo'},
+                       {'name': 'debian', 'scope_cloud': 'CloudTwo'}],
+            'first': '/v2/images', 'schema': '/v2/schemas/images'})
+        self.assertEqual(resp.headers['X-Scope-Clouds'], 'CloudOne,CloudTwo')
+        self.assertEqual(resp.headers['X-Scope-Failed-Clouds'],
+                         'CloudThree,CloudFour')
+        self.assertEqual(resp.headers['X-Scope-Truncated-Clouds'], 'CloudTwo')
+        self.assertEqual(resp.headers['Content-Length'],
+                         str(len(resp.content)))
+        self.assertIn('Only the first page of image from CloudTwo',
+                      '\n'.join(logs.output))
+
+        # Nova and Neutron name the next page in `<collection>_links`
+        resp = client._merge('compute', [
+            ('CloudOne', response(200, {'servers': [{'id': 1}]})),
+            ('CloudTwo', response(200, {
+                'servers': [{'id': 2}],
+                'servers_links': [{'rel': 'next', 'href': '/servers?m=2'}]}))])
+        self.assertEqual(resp.json(), {'servers': [
+            {'id': 1, 'scope_cloud': 'CloudOne'},
+            {'id': 2, 'scope_cloud': 'CloudTwo'}]})
+        self.assertEqual(resp.headers['X-Scope-Truncated-Clouds'], 'CloudTwo')
+
+    def test_merge_not_collections(self):
+        # A single resource, or a body with several lists, is not merged
+        for body in [{'image': {'name': 'cirros'}},
+                     {'versions': [{'id': 'v2.1'}], 'other': []},
+                     [{'name': 'cirros'}]]:
+            first = response(200, body)
+            self.assertIs(client._merge('image', [
+                ('CloudOne', first), ('CloudTwo', response(200, body))]),
+                first)
+            self.assertNotIn('X-Scope-Clouds', first.headers)
+
+        # Nor are collections of different resources
+        first = response(200, {'images': []})
+        self.assertIs(client._merge('image', [
+            ('CloudOne', first), ('CloudTwo', response(200, {'tasks': []}))]),
+            first)
+
+        # Without any success, the first error is reported
+        not_found = response(404, {'message': 'Not Found'})
+        self.assertIs(client._merge('image', [
+            ('CloudOne', not_found), ('CloudTwo', None)]), not_found)
+        with self.assertLogs(client.LOG, 'WARNING'):
+            self.assertRaises(Timeout, client._merge, 'image', [
+                ('CloudOne', None), ('CloudTwo', not_found)])
+            self.assertRaises(ConnectionError, client._merge, 'image', [
+                ('CloudOne', ConnectionError('refused'))])
+
+    def test_fan_out(self):
+        self.responses = {
+            'CloudOne': response(200, images('cirros')),
+            'CloudTwo': response(200, images('fedora')),
+            'CloudThree': response(503, {}),
+        }
+        with self.assertLogs(client.LOG, 'WARNING'):
+            resp = client.mkeypatch_session_request(
+                None, 'GET', IMAGE_URL + '/v2/images?limit=20',
+                headers={'X-Auth-Token': 'token'})
+
+        self.assertEqual(sorted(cloud for _, _, cloud in self.requests),
+                         ['CloudOne', 'CloudThree', 'CloudTwo'])
+        self.assertEqual([i['scope_cloud'] for i in resp.json()['images']],
+                         ['CloudOne', 'CloudTwo'])
+        self.assertEqual(resp.headers['X-Scope-Failed-Clouds'], 'CloudThree')
+
+    def test_no_fan_out(self):
+        # Version discovery, schemas and single resources go to the first
+        # cloud of the list only
+        self.responses = {'CloudOne': response(200, {})}
+        for path in ['', '/', '/v2', '/v2/schemas/images',
+                     '/v2/images/6a7c4f8e-1b3d-4c5e-9f0a-2b4c6d8e0f1a',
+                     '/v2/images/6a7c4f8e1b3d4c5e9f0a2b4c6d8e0f1a',
+                     '/v2.1/flavors/42']:
+            self.requests = []
+            client.mkeypatch_session_request(None, 'GET', IMAGE_URL + path,
+                                             headers={})
+            self.assertEqual(self.requests,
+                             [('GET', IMAGE_URL + path, 'CloudOne')], path)
+
+        # So do requests other than GET
+        self.requests = []
+        client.mkeypatch_session_request(None, 'POST',
+                                         IMAGE_URL + '/v2/images', headers={})
+        self.assertEqual(len(self.requests), 1)
+
+    def test_is_listing(self):
+        for path, listing in [('/v2/images', True),
+                              ('/v2/images?limit=2', True),
+                              ('/servers/detail', True),
+                              ('/v2/images/42/members', True),
+                              ('', False), ('/v2.1', False),
+                              ('/v2/images/42', False),
+                              ('/v2/schemas/image', False)]:
+            self.assertEqual(client._is_listing(IMAGE_URL + path, IMAGE_URL),
+                             listing, path)
+
+
+if __name__ == "__main__":
+    unittest.main()